@@ -1,11 +1,15 @@
 from __future__ import absolute_import
 
 from pke.data_structures import Candidate, Document, Sentence
-from pke.readers import MinimalCoreNLPReader, RawTextReader
+from pke.readers import (MinimalCoreNLPReader, RawTextReader,
+                         JsonlCorpusReader)
 from pke.base import LoadFile
+from pke.lang import stem, stem_words, cache_info, clear_cache
+from pke.cache import DocumentCache, set_default_cache
+from pke.graph import Graph, pagerank
 from pke.utils import (load_document_frequency_file, compute_document_frequency,
                        train_supervised_model, load_references,
-                       compute_lda_model, load_document_as_bos,
+                       compute_lda_model, load_lda_model, load_document_as_bos,
                        compute_pairwise_similarity_matrix)
 import pke.unsupervised
 # import pke.supervised
@@ -6,29 +6,60 @@ from collections import defaultdict
 
 from pke.data_structures import Candidate, Document
 from pke.readers import MinimalCoreNLPReader, RawTextReader
+from pke.lang import ISO_to_language, stem_words
+from pke.cache import get_default_cache
 
-from nltk.stem.snowball import SnowballStemmer
 from nltk import RegexpParser
 from nltk.corpus import stopwords
 from nltk.tag.mapping import map_tag
 
 from string import punctuation
 import os
+import json
+import time
+import heapq
 import logging
 import codecs
+import functools
 
 from six import string_types
 
 from builtins import str
 
-ISO_to_language = {'en': 'english', 'pt': 'portuguese', 'fr': 'french',
-                   'es': 'spanish', 'it': 'italian', 'nl': 'dutch',
-                   'de': 'german'}
-
 escaped_punctuation = {'-lrb-': '(', '-rrb-': ')', '-lsb-': '[', '-rsb-': ']',
                        '-lcb-': '{', '-rcb-': '}'}
 
 
+def stage(name):
+    """Decorator for the methods implementing an extraction stage. When the
+    profiling of the extractor is enabled (see LoadFile.enable_profiling), the
+    wall time of the stage is added to the profile, as well as the sizes of the
+    document, candidates, topics and graph after the stage. Nested calls to a
+    stage of the same name are only timed once.
+
+    Args:
+        name (str): the name of the stage.
+    """
+
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            profile = getattr(self, 'profile', None)
+            if profile is None or name in profile['active']:
+                return method(self, *args, **kwargs)
+
+            profile['active'].add(name)
+            start = time.perf_counter()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                profile['timings'][name] += time.perf_counter() - start
+                profile['active'].discard(name)
+                self._record_sizes()
+        return wrapper
+    return decorator
+
+
 class LoadFile(object):
     """The LoadFile class that provides base functions."""
 
@@ -62,6 +93,34 @@ class LoadFile(object):
         self.stoplist = None
         """List of stopwords."""
 
+        self.profile = None
+        """Stage timings and sizes, None unless profiling is enabled."""
+
+    def enable_profiling(self):
+        """Enables the recording of the wall time (in seconds) of each
+        extraction stage and of the sizes of the document, candidates, topics
+        and graph in self.profile."""
+
+        self.profile = {'timings': defaultdict(float),
+                        'sizes': {},
+                        'active': set()}
+
+    def _record_sizes(self):
+        """Records the current sizes of the document, candidates, topics and
+        graph in the profile."""
+
+        sizes = self.profile['sizes']
+        sizes['sentences'] = len(self.sentences)
+        sizes['words'] = sum(s.length for s in self.sentences)
+        sizes['candidates'] = len(self.candidates)
+        if getattr(self, 'topics', None) is not None:
+            sizes['topics'] = len(self.topics)
+        graph = getattr(self, 'graph', None)
+        if graph is not None:
+            sizes['graph_nodes'] = graph.number_of_nodes()
+            sizes['graph_edges'] = graph.number_of_edges()
+
+    @stage('load_document')
     def load_document(self, input, **kwargs):
         """Loads the content of a document/string/stream in a given language.
 
@@ -72,6 +131,12 @@ class LoadFile(object):
             normalization (str): word normalization method, defaults to
                 'stemming'. Other possible values are 'lemmatization' or 'None'
                 for using word surface forms instead of stems/lemmas.
+            cache (DocumentCache): the cache of preprocessed documents,
+                defaults to the one set with pke.cache.set_default_cache, if
+                any. Only file paths and strings are cached, the other
+                arguments (e.g. encoding, max_length) being part of the cache
+                key. Documents loaded with arguments that are not JSON
+                serializable are not cached.
         """
 
         # get the language parameter
@@ -84,6 +149,27 @@ class LoadFile(object):
                     language))
             language = 'en'
 
+        # get the word normalization method
+        normalization = kwargs.get('normalization', 'stemming')
+
+        # look for the preprocessed document in the cache
+        cache = kwargs.get('cache', get_default_cache())
+        cache_key = None
+        if cache is not None and isinstance(input, string_types):
+            cache_key = self._cache_key(cache, input, language, normalization,
+                                        kwargs)
+        if cache_key is not None:
+            sentences = cache.get(cache_key)
+            if sentences is not None:
+                self.input_file = None
+                if os.path.isfile(input) and input.endswith('xml'):
+                    self.input_file = input
+                self.language = language
+                self.sentences = sentences
+                self.stoplist = stopwords.words(ISO_to_language[language])
+                self.normalization = normalization
+                return
+
         # initialize document
         doc = Document()
 
@@ -138,7 +224,7 @@ class LoadFile(object):
         self.stoplist = stopwords.words(ISO_to_language[self.language])
 
         # word normalization
-        self.normalization = kwargs.get('normalization', 'stemming')
+        self.normalization = normalization
         if self.normalization == 'stemming':
             self.apply_stemming()
         elif self.normalization is None:
@@ -154,20 +240,41 @@ class LoadFile(object):
             self.normalize_pos_tags()
             self.unescape_punctuation_marks()
 
-    def apply_stemming(self):
-        """Populates the stem containers of sentences."""
+        # store the preprocessed document in the cache
+        if cache_key is not None:
+            cache.put(cache_key, self.sentences)
 
-        if self.language == 'en':
-            # create a new instance of a porter stemmer
-            stemmer = SnowballStemmer("porter")
+    @staticmethod
+    def _cache_key(cache, input, language, normalization, kwargs):
+        """Computes the cache key of a file path or string input, or returns
+        None if the document can't be cached."""
+
+        # the arguments given to the reader change the parse
+        options = {name: value for name, value in kwargs.items()
+                   if name not in ('language', 'normalization', 'cache')}
+        try:
+            json.dumps(options)
+        except (TypeError, ValueError):
+            return None
+
+        if os.path.isfile(input):
+            reader = 'corenlp' if input.endswith('xml') else 'raw'
+            with open(input, 'rb') as f:
+                content = f.read()
         else:
-            # create a new instance of a porter stemmer
-            stemmer = SnowballStemmer(ISO_to_language[self.language],
-                                      ignore_stopwords=True)
+            reader = 'raw'
+            content = input
+
+        return cache.key(content, language, normalization, reader,
+                         options=options)
+
+    def apply_stemming(self):
+        """Populates the stem containers of sentences using the process-wide
+        stem cache."""
 
         # iterate throughout the sentences
         for i, sentence in enumerate(self.sentences):
-            self.sentences[i].stems = [stemmer.stem(w) for w in sentence.words]
+            self.sentences[i].stems = stem_words(sentence.words, self.language)
 
     def normalize_pos_tags(self):
         """Normalizes the PoS tags from udp-penn to UD."""
@@ -217,6 +324,22 @@ class LoadFile(object):
                     return True
         return False
 
+    def _add_subsequences(self, candidate, subsequences):
+        """Adds all the contiguous sub-sequences of the lexical form of a
+        candidate to a set, so that testing the redundancy of another candidate
+        against the selected ones is a single lookup.
+
+        Args:
+            candidate (str): the lexical form of the candidate.
+            subsequences (set): the set of sub-sequences (tuples of stems).
+        """
+
+        lexical_form = tuple(self.candidates[candidate].lexical_form)
+        for i in range(len(lexical_form)):
+            for j in range(i + 1, len(lexical_form) + 1):
+                subsequences.add(lexical_form[i:j])
+
+    @stage('get_n_best')
     def get_n_best(self, n=10, redundancy_removal=False, stemming=False):
         """Returns the n-best candidates given the weights.
 
@@ -229,31 +352,36 @@ class LoadFile(object):
                 False.
         """
 
-        # sort candidates by descending weight
-        best = sorted(self.weights, key=self.weights.get, reverse=True)
-
         # remove redundant candidates
         if redundancy_removal:
 
             # initialize a new container for non redundant candidates
-            non_redundant_best = []
+            best = []
+
+            # contiguous sub-sequences of the selected candidates
+            selected_subsequences = set()
+
+            # heap of the candidates, ties are broken by insertion order
+            heap = [(-self.weights[u], i, u) for i, u in
+                    enumerate(self.weights)]
+            heapq.heapify(heap)
 
-            # loop through the best candidates
-            for candidate in best:
+            # pop the candidates by descending weight
+            while heap and len(best) < n:
+                candidate = heapq.heappop(heap)[2]
 
                 # test wether candidate is redundant
-                if self.is_redundant(candidate, non_redundant_best):
+                if tuple(self.candidates[candidate].lexical_form) in \
+                        selected_subsequences:
                     continue
 
                 # add the candidate otherwise
-                non_redundant_best.append(candidate)
+                best.append(candidate)
+                self._add_subsequences(candidate, selected_subsequences)
 
-                # break computation if the n-best are found
-                if len(non_redundant_best) >= n:
-                    break
-
-            # copy non redundant candidates in best container
-            best = non_redundant_best
+        else:
+            # select the n candidates with the highest weights
+            best = heapq.nlargest(n, self.weights, key=self.weights.get)
 
         # get the list of best candidates as (lexical form, weight) tuples
         n_best = [(u, self.weights[u]) for u in best[:min(n, len(best))]]
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmark of the pke extractors on samples of the StackOverflow dataset.
+
+The extractors are run on the first documents of a JSON lines file with
+'Title' and 'Body' fields (e.g. stackof_test.json), for each sample size, with
+profiling enabled. The throughput, the latency percentiles, the time spent in
+each stage, the average sizes of the documents, candidates and graphs, the
+memory usage and the stem cache hit rate are written as JSON.
+
+Two memory figures are reported: ``process_max_rss_mb`` is the high-water
+mark of the resident memory of the whole process, which is cumulative over
+the runs of a benchmark (a run only raises it if it uses more memory than
+all the previous ones), and ``python_peak_memory_mb`` (with --trace-memory)
+is the peak of the Python allocations traced during the run only, which
+excludes the memory allocated by native code such as spacy or numpy.
+
+Usage::
+
+    python -m pke.benchmark --input ../stackof_test.json \\
+        --sizes 10 100 1000 --output benchmark.json
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import sys
+import json
+import time
+import codecs
+import logging
+import argparse
+import itertools
+import tracemalloc
+from collections import defaultdict
+
+import numpy as np
+
+from pke.lang import cache_info, clear_cache
+from pke.cache import get_default_cache, set_default_cache
+from pke.readers import JsonlCorpusReader
+from pke.unsupervised import TopicRank, MultipartiteRank
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+EXTRACTORS = {'TopicRank': TopicRank,
+              'MultipartiteRank': MultipartiteRank}
+"""Extractors that can be benchmarked."""
+
+PERCENTILES = [50, 90, 95, 99]
+"""Reported latency percentiles."""
+
+
+def load_stackoverflow(input_file, n):
+    """Loads the text (title and body) of the first documents of a JSON lines
+    file.
+
+    Args:
+        input_file (str): path to the input file, optionally gzip compressed.
+        n (int): the number of documents.
+    """
+
+    texts = [text for _, text, _ in
+             itertools.islice(JsonlCorpusReader(input_file), n)]
+
+    if len(texts) < n:
+        logging.warning('only {} documents in {} ({} requested)'.format(
+            len(texts), input_file, n))
+
+    return texts
+
+
+def extract_keyphrases(extractor_class, text, n=10):
+    """Runs an extractor with default parameters on a text.
+
+    Args:
+        extractor_class (class): the extractor.
+        text (str): the text of the document.
+        n (int): the number of keyphrases, defaults to 10.
+
+    Returns:
+        tuple: the keyphrases and the profile of the extractor.
+    """
+
+    extractor = extractor_class()
+    extractor.enable_profiling()
+    extractor.load_document(input=text, language='en')
+    extractor.candidate_selection()
+    extractor.candidate_weighting()
+    keyphrases = extractor.get_n_best(n=n)
+
+    return keyphrases, extractor.profile
+
+
+def run_benchmark(extractor_class, texts, n=10, trace_memory=False):
+    """Benchmarks an extractor on a list of texts.
+
+    Args:
+        extractor_class (class): the extractor.
+        texts (list): the texts of the documents.
+        n (int): the number of keyphrases, defaults to 10.
+        trace_memory (bool): whether to trace the Python memory allocations
+            for reporting their peak during the run (native allocations are
+            not traced), which slows down the extraction, defaults to False.
+
+    Returns:
+        dict: the benchmark report.
+    """
+
+    # start from an empty stem cache
+    clear_cache()
+
+    if trace_memory:
+        tracemalloc.start()
+
+    latencies = []
+    timings = defaultdict(list)
+    sizes = defaultdict(list)
+    errors = 0
+
+    start = time.perf_counter()
+    for text in texts:
+        document_start = time.perf_counter()
+        try:
+            _, profile = extract_keyphrases(extractor_class, text, n=n)
+        except Exception as e:
+            logging.warning('extraction failed: {}'.format(e))
+            errors += 1
+            continue
+        latencies.append(time.perf_counter() - document_start)
+
+        for name, duration in profile['timings'].items():
+            timings[name].append(duration)
+        for name, size in profile['sizes'].items():
+            sizes[name].append(size)
+    total_time = time.perf_counter() - start
+
+    report = {
+        'extractor': extractor_class.__name__,
+        'documents': len(texts),
+        'errors': errors,
+        'total_time': total_time,
+        'throughput': len(latencies) / total_time if total_time else 0.0,
+        'latency': {},
+        'stages': {},
+        'sizes': {name: float(np.mean(values))
+                  for name, values in sizes.items()},
+        'stem_cache': cache_info()['stem'],
+    }
+
+    if latencies:
+        report['latency'] = {'mean': float(np.mean(latencies)),
+                             'max': float(np.max(latencies))}
+        for q, value in zip(PERCENTILES, np.percentile(latencies,
+                                                       PERCENTILES)):
+            report['latency']['p{}'.format(q)] = float(value)
+
+    for name, durations in timings.items():
+        report['stages'][name] = {'total': float(np.sum(durations)),
+                                  'mean': float(np.mean(durations)),
+                                  'share': float(np.sum(durations)) /
+                                  total_time if total_time else 0.0}
+
+    if trace_memory:
+        report['python_peak_memory_mb'] = \
+            tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+
+    if resource is not None:
+        # high-water mark of the process so far, not the peak of this run
+        # (kilobytes on linux, bytes on mac os)
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == 'darwin':
+            max_rss /= 1024
+        report['process_max_rss_mb'] = max_rss / 1024
+
+    document_cache = get_default_cache()
+    if document_cache is not None:
+        report['document_cache'] = document_cache.stats()
+
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark of the pke extractors.')
+    parser.add_argument('--input', default='stackof_test.json',
+                        help='JSON lines file with Title and Body fields, '
+                        'optionally gzip compressed')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100],
+                        help='numbers of documents of the samples')
+    parser.add_argument('--extractors', nargs='+', default=sorted(EXTRACTORS),
+                        choices=sorted(EXTRACTORS),
+                        help='extractors to benchmark')
+    parser.add_argument('-n', type=int, default=10,
+                        help='number of keyphrases per document')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='report the peak of the Python allocations '
+                        'of each run (native allocations are not traced)')
+    parser.add_argument('--cache-dir', default=None,
+                        help='directory of the preprocessed document cache')
+    parser.add_argument('--output', default=None,
+                        help='output JSON file, defaults to stdout')
+    args = parser.parse_args(argv)
+
+    if args.cache_dir is not None:
+        set_default_cache(args.cache_dir)
+
+    reports = []
+    for size in args.sizes:
+        texts = load_stackoverflow(args.input, size)
+        for name in args.extractors:
+            logging.info('benchmarking {} on {} documents'.format(name, size))
+            report = run_benchmark(EXTRACTORS[name], texts, n=args.n,
+                                   trace_memory=args.trace_memory)
+            report['sample_size'] = size
+            reports.append(report)
+
+    output = json.dumps(reports, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        with codecs.open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+
+"""On-disk cache of preprocessed documents for the pke module.
+
+Parsing documents with spacy or reading CoreNLP files is by far the most
+expensive step of keyphrase extraction, and experiments usually re-run it on
+the same documents with only the ranking parameters changing. The cache stores
+the sentences of loaded documents (words, stems, Part-Of-Speeches, character
+offsets and meta-information), keyed by a hash of the input content, the
+language, the normalization method and the reader version.
+
+Example::
+
+    import pke
+
+    pke.cache.set_default_cache('path/to/cache/dir')
+
+    # parsed once, then read from the cache
+    extractor = pke.unsupervised.MultipartiteRank()
+    extractor.load_document(input='path/to/input.txt')
+"""
+
+from __future__ import division
+
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from pke.data_structures import Sentence
+from pke.readers import READER_VERSION
+
+CACHE_FORMAT = 1
+"""Version of the serialization format, part of the cache keys."""
+
+_default_cache = None
+
+
+class DocumentCache(object):
+    """Directory of preprocessed documents with a LRU size cap.
+
+    Each document is stored in its own compressed numpy archive holding a
+    string table and integer arrays indexing it, so that no pickling is
+    involved. The least recently used documents are removed when the total
+    size of the cache exceeds its maximum size.
+    """
+
+    def __init__(self, cache_dir, max_size=2 ** 30):
+        """Initializer for DocumentCache class.
+
+        Args:
+            cache_dir (str): the directory of the cache, created if needed.
+            max_size (int): the maximum size of the cache in bytes, defaults to
+                1GB.
+        """
+
+        self.cache_dir = cache_dir
+        """Path to the cache directory."""
+
+        self.max_size = max_size
+        """Maximum size of the cache in bytes."""
+
+        self.hits = 0
+        """Number of documents read from the cache."""
+
+        self.misses = 0
+        """Number of documents not found in the cache."""
+
+        self.evictions = 0
+        """Number of documents removed from the cache."""
+
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+        # current size of the cache
+        self._size = sum(os.path.getsize(path) for path in self._entries())
+
+    def _entries(self):
+        """Returns the paths of the cached documents."""
+
+        return [os.path.join(self.cache_dir, name)
+                for name in os.listdir(self.cache_dir)
+                if name.endswith('.npz')]
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    @staticmethod
+    def key(content, language, normalization, reader, options=None):
+        """Computes the cache key of a document.
+
+        Args:
+            content (bytes or str): the content of the input.
+            language (str): the language of the document.
+            normalization (str): the word normalization method.
+            reader (str): the reader used for preprocessing, e.g. 'raw' or
+                'corenlp'.
+            options (dict): the JSON serializable arguments of the reader that
+                change the parse (e.g. encoding, max_length), defaults to
+                None.
+        """
+
+        if not isinstance(content, bytes):
+            content = content.encode('utf-8')
+
+        header = json.dumps([CACHE_FORMAT, READER_VERSION, reader, language,
+                             normalization, options or {}], sort_keys=True)
+
+        sha = hashlib.sha1(header.encode('utf-8'))
+        sha.update(b'\0')
+        sha.update(content)
+        return sha.hexdigest()
+
+    def get(self, key):
+        """Returns the cached sentences of a document, or None when the
+        document is not in the cache.
+
+        Args:
+            key (str): the cache key of the document.
+        """
+
+        path = self._path(key)
+        try:
+            with np.load(path, allow_pickle=False) as archive:
+                sentences = _deserialize(archive)
+        except (IOError, OSError, KeyError, ValueError):
+            self.misses += 1
+            return None
+
+        # mark the document as recently used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        self.hits += 1
+        return sentences
+
+    def put(self, key, sentences):
+        """Stores the sentences of a document in the cache.
+
+        Args:
+            key (str): the cache key of the document.
+            sentences (list): the Sentence objects of the document.
+        """
+
+        path = self._path(key)
+
+        # write to a temporary file first so that readers never see a
+        # partially written document
+        handle, tmp_path = tempfile.mkstemp(dir=self.cache_dir,
+                                            suffix='.tmp')
+        with os.fdopen(handle, 'wb') as f:
+            np.savez_compressed(f, **_serialize(sentences))
+
+        if os.path.exists(path):
+            self._size -= os.path.getsize(path)
+        os.replace(tmp_path, path)
+        self._size += os.path.getsize(path)
+
+        if self._size > self.max_size:
+            self._evict()
+
+    def _evict(self):
+        """Removes the least recently used documents until the cache fits in
+        its maximum size."""
+
+        # recompute the size as other processes may share the directory
+        entries = []
+        for path in self._entries():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+
+        self._size = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if self._size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._size -= size
+            self.evictions += 1
+
+    def clear(self):
+        """Removes all the documents from the cache."""
+
+        for path in self._entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self._size = 0
+
+    def stats(self):
+        """Returns the statistics of the cache.
+
+        Returns:
+            dict: the number of hits, misses, evictions, the hit rate, the
+                number of cached documents and the size of the cache in bytes.
+        """
+
+        calls = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / calls if calls else 0.0,
+                'evictions': self.evictions,
+                'documents': len(self._entries()),
+                'size': self._size,
+                'max_size': self.max_size}
+
+
+def set_default_cache(cache_dir, max_size=2 ** 30):
+    """Sets the document cache used by load_document when none is given.
+
+    Args:
+        cache_dir (str): the directory of the cache, None for disabling the
+            default cache.
+        max_size (int): the maximum size of the cache in bytes, defaults to
+            1GB.
+
+    Returns:
+        DocumentCache: the default cache.
+    """
+
+    global _default_cache
+
+    if cache_dir is None:
+        _default_cache = None
+    else:
+        _default_cache = DocumentCache(cache_dir, max_size=max_size)
+    return _default_cache
+
+
+def get_default_cache():
+    """Returns the default document cache, None if not set."""
+
+    return _default_cache
+
+
+def _serialize(sentences):
+    """Converts sentences into a dict of numpy arrays."""
+
+    # build the string table
+    strings = {}
+    words, stems, pos, offsets, lengths, meta = [], [], [], [], [], []
+    for sentence in sentences:
+        lengths.append(len(sentence.words))
+        words.extend(strings.setdefault(w, len(strings))
+                     for w in sentence.words)
+        stems.extend(strings.setdefault(w, len(strings))
+                     for w in sentence.stems)
+        pos.extend(strings.setdefault(w, len(strings))
+                   for w in sentence.pos)
+        offsets.extend(sentence.meta.get('char_offsets', []))
+        meta.append({k: v for k, v in sentence.meta.items()
+                     if k != 'char_offsets'})
+
+    table = sorted(strings, key=strings.get)
+    return {'strings': np.array(table, dtype=str),
+            'lengths': np.array(lengths, dtype=np.int32),
+            'words': np.array(words, dtype=np.int32),
+            'stems': np.array(stems, dtype=np.int32),
+            'pos': np.array(pos, dtype=np.int32),
+            'char_offsets': np.array(offsets, dtype=np.int64).reshape(-1, 2),
+            'meta': np.array(json.dumps(meta))}
+
+
+def _deserialize(archive):
+    """Rebuilds the sentences from a dict of numpy arrays."""
+
+    table = archive['strings'].tolist()
+    lengths = archive['lengths'].tolist()
+    words = archive['words'].tolist()
+    stems = archive['stems'].tolist()
+    pos = archive['pos'].tolist()
+    offsets = [tuple(u) for u in archive['char_offsets'].tolist()]
+    meta = json.loads(str(archive['meta']))
+
+    sentences = []
+    start = 0
+    for length, sentence_meta in zip(lengths, meta):
+        end = start + length
+        s = Sentence(words=[table[i] for i in words[start:end]])
+        s.stems = [table[i] for i in stems[start:end]]
+        s.pos = [table[i] for i in pos[start:end]]
+        s.meta = sentence_meta
+        if offsets:
+            s.meta['char_offsets'] = offsets[start:end]
+        sentences.append(s)
+        start = end
+
+    return sentences
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+
+"""Weighted graphs and random walk ranking for the pke module.
+
+Graphs are stored as scipy sparse matrices over integer node identifiers, the
+node labels (topic indexes, candidates) being kept aside. Rankers build the
+edge weights directly as arrays, and PageRank is computed by power iteration
+on the matrix, so that no networkx graph is built for each document. A
+networkx view of a graph can still be obtained for debugging.
+"""
+
+from __future__ import division
+
+import networkx as nx
+import numpy as np
+from scipy.sparse import coo_matrix, csr_matrix, diags
+
+
+def pagerank(W, alpha=0.85, max_iter=100, tol=1.0e-6):
+    """Computes PageRank by power iteration, following networkx.pagerank
+    (uniform teleportation, the score of dangling nodes being redistributed
+    uniformly).
+
+    Args:
+        W (matrix): the weighted adjacency matrix, sparse or dense, W[i, j]
+            being the weight of the edge from node i to node j.
+        alpha (float): the damping factor, defaults to 0.85.
+        max_iter (int): the maximum number of iterations, defaults to 100.
+        tol (float): the convergence tolerance, the iteration stops when the
+            l1 norm of the update is lower than tol times the number of nodes,
+            defaults to 1e-6.
+
+    Returns:
+        numpy array: the PageRank scores of the nodes.
+    """
+
+    N = W.shape[0]
+    if N == 0:
+        return np.zeros(0)
+
+    # row normalize the adjacency matrix
+    W = csr_matrix(W, dtype=float)
+    S = np.asarray(W.sum(axis=1)).ravel()
+    is_dangling = S == 0
+    S[~is_dangling] = 1.0 / S[~is_dangling]
+    M = diags(S).dot(W).tocsr()
+
+    # power iteration
+    p = np.repeat(1.0 / N, N)
+    x = p
+    for _ in range(max_iter):
+        x_last = x
+        x = alpha * (M.T.dot(x) + x[is_dangling].sum() * p) + (1 - alpha) * p
+        if np.absolute(x - x_last).sum() < N * tol:
+            return x
+    raise nx.PowerIterationFailedConvergence(max_iter)
+
+
+class Graph(object):
+    """Weighted graph stored as a sparse adjacency matrix.
+
+    Undirected graphs are stored as symmetric matrices. Edges are kept even
+    when their weight is null, as in networkx graphs.
+    """
+
+    def __init__(self, nodes=None, directed=False):
+        """Initializer for Graph class.
+
+        Args:
+            nodes (list): the node labels, node i being labelled nodes[i],
+                defaults to an empty graph.
+            directed (bool): whether the graph is directed, defaults to False.
+        """
+
+        self.nodes = list(nodes) if nodes is not None else []
+        """The node labels."""
+
+        self.index = {node: i for i, node in enumerate(self.nodes)}
+        """The identifier of each node label."""
+
+        self.directed = directed
+        """Whether the graph is directed."""
+
+        n = len(self.nodes)
+        self.matrix = csr_matrix((n, n))
+        """The weighted adjacency matrix (scipy CSR matrix)."""
+
+    @classmethod
+    def from_edges(cls, nodes, rows, cols, weights, directed=False):
+        """Builds a graph from arrays of edges, the weights of duplicated edges
+        being summed.
+
+        Args:
+            nodes (list): the node labels.
+            rows (array): the source node identifiers.
+            cols (array): the target node identifiers.
+            weights (array): the edge weights.
+            directed (bool): whether the graph is directed, if not each edge
+                is added in both directions, defaults to False.
+        """
+
+        graph = cls(nodes, directed=directed)
+
+        rows = np.asarray(rows, dtype=int)
+        cols = np.asarray(cols, dtype=int)
+        weights = np.asarray(weights, dtype=float)
+        if not directed:
+            loops = rows == cols
+            rows, cols = (np.concatenate([rows, cols[~loops]]),
+                          np.concatenate([cols, rows[~loops]]))
+            weights = np.concatenate([weights, weights[~loops]])
+
+        n = len(graph.nodes)
+        graph.matrix = coo_matrix((weights, (rows, cols)),
+                                  shape=(n, n)).tocsr()
+        return graph
+
+    @classmethod
+    def from_dense(cls, W, nodes=None, mask=None, directed=False):
+        """Builds a graph from a dense weight matrix.
+
+        Args:
+            W (numpy array): the weight matrix, symmetric if the graph is
+                undirected.
+            nodes (list): the node labels, defaults to the row indexes.
+            mask (numpy array): the boolean matrix of the edges, defaults to
+                the non null weights.
+            directed (bool): whether the graph is directed, defaults to False.
+        """
+
+        if nodes is None:
+            nodes = range(W.shape[0])
+        if mask is None:
+            mask = W != 0
+        if not directed:
+            mask = np.triu(mask)
+        rows, cols = np.nonzero(mask)
+        return cls.from_edges(nodes, rows, cols, W[rows, cols],
+                              directed=directed)
+
+    def add_weights(self, rows, cols, weights):
+        """Adds weights to edges, creating them if needed.
+
+        Args:
+            rows (array): the source node identifiers.
+            cols (array): the target node identifiers.
+            weights (array): the weights to add.
+        """
+
+        n = len(self.nodes)
+        update = Graph.from_edges(range(n), rows, cols, weights,
+                                  directed=self.directed)
+        self.matrix = (self.matrix + update.matrix).tocsr()
+
+    def number_of_nodes(self):
+        """Returns the number of nodes."""
+
+        return len(self.nodes)
+
+    def number_of_edges(self):
+        """Returns the number of edges, self-loops included."""
+
+        if self.directed:
+            return self.matrix.nnz
+        return (self.matrix.nnz + self.matrix.diagonal().astype(bool).sum()) \
+            // 2
+
+    def pagerank(self, alpha=0.85, max_iter=100, tol=1.0e-6):
+        """Computes the PageRank scores of the nodes, see pagerank.
+
+        Returns:
+            dict: the score of each node label.
+        """
+
+        scores = pagerank(self.matrix, alpha=alpha, max_iter=max_iter,
+                          tol=tol)
+        return dict(zip(self.nodes, scores.tolist()))
+
+    def to_networkx(self):
+        """Returns a networkx view of the graph, edges having a 'weight'
+        attribute."""
+
+        graph = nx.DiGraph() if self.directed else nx.Graph()
+        graph.add_nodes_from(self.nodes)
+
+        coo = self.matrix.tocoo()
+        for i, j, weight in zip(coo.row, coo.col, coo.data):
+            if self.directed or i <= j:
+                graph.add_edge(self.nodes[i], self.nodes[j],
+                               weight=float(weight))
+        return graph
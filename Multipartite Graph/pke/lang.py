@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+"""Language resources and cached word normalization for the pke module.
+
+Word frequencies are heavily skewed, so most stemming calls on a corpus
+repeat earlier work. The stemmers and the stems are shared by every document
+of the process, stems being kept in a bounded LRU cache keyed by
+(language, word).
+"""
+
+from __future__ import division
+
+from functools import lru_cache
+
+from nltk.stem.snowball import SnowballStemmer
+
+ISO_to_language = {'en': 'english', 'pt': 'portuguese', 'fr': 'french',
+                   'es': 'spanish', 'it': 'italian', 'nl': 'dutch',
+                   'de': 'german'}
+
+DEFAULT_CACHE_SIZE = 2 ** 18
+"""Default maximum number of (language, word) entries in the stem cache."""
+
+_stemmers = {}
+
+
+def get_stemmer(language='en'):
+    """Returns the (shared) stemmer of a language, a porter stemmer for english
+    and a snowball stemmer ignoring stopwords otherwise.
+
+    Args:
+        language (str): ISO 639 code of the language, defaults to 'en'.
+    """
+
+    if language not in _stemmers:
+        if language == 'en':
+            _stemmers[language] = SnowballStemmer("porter")
+        else:
+            _stemmers[language] = SnowballStemmer(ISO_to_language[language],
+                                                  ignore_stopwords=True)
+    return _stemmers[language]
+
+
+def _stem(language, word):
+    return get_stemmer(language).stem(word)
+
+
+_cached_stem = lru_cache(maxsize=DEFAULT_CACHE_SIZE)(_stem)
+
+
+def stem(word, language='en'):
+    """Returns the stem of a word, computed once per (language, word).
+
+    Args:
+        word (str): the word to stem.
+        language (str): ISO 639 code of the language, defaults to 'en'.
+    """
+
+    return _cached_stem(language, word)
+
+
+def stem_words(words, language='en'):
+    """Returns the list of stems of a list of words.
+
+    Args:
+        words (list): the words to stem.
+        language (str): ISO 639 code of the language, defaults to 'en'.
+    """
+
+    return [_cached_stem(language, w) for w in words]
+
+
+def set_cache_size(maxsize=DEFAULT_CACHE_SIZE):
+    """Resize the stem cache, its content is dropped.
+
+    Args:
+        maxsize (int): the maximum number of entries of the cache, None for
+            an unbounded cache, defaults to DEFAULT_CACHE_SIZE.
+    """
+
+    global _cached_stem
+
+    _cached_stem = lru_cache(maxsize=maxsize)(_stem)
+
+
+def clear_cache():
+    """Empty the stem cache and reset its statistics."""
+
+    _cached_stem.cache_clear()
+
+
+def cache_info():
+    """Returns the statistics of the stem cache.
+
+    Returns:
+        dict: for 'stem', a dict with the number of hits, misses, the hit
+            rate, the current size and the maximum size.
+    """
+
+    stats = _cached_stem.cache_info()
+    calls = stats.hits + stats.misses
+    return {'stem': {'hits': stats.hits,
+                     'misses': stats.misses,
+                     'hit_rate': stats.hits / calls if calls else 0.0,
+                     'size': stats.currsize,
+                     'maxsize': stats.maxsize}}
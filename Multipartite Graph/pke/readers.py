@@ -3,11 +3,18 @@
 
 """Readers for the pke module."""
 
+import io
+import gzip
+import json
 import xml.etree.ElementTree as etree
 import spacy
 
 from pke.data_structures import Document
 
+READER_VERSION = '1-spacy-{}'.format(spacy.__version__)
+"""Version of the readers output, to be increased whenever preprocessing
+changes so that cached documents are invalidated."""
+
 
 class Reader(object):
     def read(self, path):
@@ -90,3 +97,82 @@ class RawTextReader(Reader):
 
         return doc
 
+
+class JsonlCorpusReader(object):
+    """Streaming reader for corpora stored as JSON lines, one document per
+    line, optionally gzip compressed (.gz extension). The default fields match
+    the StackOverflow files (stackof_test.json, stackof_valid.json)::
+
+        {"Title": "...", "Body": "...", "Tag": "c#;.net"}
+
+    Iterating over the reader yields (doc_id, text, references) tuples, the
+    file being read again at each iteration.
+    """
+
+    def __init__(self,
+                 path,
+                 text_fields=('Title', 'Body'),
+                 id_field=None,
+                 reference_field='Tag',
+                 reference_separator=';',
+                 text_separator='\n',
+                 encoding='utf-8'):
+        """Constructor for JsonlCorpusReader.
+
+        Args:
+            path (str): path to the corpus file.
+            text_fields (list): the fields concatenated as the text of the
+                documents, defaults to ('Title', 'Body').
+            id_field (str): the field holding the document ids, defaults to
+                None for using the line numbers (from 0).
+            reference_field (str): the field holding the reference
+                keyphrases, either a list or a string, defaults to 'Tag'. None
+                means no references.
+            reference_separator (str): the separator of the reference
+                keyphrases in a string field, defaults to ';'.
+            text_separator (str): the separator inserted between text fields,
+                defaults to a newline.
+            encoding (str): encoding of the corpus file, defaults to utf-8.
+        """
+
+        self.path = path
+        self.text_fields = text_fields
+        self.id_field = id_field
+        self.reference_field = reference_field
+        self.reference_separator = reference_separator
+        self.text_separator = text_separator
+        self.encoding = encoding
+
+    def _open(self):
+        if self.path.endswith('.gz'):
+            return io.TextIOWrapper(gzip.open(self.path, 'rb'),
+                                    encoding=self.encoding)
+        return io.open(self.path, 'r', encoding=self.encoding)
+
+    def __iter__(self):
+        with self._open() as f:
+            for line_number, line in enumerate(f):
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+
+                # get the document id
+                if self.id_field is None:
+                    doc_id = str(line_number)
+                else:
+                    doc_id = str(record[self.id_field])
+
+                # concatenate the text fields
+                text = self.text_separator.join(
+                    record[field] for field in self.text_fields
+                    if record.get(field))
+
+                # get the reference keyphrases
+                references = []
+                if self.reference_field is not None:
+                    references = record.get(self.reference_field) or []
+                    if not isinstance(references, list):
+                        references = [r for r in references.split(
+                            self.reference_separator) if r]
+
+                yield doc_id, text, references
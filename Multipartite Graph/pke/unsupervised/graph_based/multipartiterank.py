@@ -17,13 +17,14 @@ from __future__ import division
 from __future__ import print_function
 
 import math
-from itertools import combinations
+from itertools import product
 
-import networkx as nx
 import numpy as np
 from scipy.cluster.hierarchy import linkage, fcluster
 from scipy.spatial.distance import pdist
 
+from pke.base import stage
+from pke.graph import Graph, pagerank
 from pke.unsupervised import TopicRank
 
 
@@ -71,12 +72,14 @@ class MultipartiteRank(TopicRank):
         self.topic_identifiers = {}
         """ A container for linking candidates to topic identifiers. """
 
-        self.graph = nx.DiGraph()
+        self.graph = Graph(directed=True)
         """ Redefine the graph as a directed graph. """
 
+    @stage('topic_clustering')
     def topic_clustering(self,
                          threshold=0.74,
-                         method='average'):
+                         method='average',
+                         backend='hac'):
         """ Clustering candidates into topics.
 
             Args:
@@ -84,6 +87,8 @@ class MultipartiteRank(TopicRank):
                     defaults to 0.74, i.e. more than 1/4 of stem overlap
                     similarity. 
                 method (str): the linkage method, defaults to average.
+                backend (str): the clustering backend, 'hac' or 'bucketed',
+                    defaults to 'hac', see TopicRank.topic_clustering.
         """
 
         # handle document with only one candidate
@@ -93,18 +98,10 @@ class MultipartiteRank(TopicRank):
             self.topic_identifiers[candidate] = 0
             return
 
-        # vectorize the candidates
-        candidates, X = self.vectorize_candidates()
-
-        # compute the distance matrix
-        Y = pdist(X, 'jaccard')
-        Y = np.nan_to_num(Y) + 0.01
-
         # compute the clusters
-        Z = linkage(Y, method=method)
-
-        # form flat clusters
-        clusters = fcluster(Z, t=threshold, criterion='distance')
+        candidates, clusters = self._cluster_candidates(threshold, method,
+                                                        backend,
+                                                        distance_offset=0.01)
 
         # for each cluster id
         for cluster_id in range(1, max(clusters) + 1):
@@ -115,42 +112,22 @@ class MultipartiteRank(TopicRank):
         for i, cluster_id in enumerate(clusters):
             self.topic_identifiers[candidates[i]] = cluster_id - 1
 
+    @stage('build_topic_graph')
     def build_topic_graph(self):
         """ Build the Multipartite graph. """
 
-        # adding the nodes to the graph
-        self.graph.add_nodes_from(self.candidates.keys())
-
-        # pre-compute edge weights
-        for node_i, node_j in combinations(self.candidates.keys(), 2):
-
-            # discard intra-topic edges
-            if self.topic_identifiers[node_i] == self.topic_identifiers[node_j]:
-                continue
-
-            weights = []
-            for p_i in self.candidates[node_i].offsets:
-                for p_j in self.candidates[node_j].offsets:
-
-                    # compute gap
-                    gap = abs(p_i - p_j)
-
-                    # alter gap according to candidate length
-                    if p_i < p_j:
-                        gap -= len(self.candidates[node_i].lexical_form) - 1
-                    if p_j < p_i:
-                        gap -= len(self.candidates[node_j].lexical_form) - 1
+        candidates = list(self.candidates)
+        rows, cols, weights = self._gap_edges(candidates)
 
-                    if gap != 0:
-                        weights.append(1.0 / gap)
+        # discard intra-topic edges
+        topics = np.array([self.topic_identifiers[c] for c in candidates])
+        inter_topic = topics[rows] != topics[cols]
 
-            # add weighted edges 
-            if weights:
-                # node_i -> node_j
-                self.graph.add_edge(node_i, node_j, weight=sum(weights))
-                # node_j -> node_i
-                self.graph.add_edge(node_j, node_i, weight=sum(weights))
+        self.graph = Graph.from_edges(candidates, rows[inter_topic],
+                                      cols[inter_topic], weights[inter_topic],
+                                      directed=True)
 
+    @stage('weight_adjustment')
     def weight_adjustment(self, alpha=1.1):
         """ Adjust edge weights for boosting some candidates.
 
@@ -159,11 +136,9 @@ class MultipartiteRank(TopicRank):
                     weight adjustment, defaults to 1.1.
         """
 
-        # weighted_edges = defaultdict(list)
-        weighted_edges = {}
-
-        # find the sum of all first positions
-        norm = sum([s.length for s in self.sentences])
+        W = self.graph.matrix
+        index = self.graph.index
+        rows, cols, weights = [], [], []
 
         # Topical boosting
         for variants in self.topics:
@@ -177,31 +152,30 @@ class MultipartiteRank(TopicRank):
 
             # get the first occurring variant
             first = variants[offsets.index(min(offsets))]
+            i = index[first]
 
-            # find the nodes to which it connects -- Python 2/3 compatible
-            # for start, end in self.graph.edges_iter(first):
-            for start, end in self.graph.edges(first):
+            # sum the weights of the other variants on the nodes to which the
+            # first variant connects
+            others = [index[v] for v in variants if v != first]
+            ends = W[i].indices
+            boosters = np.asarray(W[others].sum(axis=0)).ravel()[ends]
 
-                boosters = []
-                for v in variants:
-                    if v != first and self.graph.has_edge(v, end):
-                        boosters.append(self.graph[v][end]['weight'])
+            position = math.exp(1.0 / (1 + self.candidates[first].offsets[0]))
 
-                if boosters:
-                    weighted_edges[(start, end)] = np.sum(boosters)
+            # boost the edges from these nodes to the first variant
+            rows.extend(ends)
+            cols.extend([i] * len(ends))
+            weights.extend(boosters * alpha * position)
 
-        # update edge weights -- Python 2/3 compatible
-        # for nodes, boosters in weighted_edges.iteritems():
-        for nodes, boosters in weighted_edges.items():
-            node_i, node_j = nodes
-            position_i = 1.0 / (1 + self.candidates[node_i].offsets[0])
-            position_i = math.exp(position_i)
-            self.graph[node_j][node_i]['weight'] += (boosters * alpha * position_i)
+        # update edge weights
+        self.graph.add_weights(rows, cols, weights)
 
+    @stage('candidate_weighting')
     def candidate_weighting(self,
                             threshold=0.74,
                             method='average',
-                            alpha=1.1):
+                            alpha=1.1,
+                            backend='hac'):
         """ Candidate weight calculation using random walk.
 
             Args:
@@ -210,10 +184,13 @@ class MultipartiteRank(TopicRank):
                 method (str): the linkage method, defaults to average.
                 alpha (float): hyper-parameter that controls the strength of the
                     weight adjustment, defaults to 1.1.
+                backend (str): the clustering backend, 'hac' or 'bucketed',
+                    defaults to 'hac'.
         """
 
         # cluster the candidates
-        self.topic_clustering(threshold=threshold, method=method)
+        self.topic_clustering(threshold=threshold, method=method,
+                              backend=backend)
 
         # build the topic graph
         self.build_topic_graph()
@@ -222,4 +199,88 @@ class MultipartiteRank(TopicRank):
             self.weight_adjustment(alpha)
 
         # compute the word scores using random walk
-        self.weights = nx.pagerank_scipy(self.graph)
+        self.weights = self._random_walk()
+
+    def candidate_weighting_sweep(self,
+                                  thresholds=(0.74,),
+                                  methods=('average',),
+                                  alphas=(1.1,)):
+        """ Candidate weights for a grid of clustering and weight adjustment
+            parameters.
+
+            The linkage is computed once per method and the inter-candidate
+            gaps once per document, each threshold then only requires forming
+            flat clusters and each alpha scaling the cached weight
+            adjustment. The document state (topics, graph and weights) is left
+            untouched.
+
+            Args:
+                thresholds (list): the clustering thresholds, defaults to
+                    (0.74,).
+                methods (list): the linkage methods, defaults to ('average',).
+                alphas (list): the weight adjustment strengths, defaults to
+                    (1.1,).
+
+            Returns:
+                dict: the candidate weights, as returned by candidate_weighting,
+                    for each (threshold, method, alpha) tuple.
+        """
+
+        candidates = sorted(self.candidates)
+        n = len(candidates)
+        results = {}
+
+        # handle documents with less than two candidates
+        if n < 2:
+            for params in product(thresholds, methods, alphas):
+                results[params] = {k: 1.0 for k in candidates}
+            return results
+
+        # compute the distance matrix
+        candidates, X = self.vectorize_candidates(candidates)
+        Y = np.nan_to_num(pdist(X, 'jaccard')) + 0.01
+
+        # compute the topic independent edge weights
+        G, E = self._gap_matrix(candidates)
+
+        # compute the position boost of each candidate
+        first_offsets = np.array([self.candidates[k].offsets[0]
+                                  for k in candidates])
+        position = np.exp(1.0 / (1 + first_offsets))
+
+        for method in methods:
+
+            # compute the clusters
+            Z = linkage(Y, method=method)
+
+            for threshold in thresholds:
+
+                # form flat clusters
+                clusters = fcluster(Z, t=threshold, criterion='distance')
+
+                # discard intra-topic edges
+                inter_topic = clusters[:, np.newaxis] != clusters
+                W = G * inter_topic
+                edges = E & inter_topic
+
+                # topical boosting, the first occurring variant of each topic
+                # receives the weights of the other variants on its edges
+                A = np.zeros((n, n))
+                for cluster_id in range(1, max(clusters) + 1):
+                    variants = np.flatnonzero(clusters == cluster_id)
+                    if len(variants) == 1:
+                        continue
+                    first = variants[np.argmin(first_offsets[variants])]
+                    others = variants[variants != first]
+                    boosters = W[others].sum(axis=0) * edges[first]
+                    A[:, first] += boosters * position[first]
+
+                for alpha in alphas:
+                    if alpha > 0.0:
+                        scores = pagerank(W + alpha * A)
+                    else:
+                        scores = pagerank(W)
+                    results[(threshold, method, alpha)] = dict(
+                        zip(candidates, scores))
+
+        return results
@@ -17,14 +17,13 @@ from __future__ import division
 from __future__ import print_function
 
 import string
-from itertools import combinations
 
-import networkx as nx
 import numpy as np
 from scipy.cluster.hierarchy import linkage, fcluster
 from scipy.spatial.distance import pdist
 
-from pke.base import LoadFile
+from pke.base import LoadFile, stage
+from pke.graph import Graph
 
 
 class TopicRank(LoadFile):
@@ -66,12 +65,13 @@ class TopicRank(LoadFile):
 
         super(TopicRank, self).__init__()
 
-        self.graph = nx.Graph()
-        """ The topic graph. """
+        self.graph = Graph()
+        """ The topic graph, see Graph.to_networkx for a networkx view. """
 
         self.topics = []
         """ The topic container. """
 
+    @stage('candidate_selection')
     def candidate_selection(self, pos=None, stoplist=None):
         """Selects longest sequences of nouns and adjectives as keyphrase
         candidates.
@@ -101,42 +101,186 @@ class TopicRank(LoadFile):
                                           ['-lrb-', '-rrb-', '-lcb-', '-rcb-', '-lsb-', '-rsb-'] +
                                           stoplist)
 
-    def vectorize_candidates(self):
+    def vectorize_candidates(self, candidates=None):
         """Vectorize the keyphrase candidates.
 
+        Args:
+            candidates (list): the candidates to vectorize, defaults to all the
+                candidates of the document.
+
         Returns:
             C (list): the list of candidates.
             X (matrix): vectorized representation of the candidates.
 
         """
 
-        # build the vocabulary, i.e. setting the vector dimensions
-        dim = set([])
-        # for k, v in self.candidates.iteritems():
-        # iterate Python 2/3 compatible
-        for (k, v) in self.candidates.items():
-            for w in v.lexical_form:
-                dim.add(w)
-        dim = list(dim)
-
         # vectorize the candidates Python 2/3 + sort for random issues
-        C = list(self.candidates)  # .keys()
-        C.sort()
+        if candidates is None:
+            C = list(self.candidates)  # .keys()
+            C.sort()
+        else:
+            C = list(candidates)
+
+        # build the vocabulary, i.e. setting the vector dimensions
+        dim = {}
+        for k in C:
+            for w in self.candidates[k].lexical_form:
+                dim.setdefault(w, len(dim))
 
         X = np.zeros((len(C), len(dim)))
         for i, k in enumerate(C):
             for w in self.candidates[k].lexical_form:
-                X[i, dim.index(w)] += 1
+                X[i, dim[w]] += 1
 
         return C, X
 
-    def topic_clustering(self, threshold=0.74, method='average'):
+    def _linkage_clusters(self, candidates, threshold, method,
+                          distance_offset=0.0):
+        """Runs the hierarchical agglomerative clustering of candidates.
+
+        Args:
+            candidates (list): the candidates to cluster.
+            threshold (float): the distance threshold for flat clusters.
+            method (str): the linkage method.
+            distance_offset (float): a constant added to the jaccard distances,
+                which are then made finite, defaults to 0.0 (no change).
+
+        Returns:
+            numpy array: the cluster identifiers (from 1) of the candidates.
+        """
+
+        # vectorize the candidates
+        candidates, X = self.vectorize_candidates(candidates)
+
+        # compute the distance matrix
+        Y = pdist(X, 'jaccard')
+        if distance_offset:
+            Y = np.nan_to_num(Y) + distance_offset
+
+        # compute the clusters
+        Z = linkage(Y, method=method)
+
+        # form flat clusters
+        return fcluster(Z, t=threshold, criterion='distance')
+
+    def _bucketed_clusters(self, candidates, threshold, method,
+                           distance_offset=0.0):
+        """Clusters candidates by running the hierarchical agglomerative
+        clustering separately within each group of candidates connected by
+        shared stems.
+
+        Candidates from different groups share no stem, their distance is
+        maximal (1 + distance_offset) and so is any linkage distance between
+        two groups for the single, complete, average and weighted methods. For
+        a threshold below that distance, the flat clusters are thus the same
+        as those of the full clustering while the memory only depends on the
+        size of the largest group.
+
+        Args:
+            candidates (list): the candidates to cluster.
+            threshold (float): the distance threshold for flat clusters.
+            method (str): the linkage method.
+            distance_offset (float): a constant added to the jaccard distances,
+                defaults to 0.0.
+
+        Returns:
+            numpy array: the cluster identifiers (from 1) of the candidates.
+        """
+
+        if method not in {'single', 'complete', 'average', 'weighted'}:
+            raise ValueError('bucketed clustering does not support the '
+                             '{} linkage method'.format(method))
+
+        # groups may merge above the maximal distance, use full clustering
+        if threshold >= 1.0 + distance_offset:
+            return self._linkage_clusters(candidates, threshold, method,
+                                          distance_offset)
+
+        # union-find structure over the candidate indexes
+        parents = list(range(len(candidates)))
+
+        def find(i):
+            while parents[i] != i:
+                parents[i] = parents[parents[i]]
+                i = parents[i]
+            return i
+
+        # connect the candidates sharing a stem using an inverted index
+        first_occurrence = {}
+        for i, k in enumerate(candidates):
+            for w in self.candidates[k].lexical_form:
+                j = first_occurrence.setdefault(w, i)
+                root_i, root_j = find(i), find(j)
+                if root_i != root_j:
+                    parents[max(root_i, root_j)] = min(root_i, root_j)
+
+        # gather the groups, ordered by their first candidate
+        groups = {}
+        for i in range(len(candidates)):
+            groups.setdefault(find(i), []).append(i)
+
+        # cluster each group independently
+        clusters = np.zeros(len(candidates), dtype=int)
+        n_clusters = 0
+        for group in groups.values():
+            if len(group) == 1:
+                n_clusters += 1
+                clusters[group[0]] = n_clusters
+                continue
+            group_clusters = self._linkage_clusters(
+                [candidates[i] for i in group], threshold, method,
+                distance_offset)
+            clusters[group] = group_clusters + n_clusters
+            n_clusters += group_clusters.max()
+
+        return clusters
+
+    def _cluster_candidates(self, threshold, method, backend,
+                            distance_offset=0.0):
+        """Clusters the candidates of the document with the given backend.
+
+        Args:
+            threshold (float): the distance threshold for flat clusters.
+            method (str): the linkage method.
+            backend (str): 'hac' for hierarchical agglomerative clustering over
+                all the candidates, 'bucketed' for running it within groups of
+                candidates sharing stems.
+            distance_offset (float): a constant added to the jaccard distances,
+                defaults to 0.0.
+
+        Returns:
+            candidates (list): the sorted list of candidates.
+            clusters (numpy array): the cluster identifiers (from 1) of the
+                candidates.
+        """
+
+        candidates = sorted(self.candidates)
+
+        if backend == 'hac':
+            clusters = self._linkage_clusters(candidates, threshold, method,
+                                              distance_offset)
+        elif backend == 'bucketed':
+            clusters = self._bucketed_clusters(candidates, threshold, method,
+                                               distance_offset)
+        else:
+            raise ValueError('unknown clustering backend: {}'.format(backend))
+
+        return candidates, clusters
+
+    @stage('topic_clustering')
+    def topic_clustering(self, threshold=0.74, method='average',
+                         backend='hac'):
         """Clustering candidates into topics.
 
         Args:
             threshold (float): the minimum similarity for clustering, defaults
                 to 0.74, i.e. more than 1/4 of stem overlap similarity.
             method (str): the linkage method, defaults to average.
+            backend (str): the clustering backend, defaults to 'hac' which
+                clusters all the candidates at once. 'bucketed' clusters
+                separately the groups of candidates sharing stems, giving the
+                same topics (possibly in a different order) with a memory
+                bounded by the largest group, see _bucketed_clusters.
 
         """
 
@@ -145,47 +289,161 @@ class TopicRank(LoadFile):
             self.topics.append([list(self.candidates)[0]])
             return
 
-        # vectorize the candidates
-        candidates, X = self.vectorize_candidates()
-
-        # compute the distance matrix
-        Y = pdist(X, 'jaccard')
-
         # compute the clusters
-        Z = linkage(Y, method=method)
-
-        # form flat clusters
-        clusters = fcluster(Z, t=threshold, criterion='distance')
+        candidates, clusters = self._cluster_candidates(threshold, method,
+                                                        backend)
 
         # for each topic identifier
         for cluster_id in range(1, max(clusters) + 1):
             self.topics.append([candidates[j] for j in range(len(clusters))
                                 if clusters[j] == cluster_id])
 
+    def _occurrences(self, candidates):
+        """Flattens the occurrences of candidates.
+
+        Args:
+            candidates (list): the candidates.
+
+        Returns:
+            tuple: the index in candidates, the position and the length of
+                each occurrence (numpy arrays).
+        """
+
+        owners, positions, lengths = [], [], []
+        for i, k in enumerate(candidates):
+            for p in self.candidates[k].offsets:
+                owners.append(i)
+                positions.append(p)
+                lengths.append(len(self.candidates[k].lexical_form))
+        return (np.array(owners, dtype=int), np.array(positions, dtype=int),
+                np.array(lengths, dtype=int))
+
+    def _inverse_gaps(self, candidate, positions, lengths):
+        """Computes the inverse gaps between the occurrences of a candidate
+        and a list of occurrences, null gaps being ignored.
+
+        Args:
+            candidate (str): the candidate.
+            positions (numpy array): the positions of the occurrences.
+            lengths (numpy array): the lengths of the occurrences.
+
+        Returns:
+            tuple: for each occurrence, the sum of its inverse gaps with the
+                occurrences of the candidate and its number of non null gaps.
+        """
+
+        p_i = np.array(self.candidates[candidate].offsets)[:, np.newaxis]
+        length_i = len(self.candidates[candidate].lexical_form)
+
+        # compute gaps altered according to candidate lengths
+        gaps = np.absolute(p_i - positions)
+        gaps = gaps - np.where(p_i < positions, length_i - 1, 0)
+        gaps = gaps - np.where(positions < p_i, lengths - 1, 0)
+
+        non_null = gaps != 0
+        inverse = np.zeros(gaps.shape)
+        inverse[non_null] = 1.0 / gaps[non_null]
+
+        return inverse.sum(axis=0), non_null.sum(axis=0)
+
+    def _gap_edges(self, candidates):
+        """Computes the topic independent edges between candidates, i.e. the
+        pairs of candidates with a non null gap, weighted by the sum of their
+        inverse gaps. Only the edges are kept, not a dense matrix.
+
+        Args:
+            candidates (list): the candidates, giving the node identifiers.
+
+        Returns:
+            tuple: the rows, columns and weights of the edges (numpy arrays),
+                both directions of an edge being given.
+        """
+
+        owners, positions, lengths = self._occurrences(candidates)
+
+        n = len(candidates)
+        rows, cols, weights = [np.zeros(0, dtype=int)], \
+            [np.zeros(0, dtype=int)], [np.zeros(0)]
+        for i, k in enumerate(candidates):
+            inverse, non_null = self._inverse_gaps(k, positions, lengths)
+
+            # sum the inverse gaps by candidate
+            connected = np.bincount(owners, weights=non_null, minlength=n) > 0
+            connected[i] = False
+            ends = np.flatnonzero(connected)
+            rows.append(np.full(len(ends), i, dtype=int))
+            cols.append(ends)
+            weights.append(np.bincount(owners, weights=inverse,
+                                       minlength=n)[ends])
+
+        return np.concatenate(rows), np.concatenate(cols), \
+            np.concatenate(weights)
+
+    def _gap_matrix(self, candidates):
+        """Computes the topic independent edge weights between candidates as
+        dense matrices, see _gap_edges.
+
+        Args:
+            candidates (list): the candidates, giving the matrix order.
+
+        Returns:
+            G (numpy array): the summed inverse gaps between candidates.
+            E (numpy array): whether two candidates have a non null gap, i.e.
+                would be connected in the graph if in different topics.
+        """
+
+        n = len(candidates)
+        rows, cols, weights = self._gap_edges(candidates)
+        G = np.zeros((n, n))
+        E = np.zeros((n, n), dtype=bool)
+        G[rows, cols] = weights
+        E[rows, cols] = True
+
+        return G, E
+
+    @stage('build_topic_graph')
     def build_topic_graph(self):
         """Build topic graph."""
 
-        # adding the nodes to the graph
-        self.graph.add_nodes_from(range(len(self.topics)))
-
-        # loop through the topics to connect the nodes
-        for i, j in combinations(range(len(self.topics)), 2):
-            self.graph.add_edge(i, j, weight=0.0)
-            for c_i in self.topics[i]:
-                for c_j in self.topics[j]:
-                    for p_i in self.candidates[c_i].offsets:
-                        for p_j in self.candidates[c_j].offsets:
-                            gap = abs(p_i - p_j)
-                            if p_i < p_j:
-                                gap -= len(self.candidates[c_i].lexical_form) - 1
-                            if p_j < p_i:
-                                gap -= len(self.candidates[c_j].lexical_form) - 1
-                            self.graph[i][j]['weight'] += 1.0 / gap
-
+        # sum the inverse gaps between the occurrences by pair of topics, one
+        # topic at a time so that no candidate or topic matrix is built
+        candidates = [c for topic in self.topics for c in topic]
+        owners, positions, lengths = self._occurrences(candidates)
+        topic_ids = np.array([i for i, topic in enumerate(self.topics)
+                              for _ in topic], dtype=int)[owners]
+
+        n_topics = len(self.topics)
+        rows, cols, weights = [np.zeros(0, dtype=int)], \
+            [np.zeros(0, dtype=int)], [np.zeros(0)]
+        for t, topic in enumerate(self.topics[:-1]):
+            inverse = np.zeros(len(positions))
+            for k in topic:
+                inverse += self._inverse_gaps(k, positions, lengths)[0]
+
+            # connect the topic to all the following ones
+            ends = np.arange(t + 1, n_topics)
+            rows.append(np.full(len(ends), t, dtype=int))
+            cols.append(ends)
+            weights.append(np.bincount(topic_ids, weights=inverse,
+                                       minlength=n_topics)[ends])
+
+        self.graph = Graph.from_edges(range(n_topics),
+                                      np.concatenate(rows),
+                                      np.concatenate(cols),
+                                      np.concatenate(weights))
+
+    @stage('pagerank')
+    def _random_walk(self):
+        """Computes the PageRank scores of the graph nodes."""
+
+        return self.graph.pagerank(alpha=0.85)
+
+    @stage('candidate_weighting')
     def candidate_weighting(self,
                             threshold=0.74,
                             method='average',
-                            heuristic=None):
+                            heuristic=None,
+                            backend='hac'):
         """Candidate ranking using random walk.
 
         Args:
@@ -196,17 +454,20 @@ class TopicRank(LoadFile):
                 each topic, defaults to first occurring candidate. Other options
                 are 'frequent' (most frequent candidate, position is used for
                 ties).
+            backend (str): the clustering backend, 'hac' or 'bucketed',
+                defaults to 'hac'.
 
         """
 
         # cluster the candidates
-        self.topic_clustering(threshold=threshold, method=method)
+        self.topic_clustering(threshold=threshold, method=method,
+                              backend=backend)
 
         # build the topic graph
         self.build_topic_graph()
 
         # compute the word scores using random walk
-        w = nx.pagerank_scipy(self.graph, alpha=0.85, weight='weight')
+        w = self._random_walk()
 
         # loop through the topics
         for i, topic in enumerate(self.topics):
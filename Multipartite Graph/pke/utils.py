@@ -14,18 +14,26 @@ import glob
 import pickle
 import gzip
 import json
+import hashlib
 import codecs
+import struct
 import logging
+import zipfile
 
 from collections import defaultdict
+from multiprocessing import Pool
+
+import numpy as np
+from scipy.sparse import csr_matrix, diags
 
 from pke.base import LoadFile
 from pke.base import ISO_to_language
+from pke.readers import JsonlCorpusReader
+from pke.lang import stem_words
 
 from sklearn.feature_extraction.text import CountVectorizer
 from sklearn.decomposition import LatentDirichletAllocation
 
-from nltk.stem.snowball import SnowballStemmer
 from nltk.corpus import stopwords
 
 
@@ -62,6 +70,25 @@ def load_document_frequency_file(input_file,
     return frequencies
 
 
+def _iter_documents(input_dir, extension):
+    """Yields the (doc_id, input) pairs of a collection of documents, the input
+    being either a file of the input directory, the doc_id being its name
+    without extension, or the text of a document from a JSON lines corpus.
+
+    Args:
+        input_dir (str or JsonlCorpusReader): the input directory or corpus.
+        extension (str): file extension for input documents.
+    """
+
+    if isinstance(input_dir, JsonlCorpusReader):
+        for doc_id, text, _ in input_dir:
+            yield doc_id, text
+    else:
+        for input_file in glob.iglob(input_dir + '/*.' + extension):
+            yield '.'.join(input_file.split('/')[-1].split('.')[0:-1]), \
+                input_file
+
+
 def compute_document_frequency(input_dir,
                                output_file,
                                extension='xml',
@@ -76,7 +103,8 @@ def compute_document_frequency(input_dir,
     (--NB_DOC-- tab XXX). The output file is compressed using gzip.
 
     Args:
-        input_dir (str): the input directory.
+        input_dir (str or JsonlCorpusReader): the input directory, or a
+            JSON lines corpus.
         output_file (str): the output file.
         extension (str): file extension for input documents, defaults to xml.
         language (str): language of the input documents (used for computing the
@@ -97,7 +125,7 @@ def compute_document_frequency(input_dir,
     nb_documents = 0
 
     # loop through the documents
-    for input_file in glob.iglob(input_dir + '/*.' + extension):
+    for _, input_file in _iter_documents(input_dir, extension):
 
         #logging.info('reading file {}'.format(input_file))
 
@@ -143,6 +171,148 @@ def compute_document_frequency(input_dir,
             f.write(line.encode('utf-8') + b'\n')
 
 
+_training_worker = {}
+"""State shared by the workers of train_supervised_model."""
+
+
+def _init_training_worker(state):
+    """Initialize the state of a train_supervised_model worker."""
+
+    _training_worker.clear()
+    _training_worker.update(state)
+
+
+def _instances_cache_path(input_file, model, language, normalization,
+                          df_digest, cache_dir):
+    """Returns the path of the cached instances of a document, keyed by the
+    content of the document and the feature extraction parameters."""
+
+    if os.path.isfile(input_file):
+        with open(input_file, 'rb') as f:
+            sha = hashlib.sha1(f.read())
+    else:
+        sha = hashlib.sha1(input_file.encode('utf-8'))
+    sha.update(json.dumps([type(model).__name__, language, normalization,
+                           df_digest]).encode('utf-8'))
+    return os.path.join(cache_dir, sha.hexdigest() + '.npz')
+
+
+def _extract_training_instances(job):
+    """Extract the candidates and their feature vectors from a document.
+
+    Args:
+        job (tuple): the document id and the input file or text.
+
+    Returns:
+        tuple: the document id, the list of candidates and the matrix of their
+            feature vectors, or None if the document has no candidate.
+    """
+
+    worker = _training_worker
+    model = worker['model']
+
+    doc_id, input_file = job
+
+    logging.info('reading document {}'.format(doc_id))
+
+    # read the instances from the cache
+    cache_file = None
+    if worker['cache_dir'] is not None:
+        cache_file = _instances_cache_path(input_file, model,
+                                           worker['language'],
+                                           worker['normalization'],
+                                           worker['df_digest'],
+                                           worker['cache_dir'])
+        if os.path.isfile(cache_file):
+            with np.load(cache_file, allow_pickle=False) as cached:
+                candidates = cached['candidates'].tolist()
+                if not candidates:
+                    return None
+                return doc_id, candidates, cached['instances']
+
+    # initialize the input file
+    model.__init__()
+
+    # load the document
+    model.load_document(input=input_file,
+                        language=worker['language'],
+                        normalization=worker['normalization'])
+
+    # candidate selection
+    model.candidate_selection()
+
+    # extract features
+    candidates, instances = [], None
+    if len(model.candidates):
+        model.feature_extraction(df=worker['df'], training=True)
+        candidates = list(model.instances)
+        if candidates:
+            instances = np.vstack([np.asarray(model.instances[c], dtype=float)
+                                   for c in candidates])
+
+    # write the instances to the cache, documents without candidates included
+    if cache_file is not None:
+        if instances is None:
+            instances = np.zeros((0, 0))
+        tmp_file = cache_file + '.{}.tmp'.format(os.getpid())
+        with open(tmp_file, 'wb') as f:
+            np.savez(f, candidates=np.asarray(candidates, dtype=str),
+                     instances=instances)
+        os.replace(tmp_file, cache_file)
+
+    # skipping documents without candidates
+    if not candidates:
+        return None
+
+    return doc_id, candidates, instances
+
+
+def _train_leave_one_out_model(fold):
+    """Train the leave-one-out model of a document.
+
+    Args:
+        fold (tuple): the document id and the first and last offsets of its
+            instances in the training matrix.
+    """
+
+    worker = _training_worker
+    doc_id, start, end = fold
+
+    logging.info('writing model to {}'.format(doc_id))
+
+    # mask the instances of the document
+    mask = np.ones(len(worker['classes']), dtype=bool)
+    mask[start:end] = False
+
+    worker['model'].train(training_instances=worker['instances'][mask],
+                          training_classes=worker['classes'][mask],
+                          model_file=worker['model_file'] + "." + doc_id +
+                          ".pickle")
+
+
+def _map(function, jobs, n_jobs, chunksize=1, **state):
+    """Map a function over jobs, using a pool of n_jobs workers sharing the
+    given state, or in the current process if n_jobs is 1. The jobs can be a
+    generator, they are sent to the workers by chunks of chunksize jobs as
+    they are consumed, instead of being all loaded first."""
+
+    if n_jobs == 1:
+        _init_training_worker(state)
+        try:
+            return [function(job) for job in jobs]
+        finally:
+            _training_worker.clear()
+
+    pool = Pool(None if n_jobs < 0 else n_jobs,
+                initializer=_init_training_worker,
+                initargs=(state,))
+    try:
+        return list(pool.imap(function, jobs, chunksize=chunksize))
+    finally:
+        pool.close()
+        pool.join()
+
+
 def train_supervised_model(input_dir,
                            reference_file,
                            model_file,
@@ -154,13 +324,17 @@ def train_supervised_model(input_dir,
                            sep_doc_id=':',
                            sep_ref_keyphrases=',',
                            normalize_reference=False,
-                           leave_one_out=False):
+                           leave_one_out=False,
+                           n_jobs=1,
+                           cache_dir=None):
     """Build a supervised keyphrase extraction model from a set of documents and
     a reference file.
 
     Args:
-        input_dir (str): the input directory.
-        reference_file (str): the reference file.
+        input_dir (str or JsonlCorpusReader): the input directory, or a
+            JSON lines corpus.
+        reference_file (str): the reference file, defaults to the references
+            of the corpus if None and input_dir is a JsonlCorpusReader.
         model_file (str): the model output file.
         extension (str): file extension for input documents, defaults to xml.
         language (str): language of the input documents (used for computing the
@@ -178,61 +352,66 @@ def train_supervised_model(input_dir,
             keyphrases, default to False.
         leave_one_out (bool): whether to use a leave-one-out procedure for
             training, creating one model per input, defaults to False.
+        n_jobs (int): number of processes used for extracting the features and
+            training the leave-one-out models, -1 means using all processors,
+            defaults to 1.
+        cache_dir (str): directory where the feature vectors of each document
+            are cached, keyed by the document content, the model, the language,
+            the normalization and the df weights, defaults to None (no cache).
     """
 
     logging.info('building model {} from {}'.format(model, input_dir))
 
+    if reference_file is None and isinstance(input_dir, JsonlCorpusReader):
+        reference_file = input_dir
+
     references = load_references(reference_file,
                                  sep_doc_id=sep_doc_id,
                                  sep_ref_keyphrases=sep_ref_keyphrases,
                                  normalize_reference=normalize_reference,
                                  language=language)
-    training_instances = []
-    training_classes = []
-    masks = {}
-    offsets = []
-    sizes = []
-
-    # get the input files from the input directory
-    for input_file in glob.iglob(input_dir + '/*.' + extension):
-
-        logging.info('reading file {}'.format(input_file))
-
-        # get the document id from file name
-        doc_id = '.'.join(input_file.split('/')[-1].split('.')[0:-1])
-
-        # initialize the input file
-        model.__init__()
-
-        # load the document
-        model.load_document(input=input_file,
-                            language=language,
-                            normalization=normalization)
-
-        # candidate selection
-        model.candidate_selection()
-
-        # skipping documents without candidates
-        if not len(model.candidates):
-            continue
-
-        # extract features
-        model.feature_extraction(df=df, training=True)
 
-        # add the first offset for leave-one-out masking
+    # fingerprint of the df weights for the cache keys
+    df_digest = None
+    if cache_dir is not None:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        if df is not None:
+            sha = hashlib.sha1()
+            for ngram in sorted(df):
+                sha.update('{}\t{}\n'.format(ngram, df[ngram]).encode('utf-8'))
+            df_digest = sha.hexdigest()
+
+    # extract the features of the input files from the input directory, the
+    # documents being streamed to the workers
+    jobs = _iter_documents(input_dir, extension)
+    documents = _map(_extract_training_instances, jobs, n_jobs, chunksize=64,
+                     model=model, df=df, language=language,
+                     normalization=normalization, df_digest=df_digest,
+                     cache_dir=cache_dir)
+    documents = [document for document in documents if document is not None]
+
+    # offsets of the instances of each document for leave-one-out masking
+    masks = {}
+    training_classes = []
+    for doc_id, candidates, instances in documents:
         masks[doc_id] = [len(training_classes)]
 
         # annotate the reference keyphrases in the instances
-        for candidate in model.instances:
-            if candidate in references[doc_id]:
-                training_classes.append(1)
-            else:
-                training_classes.append(0)
-            training_instances.append(model.instances[candidate])
+        training_classes.extend([1 if candidate in references[doc_id] else 0
+                                 for candidate in candidates])
 
-        # add the last offset for leave-one-out masking
         masks[doc_id].append(len(training_classes))
 
+    # stack the instances in a contiguous matrix
+    training_classes = np.array(training_classes, dtype=int)
+    if documents:
+        training_instances = np.ascontiguousarray(
+            np.vstack([instances for _, _, instances in documents]))
+    else:
+        training_instances = np.zeros((0, 0))
+    del documents
+
     if not leave_one_out:
         logging.info('writing model to {}'.format(model_file))
         model.train(training_instances=training_instances,
@@ -241,14 +420,10 @@ def train_supervised_model(input_dir,
     else:
         logging.info('leave-one-out training procedure')
 
-        for doc_id in masks:
-            logging.info('writing model to {}'.format(doc_id))
-            ind = masks[doc_id]
-            fold = training_instances[:ind[0]] + training_instances[ind[1]:]
-            gold = training_classes[:ind[0]] + training_classes[ind[1]:]
-            model.train(training_instances=fold,
-                        training_classes=gold,
-                        model_file=model_file+"."+doc_id+".pickle")
+        folds = [(doc_id, ind[0], ind[1]) for doc_id, ind in masks.items()]
+        _map(_train_leave_one_out_model, folds, n_jobs, model=model,
+             instances=training_instances, classes=training_classes,
+             model_file=model_file)
 
 
 def load_references(input_file,
@@ -261,7 +436,8 @@ def load_references(input_file,
     the SemEval-2010 official format.
 
     Args:
-        input_file (str): path to the reference file.
+        input_file (str or JsonlCorpusReader): path to the reference file, or
+            a JSON lines corpus holding the reference keyphrases.
         sep_doc_id (str): the separator used for doc_id in reference file,
             defaults to ':'.
         sep_ref_keyphrases (str): the separator used for keyphrases in
@@ -277,6 +453,16 @@ def load_references(input_file,
 
     references = defaultdict(list)
 
+    # load the references of a corpus
+    if isinstance(input_file, JsonlCorpusReader):
+        for doc_id, _, keyphrases in input_file:
+            references[doc_id] = list(keyphrases)
+
+        if normalize_reference:
+            _normalize_references(references, language)
+
+        return references
+
     # open input file
     with codecs.open(input_file, 'r', encoding) as f:
 
@@ -302,19 +488,52 @@ def load_references(input_file,
 
         # normalize reference if needed
         if normalize_reference:
+            _normalize_references(references, language)
 
-            # initialize stemmer
-            stemmer = SnowballStemmer("porter")
-            if language != 'en':
-                stemmer = SnowballStemmer(ISO_to_language[language],
-                                          ignore_stopwords=True)
+    return references
 
-            for doc_id in references:
-                for i, keyphrase in enumerate(references[doc_id]):
-                    stems = [stemmer.stem(w) for w in keyphrase.split()]
-                    references[doc_id][i] = ' '.join(stems)
 
-    return references
+def _normalize_references(references, language):
+    """Replaces in place the reference keyphrases by their stems."""
+
+    for doc_id in references:
+        for i, keyphrase in enumerate(references[doc_id]):
+            stems = stem_words(keyphrase.split(), language)
+            references[doc_id][i] = ' '.join(stems)
+
+
+def _load_lda_text(args):
+    """Load a document as the space-separated sequence of its stems that are
+    not punctuation marks, used as input text for the LDA model.
+
+    Args:
+        args (tuple): the input file or text, the language and the
+            normalization method, packed so that the function can be mapped over a pool of
+            workers.
+    """
+
+    input_file, language, normalization = args
+
+    # initialize load file object
+    doc = LoadFile()
+
+    # read the input file
+    doc.load_document(input=input_file,
+                      language=language,
+                      normalization=normalization)
+
+    # container for current document
+    text = []
+
+    # loop through sentences
+    for sentence in doc.sentences:
+        # get the tokens (stems) from the sentence if they are not
+        # punctuation marks
+        text.extend([sentence.stems[i] for i in range(sentence.length)
+                     if sentence.pos[i] != 'PUNCT' and
+                     sentence.pos[i].isalpha()])
+
+    return ' '.join(text)
 
 
 def compute_lda_model(input_dir,
@@ -322,12 +541,18 @@ def compute_lda_model(input_dir,
                       n_topics=500,
                       extension="xml",
                       language="en",
-                      normalization="stemming"):
+                      normalization="stemming",
+                      n_jobs=1,
+                      learning_method='batch',
+                      batch_size=128):
     """Compute a LDA model from a collection of documents. Latent Dirichlet
-    Allocation is computed using sklearn module.
+    Allocation is computed using sklearn module. The model is saved as an
+    uncompressed numpy archive if `output_file` ends with .npz, which can be
+    memory-mapped by `load_lda_model`, or as a gzip pickle otherwise.
 
     Args:
-        input_dir (str): the input directory.
+        input_dir (str or JsonlCorpusReader): the input directory, or a
+            JSON lines corpus.
         output_file (str): the output file.
         n_topics (int): number of topics for the LDA model, defaults to 500.
         extension (str): file extension for input documents, defaults to xml.
@@ -336,44 +561,36 @@ def compute_lda_model(input_dir,
         normalization (str): word normalization method, defaults to 'stemming'.
             Other possible values are 'lemmatization' or 'None' for using word
             surface forms instead of stems/lemmas.
+        n_jobs (int): number of processes used for loading the documents and
+            fitting the model, -1 means using all processors, defaults to 1.
+        learning_method (str): method used to update the model, 'batch' or
+            'online' (minibatch updates, faster on large collections),
+            defaults to 'batch'.
+        batch_size (int): number of documents in each minibatch when
+            `learning_method` is 'online', defaults to 128.
     """
 
-    # texts container
-    texts = []
-
-    # loop throught the documents
-    for input_file in glob.iglob(input_dir + '/*.' + extension):
-
-        logging.info('reading file {}'.format(input_file))
-
-        # initialize load file object
-        doc = LoadFile()
-
-        # read the input file
-        doc.load_document(input=input_file,
-                          language=language,
-                          normalization=normalization)
-
-        # container for current document
-        text = []
-
-        # loop through sentences
-        for sentence in doc.sentences:
-            # get the tokens (stems) from the sentence if they are not
-            # punctuation marks 
-            text.extend([sentence.stems[i] for i in range(sentence.length)
-                         if sentence.pos[i] != 'PUNCT' and
-                         sentence.pos[i].isalpha()])
-
-        # add the document to the texts container
-        texts.append(' '.join(text))
+    # loop throught the documents, which are streamed from the input
+    jobs = ((input_file, language, normalization) for _, input_file in
+            _iter_documents(input_dir, extension))
 
     # vectorize dataset
     # get the stoplist from nltk because CountVectorizer only contains english
     # stopwords atm
     tf_vectorizer = CountVectorizer(
         stop_words=stopwords.words(ISO_to_language[language]))
-    tf = tf_vectorizer.fit_transform(texts)
+
+    # the texts are vectorized as they are loaded, without keeping them
+    if n_jobs == 1:
+        tf = tf_vectorizer.fit_transform(_load_lda_text(job) for job in jobs)
+    else:
+        pool = Pool(None if n_jobs < 0 else n_jobs)
+        try:
+            tf = tf_vectorizer.fit_transform(
+                pool.imap(_load_lda_text, jobs, chunksize=64))
+        finally:
+            pool.close()
+            pool.join()
 
     # extract vocabulary
     vocabulary = tf_vectorizer.get_feature_names()
@@ -381,7 +598,9 @@ def compute_lda_model(input_dir,
     # create LDA model and train
     lda_model = LatentDirichletAllocation(n_components=n_topics,
                                           random_state=0,
-                                          learning_method='batch')
+                                          learning_method=learning_method,
+                                          batch_size=batch_size,
+                                          n_jobs=n_jobs)
     lda_model.fit(tf)
 
     # save all data necessary for later prediction
@@ -397,9 +616,93 @@ def compute_lda_model(input_dir,
     if os.path.dirname(output_file):
         os.makedirs(os.path.dirname(output_file), exist_ok=True)
 
+    # dump the LDA model as uncompressed arrays that can be memory-mapped
+    if output_file.endswith('.npz'):
+        np.savez(output_file,
+                 vocabulary=np.asarray(vocabulary, dtype=str),
+                 components=saved_model[1],
+                 exp_dirichlet_component=saved_model[2],
+                 doc_topic_prior=np.asarray(saved_model[3]))
+
     # dump the LDA model
-    with gzip.open(output_file, 'wb') as fp:
-        pickle.dump(saved_model, fp)
+    else:
+        with gzip.open(output_file, 'wb') as fp:
+            pickle.dump(saved_model, fp)
+
+
+def _mmap_npz_member(path, zip_file, name, mmap_mode):
+    """Memory-map an array stored uncompressed in a numpy archive.
+
+    Args:
+        path (str): path to the numpy archive.
+        zip_file (zipfile.ZipFile): the opened archive.
+        name (str): the name of the array.
+        mmap_mode (str): the memory-map mode, e.g. 'r'.
+    """
+
+    info = zip_file.getinfo(name + '.npy')
+
+    with open(path, 'rb') as f:
+        # skip the local file header of the member
+        f.seek(info.header_offset)
+        header = f.read(30)
+        name_length, extra_length = struct.unpack('<HH', header[26:30])
+        f.seek(info.header_offset + 30 + name_length + extra_length)
+
+        # read the npy header
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = \
+                np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = \
+                np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+
+    return np.memmap(path, dtype=dtype, mode=mmap_mode, shape=shape,
+                     order='F' if fortran_order else 'C', offset=offset)
+
+
+def load_lda_model(input_file, mmap_mode='r'):
+    """Load a LDA model computed by `compute_lda_model`. Models saved as numpy
+    archives (.npz) are memory-mapped so that the topic-word matrices are
+    only paged in when accessed, other files are unpickled.
+
+    Args:
+        input_file (str): path to the LDA model.
+        mmap_mode (str): the memory-map mode for numpy archives, None for
+            loading the arrays in memory, defaults to 'r'.
+
+    Returns:
+        tuple: the vocabulary, the components, the exponential dirichlet
+            components and the document topic prior of the model.
+    """
+
+    logging.info('loading LDA model from {}'.format(input_file))
+
+    if not input_file.endswith('.npz'):
+        with gzip.open(input_file, 'rb') as fp:
+            return pickle.load(fp)
+
+    names = ['components', 'exp_dirichlet_component']
+
+    with zipfile.ZipFile(input_file) as zip_file, \
+            np.load(input_file) as model:
+
+        # compressed members can not be mapped
+        compressed = any(zip_file.getinfo(n + '.npy').compress_type !=
+                         zipfile.ZIP_STORED for n in names)
+
+        if mmap_mode is None or compressed:
+            arrays = [model[n] for n in names]
+        else:
+            arrays = [_mmap_npz_member(input_file, zip_file, n, mmap_mode)
+                      for n in names]
+
+        vocabulary = model['vocabulary'].tolist()
+        doc_topic_prior = model['doc_topic_prior'].item()
+
+    return vocabulary, arrays[0], arrays[1], doc_topic_prior
 
 
 def load_document_as_bos(input_file,
@@ -443,6 +746,44 @@ def load_document_as_bos(input_file,
     return vector
 
 
+def _build_tfidf_matrix(bags, vocabulary, idf):
+    """Build a sparse TF x IDF matrix from a list of bag of words.
+
+    Args:
+        bags (list): the bag of words/stems/lemmas (dict) of each document.
+        vocabulary (dict): mapping from terms to column indexes, new terms are
+            added to the mapping.
+        idf (func): function returning the IDF weight of a term.
+
+    Returns:
+        scipy.sparse.csr_matrix: the TF x IDF matrix, one row per document.
+    """
+
+    indptr = [0]
+    indices = []
+    data = []
+
+    for bag in bags:
+        for term, tf in bag.items():
+            indices.append(vocabulary.setdefault(term, len(vocabulary)))
+            data.append(tf * idf(term))
+        indptr.append(len(indices))
+
+    return csr_matrix((np.asarray(data, dtype=np.float64),
+                       np.asarray(indices, dtype=np.int64),
+                       np.asarray(indptr, dtype=np.int64)),
+                      shape=(len(bags), len(vocabulary)))
+
+
+def _l2_normalize_rows(X):
+    """Scale the rows of a sparse matrix to unit length, rows with a null norm
+    are left unchanged (all their cosine similarities are then 0)."""
+
+    norms = np.sqrt(np.asarray(X.multiply(X).sum(axis=1)).ravel())
+    norms[norms == 0.0] = 1.0
+    return diags(1.0 / norms).dot(X).tocsr()
+
+
 def compute_pairwise_similarity_matrix(input_dir,
                                        output_file,
                                        collection_dir=None,
@@ -450,18 +791,28 @@ def compute_pairwise_similarity_matrix(input_dir,
                                        extension="xml",
                                        language="en",
                                        normalization="stemming",
-                                       stoplist=None):
+                                       stoplist=None,
+                                       top_k=None,
+                                       threshold=None,
+                                       block_size=1000):
     """Compute the pairwise similarity between documents in `input_dir` and
     documents in `collection_dir`. Similarity scores are computed using a cosine
     similarity over TF x IDF term weights. If there is no collection to compute
     those scores, the similarities between documents in input_dir are returned
     instead.
 
+    TF x IDF vectors are stored as sparse matrices whose rows are normalized
+    once, similarities are then computed for blocks of `block_size` input
+    documents with a sparse matrix product and written to the output file
+    block by block.
+
     Args:
-        input_dir (str): path to the input directory.
+        input_dir (str or JsonlCorpusReader): path to the input directory, or
+            a JSON lines corpus (documents are then named by their ids in the
+            output file).
         output_file (str): path to the output file.
-        collection_dir (str): path to the collection of documents, defaults to
-            None.
+        collection_dir (str or JsonlCorpusReader): path to the collection of
+            documents, or a JSON lines corpus, defaults to None.
         df (dict): df weights dictionary.
         extension (str): file extension for input documents, defaults to xml.
         language (str): language of the input documents, used for stop_words
@@ -470,11 +821,19 @@ def compute_pairwise_similarity_matrix(input_dir,
             Other possible values are 'lemmatization' or 'None' for using word
             surface forms instead of stems/lemmas.
         stoplist (list): the stop words for filtering tokens, default to [].
+        top_k (int): only write the k most similar collection documents of
+            each input document, defaults to None (all documents).
+        threshold (float): only write the pairs whose similarity is greater or
+            equal to the threshold, defaults to None (no threshold).
+        block_size (int): number of input documents whose similarities are
+            computed at once, defaults to 1000.
     """
 
     # containers
-    collection = {}
-    documents = {}
+    collection_files = []
+    collection_bags = []
+    document_files = []
+    document_bags = []
 
     # initialize the number of documents
     N = df.get('--NB_DOC--', 1)
@@ -483,46 +842,84 @@ def compute_pairwise_similarity_matrix(input_dir,
     if stoplist is None:
         stoplist = []
 
-    # build collection tf*idf vectors
+    # build collection bag of words
     if collection_dir is not None:
 
         # loop throught the documents in the collection
-        for input_file in glob.iglob(collection_dir + '/*.' + extension):
+        for doc_id, input_file in _iter_documents(collection_dir, extension):
 
-            logging.info('Reading file from {}'.format(input_file))
+            # documents of a corpus are named by their ids, files by their path
+            if isinstance(collection_dir, JsonlCorpusReader):
+                logging.info('Reading document {}'.format(doc_id))
+                collection_files.append(doc_id)
+            else:
+                logging.info('Reading file from {}'.format(input_file))
+                collection_files.append(input_file)
 
             # initialize document vector
-            collection[input_file] = load_document_as_bos(input_file=input_file,
-                                                          language=language,
-                                                          normalization=normalization,
-                                                          stoplist=stoplist)
-
-            # compute TF*IDF weights
-            for stem in collection[input_file]:
-                collection[input_file][stem] *= math.log(N / df.get(stem, 1), 2)
-
-        # update N if a collection of documents is provided
-        N += 1
+            collection_bags.append(load_document_as_bos(input_file=input_file,
+                                                        language=language,
+                                                        normalization=normalization,
+                                                        stoplist=stoplist))
 
     # loop throught the documents in the input directory
-    for input_file in glob.iglob(input_dir + '/*.' + extension):
+    for doc_id, input_file in _iter_documents(input_dir, extension):
 
-        logging.info('Reading file from {}'.format(input_file))
+        # documents of a corpus are named by their ids, files by their path
+        if isinstance(input_dir, JsonlCorpusReader):
+            logging.info('Reading document {}'.format(doc_id))
+            document_files.append(doc_id)
+        else:
+            logging.info('Reading file from {}'.format(input_file))
+            document_files.append(input_file)
 
         # initialize document vector
-        documents[input_file] = load_document_as_bos(input_file=input_file,
-                                                     language=language,
-                                                     normalization=normalization,
-                                                     stoplist=stoplist)
+        document_bags.append(load_document_as_bos(input_file=input_file,
+                                                  language=language,
+                                                  normalization=normalization,
+                                                  stoplist=stoplist))
+
+    # shared term -> column mapping
+    vocabulary = {}
+
+    # compute TF*IDF weights, N is updated if a collection is provided
+    collection = None
+    if collection_files:
+        collection = _build_tfidf_matrix(
+            collection_bags, vocabulary,
+            lambda stem: math.log(N / df.get(stem, 1), 2))
+        N += 1
+
+    documents = _build_tfidf_matrix(
+        document_bags, vocabulary,
+        lambda stem: math.log(N / (1 + df.get(stem, 1)), 2))
 
-        # compute TF*IDF weights
-        for stem in documents[input_file]:
-            documents[input_file][stem] *= math.log(N / (1+df.get(stem, 1)), 2)
+    # release the bag of words
+    del collection_bags, document_bags
 
     # consider input documents as collection if None provided
-    if not collection:
+    if collection is None:
         collection = documents
+        collection_files = document_files
+
+    # align the number of columns with the final vocabulary
+    documents.resize((documents.shape[0], len(vocabulary)))
+    collection.resize((collection.shape[0], len(vocabulary)))
+
+    # precompute the norms by normalizing the vectors
+    documents = _l2_normalize_rows(documents)
+    collection_t = _l2_normalize_rows(collection).T.tocsr()
+
+    # column of each input document in the collection (-1 if it is not in
+    # the collection), so that the document itself is discarded
+    collection_columns = {input_file: j
+                          for j, input_file in enumerate(collection_files)}
+    self_columns = np.array([collection_columns.get(input_file, -1)
+                             for input_file in document_files], dtype=int)
 
+    # null similarities are only dropped when they can't be written
+    write_null = (top_k is None and threshold is None) or \
+        (threshold is not None and threshold <= 0)
 
     # create directories from path if not exists
     if os.path.dirname(output_file):
@@ -531,28 +928,49 @@ def compute_pairwise_similarity_matrix(input_dir,
     # open the output file in gzip mode
     with gzip.open(output_file, 'wb') as f:
 
-        # compute pairwise similarity scores
-        for doc_i in documents:
-            for doc_j in collection:
-                if doc_i == doc_j:
-                    continue
-
-                # inner product
-                inner = 0.0
-                for stem in set(documents[doc_i]) & set(collection[doc_j]):
-                    inner += documents[doc_i][stem] * collection[doc_j][stem]
-
-                # norms
-                norm_i = sum([math.pow(documents[doc_i][t], 2) for t in
-                              documents[doc_i]])
-                norm_i = math.sqrt(norm_i)
-                norm_j = sum([math.pow(collection[doc_j][t], 2) for t in
-                              collection[doc_j]])
-                norm_j = math.sqrt(norm_j)
-
-                # compute cosine
-                cosine = inner / (norm_i * norm_j)
-
-                # encode line and write to output file
-                line = doc_i + '\t' + doc_j + '\t' + str(cosine) + '\n'
-                f.write(line.encode('utf-8'))
+        # compute pairwise similarity scores block by block
+        for start in range(0, documents.shape[0], block_size):
+
+            # cosine similarities of the block, (block_size, |collection|)
+            block = documents[start:start + block_size].dot(collection_t)
+
+            # every pair is a candidate, null similarities included
+            if write_null:
+                block = block.toarray()
+                rows = [(np.arange(block.shape[1]), block[r])
+                        for r in range(block.shape[0])]
+
+            # only the non null similarities are candidate neighbours
+            else:
+                block = block.tocsr()
+                rows = [(block.indices[block.indptr[r]:block.indptr[r + 1]],
+                         block.data[block.indptr[r]:block.indptr[r + 1]])
+                        for r in range(block.shape[0])]
+
+            lines = []
+            for r, (columns, cosines) in enumerate(rows):
+                doc_i = document_files[start + r]
+
+                # discard the document itself
+                keep = columns != self_columns[start + r]
+                columns, cosines = columns[keep], cosines[keep]
+
+                # filter the similarities below the threshold
+                if threshold is not None:
+                    keep = cosines >= threshold
+                    columns, cosines = columns[keep], cosines[keep]
+
+                # select the k most similar documents in descending order
+                if top_k is not None:
+                    if len(cosines) > top_k:
+                        best = np.argpartition(-cosines, top_k - 1)[:top_k]
+                        columns, cosines = columns[best], cosines[best]
+                    order = np.argsort(-cosines, kind='mergesort')
+                    columns, cosines = columns[order], cosines[order]
+
+                for j, cosine in zip(columns, cosines):
+                    lines.append(doc_i + '\t' + collection_files[j] + '\t' +
+                                 str(float(cosine)) + '\n')
+
+            # encode lines and write them to output file
+            f.write(''.join(lines).encode('utf-8'))
@@ -131,6 +131,7 @@ class SequenceGenerator(object):
                  return_attention=True,
                  length_normalization_factor=0.0,
                  length_normalization_const=5.,
+                 n_best=None
                  ):
         """Initializes the generator.
 
@@ -145,6 +146,9 @@ class SequenceGenerator(object):
             x > 0 then longer sequences will be favored.
             alpha in: https://arxiv.org/abs/1609.08144
           length_normalization_const: 5 in https://arxiv.org/abs/1609.08144
+          n_best: If not None, beam search stops for a batch item once it has n_best completed
+            sequences that no partial sequence can beat (the top n_best sequences are the same
+            as without stopping but lower ranked ones are missing), by default it runs until max_sequence_length.
         """
         self.model = model
         self.eos_id = eos_id
@@ -153,6 +157,7 @@ class SequenceGenerator(object):
         self.length_normalization_factor = length_normalization_factor
         self.length_normalization_const = length_normalization_const
         self.return_attention = return_attention
+        self.n_best = n_best
         self.get_mask = GetMask()
 
     def sequence_to_batch(self, sequence_lists):
@@ -203,9 +208,21 @@ class SequenceGenerator(object):
 
         return seq_id2batch_id, flattened_id_map, inputs, dec_hiddens, contexts, ctx_mask, src_oovs, oov_lists
 
+    def _length_penalty(self, length):
+        L = self.length_normalization_const
+        return ((L + length) / (L + 1)) ** self.length_normalization_factor
+
     def beam_search(self, src_input, src_len, src_oov, oov_list, word2id):
         """Runs beam search sequence generation given input (padded word indexes)
 
+        The hypotheses of all the batch items are kept in (num_hyps, ...) tensors, num_hyps = #(active items) * beam_size,
+        holding their scores, tokens, backpointers and decoder states. At each step the top beam_size hypotheses of an item
+        are selected with one topk over the flattened (beam_size * vocab) scores and the states are reordered with index_select.
+        As before, a hypothesis ending with EOS is completed only if EOS is in its top beam_size words.
+        Items are dropped from the active set once they have n_best completed hypotheses that no partial one can beat.
+        The encoder outputs, masks, oov maps and attention keys are kept once per active item, the hypotheses of an item
+        being contiguous, and are only re-indexed when items are dropped.
+
         Args:
           initial_input: An initial input for the model -
                          list of batch size holding the first input for every entry.
@@ -214,198 +231,190 @@ class SequenceGenerator(object):
         """
         self.model.eval()
         batch_size = len(src_input)
+        beam_size = self.beam_size
 
         src_mask = self.get_mask(src_input)  # same size as input_src
         src_context, (src_h, src_c) = self.model.encode(src_input, src_len)
+        device = src_context.device
 
-        # prepare the init hidden vector, (batch_size, trg_seq_len, dec_hidden_dim)
+        # prepare the init hidden vector, tuple of (num_layers, batch_size, dec_hidden_dim)
         dec_hiddens = self.model.init_decoder_state(src_h, src_c)
 
-        # each dec_hidden is (trg_seq_len, dec_hidden_dim)
-        initial_input = [word2id[pykp.io.BOS_WORD]] * batch_size
-        if isinstance(dec_hiddens, tuple):
-            dec_hiddens = (dec_hiddens[0].squeeze(0), dec_hiddens[1].squeeze(0))
-            dec_hiddens = [(dec_hiddens[0][i], dec_hiddens[1][i]) for i in range(batch_size)]
-        elif isinstance(dec_hiddens, list):
-            dec_hiddens = dec_hiddens
-
-        partial_sequences = [TopN_heap(self.beam_size) for _ in range(batch_size)]
-        complete_sequences = [TopN_heap(sys.maxsize) for _ in range(batch_size)]
-
-        for batch_i in range(batch_size):
-            seq = Sequence(
-                batch_id=batch_i,
-                sentence=[initial_input[batch_i]],
-                dec_hidden=dec_hiddens[batch_i],
-                context=src_context[batch_i],
-                ctx_mask=src_mask[batch_i],
-                src_oov=src_oov[batch_i],
-                oov_list=oov_list[batch_i],
-                logprobs=[],
-                score=0.0,
-                attention=[])
-            partial_sequences[batch_i].push(seq)
+        # the active items and the batch item of each hypothesis, starting with one hypothesis <BOS> per item
+        active_items = torch.arange(batch_size, device=device)
+        active_context, active_mask, active_src_oov, active_oov_list = src_context, src_mask, src_oov, oov_list
+        # the attention keys of the encoder outputs are projected once, not at every step
+        active_keys = self.model.attention_keys(src_context)
+        hyp_items = torch.arange(batch_size, device=device)
+        hyp_scores = torch.zeros(batch_size, device=device)
+        hyp_tokens = torch.zeros(batch_size, 0, dtype=torch.long, device=device)
+        hyp_logprobs = torch.zeros(batch_size, 0, device=device)
+        hyp_attentions = [] if self.return_attention else None
+        inputs = torch.full((batch_size, 1), word2id[pykp.io.BOS_WORD], dtype=torch.long, device=device)
+
+        complete_sequences = [[] for _ in range(batch_size)]
+        # upper bound of the normalized score of the sequences completed in the future, given their current score
+        max_length_penalty = self._length_penalty(self.max_sequence_length) if self.length_normalization_factor > 0 else 1.0
 
         '''
         Run beam search.
         '''
         for current_len in range(1, self.max_sequence_length + 1):
-            # the total number of partial sequences of all the batches
-            num_partial_sequences = sum([len(batch_seqs) for batch_seqs in partial_sequences])
-            if num_partial_sequences == 0:
-                # We have run out of partial candidates; often happens when beam_size is small
+            num_hyps = hyp_items.size(0)
+            if num_hyps == 0:
                 break
 
-            # flatten 2d sequences (batch_size, beam_size) into 1d batches (batch_size * beam_size) to feed model
-            seq_id2batch_id, flattened_id_map, inputs, dec_hiddens, contexts, ctx_mask, src_oovs, oov_lists = self.sequence_to_batch(partial_sequences)
-
-            # Run one-step generation. probs=(batch_size, 1, K), dec_hidden=tuple of (1, batch_size, trg_hidden_dim)
-            log_probs, new_dec_hiddens, attn_weights = self.model.generate(
+            # Run one-step generation. log_probs=(num_hyps, 1, K), dec_hidden=tuple of (1, num_hyps, trg_hidden_dim)
+            log_probs, dec_hiddens, attn_weights = self.model.generate(
                 trg_input=inputs,
                 dec_hidden=dec_hiddens,
-                enc_context=contexts,
-                ctx_mask=ctx_mask,
-                src_map=src_oovs,
-                oov_list=oov_lists,
-                # k           =self.beam_size+1,
+                enc_context=active_context,
+                ctx_mask=active_mask,
+                src_map=active_src_oov,
+                oov_list=active_oov_list,
                 max_len=1,
-                return_attention=self.return_attention
+                return_attention=True,
+                enc_keys=active_keys
             )
-
-            # squeeze these outputs, (hyp_seq_size, trg_len=1, K+1) -> (hyp_seq_size, K+1)
-            probs, words = log_probs.data.topk(self.beam_size + 1, dim=-1)
-            words = words.squeeze(1)
-            probs = probs.squeeze(1)
-            # (hyp_seq_size, trg_len=1, src_len) -> (hyp_seq_size, src_len)
-            if isinstance(attn_weights, tuple):  # if it's (attn, copy_attn)
-                attn_weights = (attn_weights[0].squeeze(1), attn_weights[1].squeeze(1))
-            else:
-                attn_weights = attn_weights.squeeze(1)
-
-            # tuple of (num_layers * num_directions, batch_size, trg_hidden_dim)=(1, hyp_seq_size, trg_hidden_dim), squeeze the first dim
-            if isinstance(new_dec_hiddens, tuple):
-                new_dec_hiddens1 = new_dec_hiddens[0].squeeze(0)
-                new_dec_hiddens2 = new_dec_hiddens[1].squeeze(0)
-                new_dec_hiddens = [(new_dec_hiddens1[i], new_dec_hiddens2[i]) for i in range(num_partial_sequences)]
-
-            # For every partial_sequence (num_partial_sequences in total), find and trim to the best hypotheses (beam_size in total)
-            for batch_i in range(batch_size):
-                num_new_hyp_in_batch = 0
-                new_partial_sequences = TopN_heap(self.beam_size)
-
-                for partial_id, partial_seq in enumerate(partial_sequences[batch_i].extract()):
-                    num_new_hyp = 0
-                    flattened_seq_id = flattened_id_map[batch_i][partial_id]
-
-                    # check each new beam and decide to add to hypotheses or completed list
-                    for beam_i in range(self.beam_size + 1):
-                        w = int(words[flattened_seq_id][beam_i])
-                        # if w has appeared before, ignore current hypothese
-                        # if w in partial_seq.vocab:
-                        #     continue
-
-                        # score=0 means this is the first word <BOS>, empty the sentence
-                        if partial_seq.score != 0:
-                            new_sent = copy.copy(partial_seq.sentence)
-                        else:
-                            new_sent = []
-                        new_sent.append(w)
-
-                        # if w >= 50000 and len(partial_seq.oov_list)==0:
-                        #     print(new_sent)
-                        #     print(partial_seq.oov_list)
-                        #     pass
-
-                        new_partial_seq = Sequence(
-                            batch_id=partial_seq.batch_id,
-                            sentence=new_sent,
-                            dec_hidden=None,
-                            context=partial_seq.context,
-                            ctx_mask=partial_seq.ctx_mask,
-                            src_oov=partial_seq.src_oov,
-                            oov_list=partial_seq.oov_list,
-                            logprobs=copy.copy(partial_seq.logprobs),
-                            score=copy.copy(partial_seq.score),
-                            attention=copy.copy(partial_seq.attention)
-                        )
-
-                        # we have generated self.beam_size new hypotheses for current hyp, stop generating
-                        if num_new_hyp >= self.beam_size:
-                            break
-
-                        # dec_hidden and attention of this partial_seq are shared by its descendant beams
-                        new_partial_seq.dec_hidden = new_dec_hiddens[flattened_seq_id]
-
-                        if self.return_attention:
-                            if isinstance(attn_weights, tuple):  # if it's (attn, copy_attn)
-                                attn_weights = (attn_weights[0].squeeze(1), attn_weights[1].squeeze(1))
-                                new_partial_seq.attention.append((attn_weights[0][flattened_seq_id], attn_weights[1][flattened_seq_id]))
-                            else:
-                                new_partial_seq.attention.append(attn_weights[flattened_seq_id])
-                        else:
-                            new_partial_seq.attention = None
-
-                        new_partial_seq.logprobs.append(probs[flattened_seq_id][beam_i])
-                        new_partial_seq.score = new_partial_seq.score + probs[flattened_seq_id][beam_i]
-
-                        # if predict EOS, push it into complete_sequences
-                        if w == self.eos_id:
-                            if self.length_normalization_factor > 0:
-                                L = self.length_normalization_const
-                                length_penalty = (L + len(new_partial_seq.sentence)) / (L + 1)
-                                new_partial_seq.score /= length_penalty ** self.length_normalization_factor
-                            complete_sequences[new_partial_seq.batch_id].push(new_partial_seq)
-                        else:
-                            # print('Before pushing[%d]' % new_partial_sequences.size())
-                            # print(sorted([s.score for s in new_partial_sequences._data]))
-                            new_partial_sequences.push(new_partial_seq)
-                            # print('After pushing[%d]' % new_partial_sequences.size())
-                            # print(sorted([s.score for s in new_partial_sequences._data]))
-                            num_new_hyp += 1
-                            num_new_hyp_in_batch += 1
-
-                    # print('Finished no.%d partial sequence' % partial_id)
-                    # print('\t#(hypothese) = %d' % (len(new_partial_sequences)))
-                    # print('\t#(completed) = %d' % (sum([len(c) for c in complete_sequences])))
-
-                partial_sequences[batch_i] = new_partial_sequences
-
-                logging.debug('Batch=%d, \t#(hypothese) = %d, \t#(completed) = %d \t #(new_hyp_explored)=%d' % (batch_i, len(partial_sequences[batch_i]), len(complete_sequences[batch_i]), num_new_hyp_in_batch))
-                '''
-                # print-out for debug
-                print('Source with OOV: \n\t %s' % ' '.join([str(w) for w in partial_seq.src_oov.cpu().data.numpy().tolist()]))
-                print('OOV list: \n\t %s' % str(partial_seq.oov_list))
-
-                for seq_id, seq in enumerate(new_partial_sequences._data):
-                    print('%d, score=%.5f : %s' % (seq_id, seq.score, str(seq.sentence)))
-
-                print('*' * 50)
-                '''
-
-            logging.debug('Round=%d, \t#(batch) = %d, \t#(hypothese) = %d, \t#(completed) = %d' % (current_len, batch_size, sum([len(batch_heap) for batch_heap in partial_sequences]), sum([len(batch_heap) for batch_heap in complete_sequences])))
-
-            # print('Round=%d' % (current_len))
-            # print('\t#(hypothese) = %d' % (sum([len(batch_heap) for batch_heap in partial_sequences])))
-            # for b_i in range(batch_size):
-            #     print('\t\tbatch %d, #(hyp seq)=%d' % (b_i, len(partial_sequences[b_i])))
-            # print('\t#(completed) = %d' % (sum([len(batch_heap) for batch_heap in complete_sequences])))
-            # for b_i in range(batch_size):
-            #     print('\t\tbatch %d, #(completed seq)=%d' % (b_i, len(complete_sequences[b_i])))
+            log_probs = log_probs.data.squeeze(1)
+            num_words = log_probs.size(1)
+
+            # a hypothesis is completed with EOS if EOS is in its top beam_size words
+            eos_log_probs = log_probs[:, self.eos_id]
+            eos_ranks = (log_probs > eos_log_probs.unsqueeze(1)).sum(1)
+            complete_ids = torch.nonzero((eos_ranks < beam_size) & (hyp_scores > float('-inf'))).view(-1)
+
+            if self.return_attention:
+                # (num_hyps, trg_len=1, src_len) -> (num_hyps, src_len)
+                if isinstance(attn_weights, tuple):  # if it's (attn, copy_attn)
+                    step_attention = (attn_weights[0].data.squeeze(1), attn_weights[1].data.squeeze(1))
+                else:
+                    step_attention = attn_weights.data.squeeze(1)
+
+            if len(complete_ids) > 0:
+                complete_scores = hyp_scores[complete_ids] + eos_log_probs[complete_ids]
+                if self.length_normalization_factor > 0:
+                    complete_scores = complete_scores / self._length_penalty(current_len)
+                self._push_complete_sequences(complete_sequences, complete_ids, complete_scores,
+                                              hyp_items, hyp_tokens, hyp_logprobs, eos_log_probs,
+                                              hyp_attentions, step_attention if self.return_attention else None)
+
+            # select the top beam_size continuations (other than EOS) of each item over all its hypotheses
+            num_active = active_items.size(0)
+            beam_width = num_hyps // num_active
+            candidate_scores = hyp_scores.unsqueeze(1) + log_probs
+            candidate_scores[:, self.eos_id] = float('-inf')
+            top_scores, top_ids = candidate_scores.view(num_active, beam_width * num_words).topk(beam_size, dim=1)
+
+            # backpointers to the previous hypotheses and the new tokens, (num_active * beam_size)
+            backpointers = (top_ids // num_words + torch.arange(num_active, device=device).unsqueeze(1) * beam_width).view(-1)
+            new_tokens = (top_ids % num_words).view(-1)
+
+            hyp_scores = top_scores.view(-1)
+            hyp_items = hyp_items.index_select(0, backpointers)
+            hyp_tokens = torch.cat([hyp_tokens.index_select(0, backpointers), new_tokens.unsqueeze(1)], dim=1)
+            hyp_logprobs = torch.cat([hyp_logprobs.index_select(0, backpointers),
+                                      log_probs.view(-1).index_select(0, backpointers * num_words + new_tokens).unsqueeze(1)], dim=1)
+            dec_hiddens = tuple(h.index_select(1, backpointers) for h in dec_hiddens)
+            if self.return_attention:
+                hyp_attentions = [self._select_attention(a, backpointers) for a in hyp_attentions + [step_attention]]
+
+            # drop the finished items from the active set. Hypotheses with a score of -inf (if there were fewer candidates
+            # than beam_size) are kept so that all the items have beam_size hypotheses, they are never completed
+            if self.n_best is not None:
+                finished = self._finished_items(active_items, complete_sequences, top_scores[:, 0] / max_length_penalty)
+                if bool(finished.any()):
+                    kept_ids = torch.nonzero((~finished).unsqueeze(1).expand(num_active, beam_size).contiguous().view(-1)).view(-1)
+                    kept_items = torch.nonzero(~finished).view(-1)
+                    active_items = active_items.index_select(0, kept_items)
+                    active_context, active_mask, active_src_oov = [x.index_select(0, kept_items) for x in [active_context, active_mask, active_src_oov]]
+                    active_oov_list = [active_oov_list[i] for i in kept_items.tolist()]
+                    active_keys = tuple(x.index_select(0, kept_items) if x is not None else None for x in active_keys)
+                    hyp_scores, hyp_items, hyp_tokens, hyp_logprobs = [x.index_select(0, kept_ids) for x in [hyp_scores, hyp_items, hyp_tokens, hyp_logprobs]]
+                    dec_hiddens = tuple(h.index_select(1, kept_ids) for h in dec_hiddens)
+                    if self.return_attention:
+                        hyp_attentions = [self._select_attention(a, kept_ids) for a in hyp_attentions]
+
+            # if it's oov, replace it with <unk> (num_hyps, 1)
+            inputs = hyp_tokens[:, -1:].masked_fill(hyp_tokens[:, -1:] >= self.model.vocab_size, self.model.unk_word)
+
+            logging.debug('Round=%d, \t#(batch) = %d, \t#(hypothese) = %d, \t#(completed) = %d' % (current_len, active_items.size(0), hyp_items.size(0), sum([len(c) for c in complete_sequences])))
 
         # If we have no complete sequences then fall back to the partial sequences.
         # But never output a mixture of complete and partial sequences because a
         # partial sequence could have a higher score than all the complete
         # sequences.
+        partial_sequences = [[] for _ in range(batch_size)]
+        self._push_partial_sequences(partial_sequences, hyp_items, hyp_scores, hyp_tokens, hyp_logprobs, hyp_attentions)
 
-        # append all the partial_sequences to complete
-        # [complete_sequences[s.batch_id] for s in partial_sequences]
         for batch_i in range(batch_size):
             if len(complete_sequences[batch_i]) == 0:
                 complete_sequences[batch_i] = partial_sequences[batch_i]
-            complete_sequences[batch_i] = complete_sequences[batch_i].extract(sort=True)
+            complete_sequences[batch_i] = sorted(complete_sequences[batch_i], reverse=True)
 
         return complete_sequences
 
+    def _select_attention(self, attention, index):
+        if isinstance(attention, tuple):
+            return (attention[0].index_select(0, index), attention[1].index_select(0, index))
+        return attention.index_select(0, index)
+
+    def _attention_list(self, attentions, i):
+        if attentions is None:
+            return None
+        return [(a[0][i], a[1][i]) if isinstance(a, tuple) else a[i] for a in attentions]
+
+    def _push_complete_sequences(self, complete_sequences, complete_ids, complete_scores,
+                                 hyp_items, hyp_tokens, hyp_logprobs, eos_log_probs, hyp_attentions, step_attention):
+        '''
+        Convert the hypotheses completed with EOS at the current step into Sequence objects
+        '''
+        items = hyp_items[complete_ids].tolist()
+        sentences = hyp_tokens[complete_ids].tolist()
+        logprobs = torch.cat([hyp_logprobs[complete_ids], eos_log_probs[complete_ids].unsqueeze(1)], dim=1)
+        for i, hyp_id in enumerate(complete_ids.tolist()):
+            attention = None
+            if hyp_attentions is not None:
+                attention = self._attention_list(hyp_attentions + [step_attention], hyp_id)
+            complete_sequences[items[i]].append(Sequence(
+                batch_id=items[i],
+                sentence=sentences[i] + [self.eos_id],
+                dec_hidden=None, context=None, ctx_mask=None, src_oov=None, oov_list=None,
+                logprobs=list(logprobs[i]),
+                score=float(complete_scores[i]),
+                attention=attention))
+
+    def _push_partial_sequences(self, partial_sequences, hyp_items, hyp_scores, hyp_tokens, hyp_logprobs, hyp_attentions):
+        items = hyp_items.tolist()
+        sentences = hyp_tokens.tolist()
+        scores = hyp_scores.tolist()
+        for i in range(len(items)):
+            if scores[i] == float('-inf'):
+                continue
+            partial_sequences[items[i]].append(Sequence(
+                batch_id=items[i],
+                sentence=sentences[i],
+                dec_hidden=None, context=None, ctx_mask=None, src_oov=None, oov_list=None,
+                logprobs=list(hyp_logprobs[i]),
+                score=scores[i],
+                attention=self._attention_list(hyp_attentions, i)))
+
+    def _finished_items(self, active_items, complete_sequences, best_partial_bounds):
+        '''
+        An item is finished once it has n_best completed sequences and none of its partial sequences can get a higher score
+        :param best_partial_bounds: upper bound of the final score of the best partial sequence of each active item
+        :return: a bool tensor over the active items
+        '''
+        finished = []
+        for item, bound in zip(active_items.tolist(), best_partial_bounds.tolist()):
+            completed = complete_sequences[item]
+            if len(completed) < self.n_best:
+                finished.append(False)
+            else:
+                nth_best = heapq.nlargest(self.n_best, [seq.score for seq in completed])[-1]
+                finished.append(bound <= nth_best)
+        return torch.tensor(finished, dtype=torch.bool, device=active_items.device)
+
     def sample(self, src_input, src_len, src_oov, oov_list, word2id, k, is_greedy=False):
         """
         Sample k sequeces for each src in src_input
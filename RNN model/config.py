@@ -274,6 +274,8 @@ def preprocess_opts(parser):
                         help="Shuffle data")
     parser.add_argument('-lower', default=True,
                         action = 'store_true', help='lowercase data')
+    parser.add_argument('-columnar', type=int, default=1,
+                        help="Also export the one2many examples in the memory-mapped columnar format (see pykp.columnar)")
 
     # Options most relevant to summarization
     parser.add_argument('-dynamic_dict', default=True,
@@ -335,6 +337,12 @@ def train_opts(parser):
                         help='Maximum batch size')
     parser.add_argument('-batch_workers', type=int, default=2,
                         help='Number of workers for generating batches')
+    parser.add_argument('-prefetch_factor', type=int, default=2,
+                        help='Number of batches loaded in advance by each worker')
+    parser.add_argument('-max_batch_tokens', type=int, default=None,
+                        help='Maximum number of padded tokens (one2one pairs x (source + target length)) in a training batch')
+    parser.add_argument('-bucket_size', type=int, default=None,
+                        help='Number of training examples per length bucket, default to 50 batches')
     parser.add_argument('-optim', default='adam',
                         choices=['sgd', 'adagrad', 'adadelta', 'adam'],
                         help="""Optimization method.""")
@@ -435,6 +443,9 @@ def train_opts(parser):
                         help='Beam size')
     parser.add_argument('-max_sent_length', type=int, default=5,
                         help='Maximum sentence length.')
+    parser.add_argument('-n_best', type=int, default=None,
+                        help='If set, stop the beam search of an example once it has n_best completed sequences '
+                             'that no partial sequence can beat (lower ranked predictions are missing)')
 
 def predict_opts(parser):
     parser.add_argument('-must_appear_in_src', action='store_true', default=False,
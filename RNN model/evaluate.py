@@ -9,6 +9,7 @@ import torch
 from nltk.stem.porter import *
 import numpy as np
 from collections import Counter
+from functools import lru_cache
 
 import os
 
@@ -96,48 +97,76 @@ def post_process_predseqs(seqs, num_oneword_seq=1):
         return unzipped
 
 
+class PhraseIndex(object):
+    '''
+    Index of the n-grams of a tokenized text, mapping each n-gram to the position of its first occurrence,
+    so checking whether a phrase appears in the text takes O(len(phrase)) instead of a scan of the text.
+    N-grams are indexed up to max_phrase_len, and longer ones are added when a longer phrase is queried
+    '''
+    def __init__(self, tokens, max_phrase_len=0):
+        self.tokens = list(tokens)
+        self.max_phrase_len = 0
+        self.first_positions = {}
+        self._index_ngrams(max_phrase_len)
+
+    def _index_ngrams(self, max_phrase_len):
+        max_phrase_len = min(max_phrase_len, len(self.tokens))
+        for n in range(self.max_phrase_len + 1, max_phrase_len + 1):
+            for start_idx in range(len(self.tokens) - n + 1):
+                self.first_positions.setdefault(tuple(self.tokens[start_idx: start_idx + n]), start_idx)
+        self.max_phrase_len = max(self.max_phrase_len, max_phrase_len)
+
+    def position(self, phrase_tokens):
+        '''
+        :return: the position of the first occurrence of the phrase in the text, -1 if it's absent
+        '''
+        if len(phrase_tokens) == 0:
+            return 0
+        if len(phrase_tokens) > self.max_phrase_len:
+            self._index_ngrams(len(phrase_tokens))
+        return self.first_positions.get(tuple(phrase_tokens), -1)
+
+    def __contains__(self, phrase_tokens):
+        return self.position(phrase_tokens) >= 0
+
+
 def if_present_phrase(src_str_tokens, phrase_str_tokens):
     """
 
-    :param src_str_tokens: a list of strings (words) of source text
+    :param src_str_tokens: a list of strings (words) of source text, or its PhraseIndex
     :param phrase_str_tokens: a list of strings (words) of a phrase
     :return:
     """
-    match_pos_idx = -1
-    for src_start_idx in range(len(src_str_tokens) - len(phrase_str_tokens) + 1):
-        match_flag = True
-        # iterate each word in target, if one word does not match, set match=False and break
-        for seq_idx, seq_w in enumerate(phrase_str_tokens):
-            src_w = src_str_tokens[src_start_idx + seq_idx]
-            if src_w != seq_w:
-                match_flag = False
-                break
-        if match_flag:
-            match_pos_idx = src_start_idx
-            break
+    if not isinstance(src_str_tokens, PhraseIndex):
+        src_str_tokens = PhraseIndex(src_str_tokens, max_phrase_len=len(phrase_str_tokens))
 
-    return match_flag, match_pos_idx
+    match_pos_idx = src_str_tokens.position(phrase_str_tokens)
+    return match_pos_idx >= 0, match_pos_idx
 
 
 def if_present_duplicate_phrases(src_str, trgs_str, do_stemming=True, check_duplicate=True):
+    '''
+    :param src_str: tokens of source text, or a PhraseIndex of them (stemmed if do_stemming) to share it between calls
+    '''
     if do_stemming:
-        src_to_match = stem_word_list(src_str)
+        trgs_to_match = [stem_word_list(trg_str) for trg_str in trgs_str]
+    else:
+        trgs_to_match = trgs_str
+
+    # the n-grams of source text are hashed once for all the phrases
+    if isinstance(src_str, PhraseIndex):
+        src_index = src_str
     else:
-        src_to_match = src_str
+        src_to_match = stem_word_list(src_str) if do_stemming else src_str
+        src_index = PhraseIndex(src_to_match, max_phrase_len=max([len(t) for t in trgs_to_match] + [0]))
 
     present_indices = []
     present_flags = []
     phrase_set = set()  # some phrases are duplicate after stemming, like "model" and "models" would be same after stemming, thus we ignore the following ones
 
-    for trg_str in trgs_str:
-        if do_stemming:
-            trg_to_match = stem_word_list(trg_str)
-        else:
-            trg_to_match = trg_str
-
+    for trg_to_match in trgs_to_match:
         # check if the phrase appears in source text
-        # iterate each word in source
-        match_flag, match_pos_idx = if_present_phrase(src_to_match, trg_to_match)
+        match_flag, match_pos_idx = if_present_phrase(src_index, trg_to_match)
 
         # check if it is duplicate, if true then ignore it
         if check_duplicate and '_'.join(trg_to_match) in phrase_set:
@@ -234,7 +263,9 @@ def evaluate_beam_search(generator, data_loader, opt, title='', epoch=1, predict
             print_out += 'Real Target String [%d] \n\t\t%s \n' % (len(trg_str_seqs), trg_str_seqs)
             print_out += 'Real Target Input:  \n\t\t%s \n' % str([[opt.id2word[x] for x in t] for t in trg])
             print_out += 'Real Target Copy:   \n\t\t%s \n' % str([[opt.id2word[x] if x < opt.vocab_size else oov[x - opt.vocab_size] for x in t] for t in trg_copy])
-            trg_str_is_present_flags, _ = if_present_duplicate_phrases(src_str, trg_str_seqs)
+            # the source is stemmed and indexed once for the targets and the predictions
+            src_index = PhraseIndex(stem_word_list(src_str))
+            trg_str_is_present_flags, _ = if_present_duplicate_phrases(src_index, trg_str_seqs)
 
             # ignore the cases that there's no present phrases
             if opt.must_appear_in_src and np.sum(trg_str_is_present_flags) == 0:
@@ -249,7 +280,7 @@ def evaluate_beam_search(generator, data_loader, opt, title='', epoch=1, predict
             pred_is_valid_flags, processed_pred_seqs, processed_pred_str_seqs, processed_pred_score = process_predseqs(pred_seq, oov, opt.id2word, opt)
             # 2nd filtering: if filter out phrases that don't appear in text, and keep unique ones after stemming
             if opt.must_appear_in_src:
-                pred_is_present_flags, _ = if_present_duplicate_phrases(src_str, processed_pred_str_seqs)
+                pred_is_present_flags, _ = if_present_duplicate_phrases(src_index, processed_pred_str_seqs)
                 filtered_trg_str_seqs = np.asarray(trg_str_seqs)[trg_str_is_present_flags]
             else:
                 pred_is_present_flags = [True] * len(processed_pred_str_seqs)
@@ -452,8 +483,13 @@ def evaluate_greedy(model, data_loader, test_examples, opt):
         logging.info('\t\tReal : %s ' % (sentence_real))
 
 
+@lru_cache(maxsize=2 ** 18)
+def stem_word(word):
+    return stemmer.stem(word.strip().lower())
+
+
 def stem_word_list(word_list):
-    return [stemmer.stem(w.strip().lower()) for w in word_list]
+    return [stem_word(w) for w in word_list]
 
 
 def macro_averaged_score(precisionlist, recalllist):
@@ -38,18 +38,18 @@ def main():
         logger.info('Running on CPU!')
 
     try:
-        valid_data_loaders, word2id, id2word, vocab = load_vocab_and_datasets_for_testing(dataset_names=opt.test_dataset_names, type='valid', opt=opt)
+        valid_data_loaders, word2id, id2word, _ = load_vocab_and_datasets_for_testing(dataset_names=opt.test_dataset_names, type='valid', opt=opt)
         test_data_loaders, _, _, _ = load_vocab_and_datasets_for_testing(dataset_names=opt.test_dataset_names, type='test', opt=opt)
 
         opt.word2id = word2id
         opt.id2word = id2word
-        opt.vocab = vocab
 
         model = init_model(opt).to(torch.device('cuda:0' if torch.cuda.is_available() else 'cpu'))
         generator = SequenceGenerator(model,
                                       eos_id=opt.word2id[pykp.io.EOS_WORD],
                                       beam_size=opt.beam_size,
-                                      max_sequence_length=opt.max_sent_length
+                                      max_sequence_length=opt.max_sent_length,
+                                      n_best=opt.n_best
                                       )
 
         '''
@@ -7,12 +7,16 @@ Be advised to run the remove_duplicates.py on raw json files (remove overlapping
 # -*- coding: utf-8 -*-
 
 import argparse
+import multiprocessing
 import os
+import shutil
 
 import torch
 
 import config
 import pykp.io
+import pykp.shards
+from pykp.vocab import SPECIAL_WORDS, Vocab
 
 parser = argparse.ArgumentParser(
     description='preprocess.py',
@@ -25,6 +29,12 @@ parser.add_argument('-source_dataset_dir', required=True,
                     help="The path to the source data (raw json).")
 parser.add_argument('-output_path_prefix', default='data',
                     help="Output file for the prepared data")
+parser.add_argument('-num_workers', type=int, default=multiprocessing.cpu_count(),
+                    help="Number of processes for tokenizing and numericalizing the data")
+parser.add_argument('-num_shards', type=int, default=None,
+                    help="Number of shards each json file is split into, default to 4 per worker")
+parser.add_argument('-subset_size', type=int, default=20000,
+                    help="Number of training examples of the small dataset")
 
 config.preprocess_opts(parser)
 opt = parser.parse_args()
@@ -66,88 +76,67 @@ def main():
         raise Exception('Unsupported dataset name=%s' % opt.dataset_name)
 
     print("Loading training/validation/test data...")
-    tokenized_train_pairs = pykp.io.load_src_trgs_pairs(source_json_path=opt.source_train_file,
-                                                        dataset_name=opt.dataset_name,
-                                                        src_fields=src_fields,
-                                                        trg_fields=trg_fields,
-                                                        opt=opt,
-                                                        valid_check=valid_check)
-
-    tokenized_valid_pairs = pykp.io.load_src_trgs_pairs(source_json_path=opt.source_valid_file,
-                                                        dataset_name=opt.dataset_name,
-                                                        src_fields=src_fields,
-                                                        trg_fields=trg_fields,
-                                                        opt=opt,
-                                                        valid_check=valid_check)
-
-    tokenized_test_pairs = pykp.io.load_src_trgs_pairs(source_json_path=opt.source_test_file,
-                                                       dataset_name=opt.dataset_name,
-                                                       src_fields=src_fields,
-                                                       trg_fields=trg_fields,
-                                                       opt=opt,
-                                                       valid_check=valid_check)
+    tokenized_shards = {}
+    tokenized_dirs = {}
+    vocab_counter = None
+    for data_type, source_file in [('train', opt.source_train_file),
+                                   ('valid', opt.source_valid_file),
+                                   ('test', opt.source_test_file)]:
+        tokenized_dirs[data_type] = os.path.join(opt.output_path, '%s.%s.tokenized' % (opt.dataset_name, data_type))
+        shard_paths, counter = pykp.shards.tokenize_json_file(source_file,
+                                                              src_fields=src_fields,
+                                                              trg_fields=trg_fields,
+                                                              opt=opt,
+                                                              work_dir=tokenized_dirs[data_type],
+                                                              valid_check=valid_check,
+                                                              num_workers=opt.num_workers,
+                                                              num_shards=opt.num_shards)
+        tokenized_shards[data_type] = shard_paths
+        if data_type == 'train':
+            vocab_counter = counter
 
     print("Building Vocab...")
-    word2id, id2word, vocab = pykp.io.build_vocab(tokenized_train_pairs, opt)
+    # the vocab table is built from the merged counts, the dicts are derived from it (same ids as pykp.io.build_vocab_from_counter)
+    vocab_table = Vocab.from_counter(vocab_counter)
+    word2id, id2word = vocab_table.word2id(), vocab_table.id2word()
+    vocab = {w: c for w, c in vocab_counter.items() if w not in SPECIAL_WORDS}
     print('Vocab size = %d' % len(vocab))
     if opt.vocab_size > len(vocab):
         opt.vocab_size = len(vocab)
         print('Reset vocab size to %d' % opt.vocab_size)
 
     print("Dumping dict to disk")
+    # the vocab table is saved along with the dicts, as 'xxx.vocab' for 'xxx.vocab.pt'
     opt.vocab_path = os.path.join(opt.subset_output_path, opt.dataset_name + '.vocab.pt')
     torch.save([word2id, id2word, vocab], open(opt.vocab_path, 'wb'))
+    vocab_table.save(opt.vocab_path[:-len('.pt')])
     opt.vocab_path = os.path.join(opt.output_path, opt.dataset_name + '.vocab.pt')
     torch.save([word2id, id2word, vocab], open(opt.vocab_path, 'wb'))
+    vocab_table.save(opt.vocab_path[:-len('.pt')])
 
-    print("Exporting a small dataset to %s (for debugging), "
-          "size of train/valid/test is 20000" % opt.subset_output_path)
-    pykp.io.process_and_export_dataset(tokenized_train_pairs[:20000],
-                                       word2id, id2word,
-                                       opt,
-                                       opt.subset_output_path,
-                                       dataset_name=opt.dataset_name,
-                                       data_type='train')
-
-    pykp.io.process_and_export_dataset(tokenized_valid_pairs,
-                                       word2id, id2word,
-                                       opt,
-                                       opt.subset_output_path,
-                                       dataset_name=opt.dataset_name,
-                                       data_type='valid',
-                                       include_original=True)
-
-    pykp.io.process_and_export_dataset(tokenized_test_pairs,
-                                       word2id, id2word,
-                                       opt,
-                                       opt.subset_output_path,
-                                       dataset_name=opt.dataset_name,
-                                       data_type='test',
-                                       include_original=True)
+    # only the words within vocab_size are needed for numericalizing the data, the others are OOV
+    vocab_table = Vocab.from_counter(vocab_counter, max_size=opt.vocab_size)
 
     print("Exporting complete dataset to %s" % opt.output_path)
-    pykp.io.process_and_export_dataset(tokenized_train_pairs,
-                                       word2id, id2word,
-                                       opt,
-                                       opt.output_path,
-                                       dataset_name=opt.dataset_name,
-                                       data_type='train')
-
-    pykp.io.process_and_export_dataset(tokenized_valid_pairs,
-                                       word2id, id2word,
-                                       opt,
-                                       opt.output_path,
-                                       dataset_name=opt.dataset_name,
-                                       data_type='valid',
-                                       include_original=True)
-
-    pykp.io.process_and_export_dataset(tokenized_test_pairs,
-                                       word2id, id2word,
-                                       opt,
-                                       opt.output_path,
-                                       dataset_name=opt.dataset_name,
-                                       data_type='test',
-                                       include_original=True)
+    for data_type in ['train', 'valid', 'test']:
+        pykp.shards.export_dataset(tokenized_shards[data_type],
+                                   vocab_table, id2word,
+                                   opt,
+                                   opt.output_path,
+                                   dataset_name=opt.dataset_name,
+                                   data_type=data_type,
+                                   include_original=(data_type != 'train'),
+                                   num_workers=opt.num_workers)
+        shutil.rmtree(tokenized_dirs[data_type])
+
+    # the small dataset is taken from the complete one, instead of processing the data again
+    print("Exporting a small dataset to %s (for debugging), "
+          "size of train is %d" % (opt.subset_output_path, opt.subset_size))
+    for data_type in ['train', 'valid', 'test']:
+        pykp.shards.export_subset(opt.output_path, opt.subset_output_path,
+                                  dataset_name=opt.dataset_name,
+                                  data_type=data_type,
+                                  num_examples=opt.subset_size if data_type == 'train' else None)
 
 
 if __name__ == "__main__":
@@ -10,6 +10,7 @@ import torch
 
 import config
 import pykp.io
+from pykp.vocab import Vocab, get_vocab_table_path
 
 
 parser = argparse.ArgumentParser(
@@ -37,6 +38,9 @@ def main():
     print(os.path.abspath(opt.vocab_path))
     word2id, id2word, vocab = torch.load(opt.vocab_path, 'rb')
     print('Vocab size = %d' % len(vocab))
+    if get_vocab_table_path(opt.vocab_path):
+        # numericalize with the memory-mapped vocab table instead of the dicts
+        word2id = Vocab.load(get_vocab_table_path(opt.vocab_path))
 
     for test_dataset_name in test_dataset_names:
         opt.source_train_file = os.path.join(opt.source_dataset_root_dir, test_dataset_name, '%s_training.json' % (test_dataset_name))
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar on-disk format of one2many keyphrase datasets.
+
+A dataset is a directory of flat numpy arrays that are memory-mapped when
+loaded, so examples are built from slices without reading the whole split:
+    meta.json                   number of examples, vocab size, include_original and the size and
+                                modification time of the .pt file the dataset was exported with
+    src.npy, src_oov.npy        int32 token ids of the sources, concatenated
+    src_offsets.npy             int64, src[src_offsets[i]:src_offsets[i+1]] is the source of example i
+    trg.npy, trg_copy.npy       int32 token ids of the targets, concatenated
+    trg_offsets.npy             int64, boundaries of each target in trg
+    trg_index.npy               int64, targets trg_index[i]..trg_index[i+1]-1 belong to example i
+    oov.npy, oov_offsets.npy    string ids of the OOV list of each example
+    strings.bin                 utf-8 string table, string_offsets.npy gives the byte boundaries
+    src_str.npy, trg_str.npy    string ids of the original tokens (only if include_original),
+                                aligned with src and trg
+"""
+import json
+import os
+import shutil
+
+import numpy as np
+
+__author__ = "Rui Meng"
+__email__ = "rui.meng@pitt.edu"
+
+FORMAT_VERSION = 1
+
+
+def get_columnar_path(data_path):
+    '''
+    Return the columnar dataset directory corresponding to a dataset path, i.e. the path itself if it is a
+    directory, or 'xxx.cols' for 'xxx.pt' if it exists and was exported from the current 'xxx.pt'.
+    Return None if there is no (up-to-date) columnar version.
+    '''
+    if os.path.isdir(data_path):
+        return data_path
+    if data_path.endswith('.pt'):
+        path = data_path[:-len('.pt')] + '.cols'
+        if os.path.isdir(path) and _is_exported_from(path, data_path):
+            return path
+    return None
+
+
+def remove_columnar_dataset(data_path):
+    '''
+    Delete the columnar version 'xxx.cols' of 'xxx.pt' if there is one, e.g. when 'xxx.pt' is exported again
+    without it
+    '''
+    path = data_path[:-len('.pt')] + '.cols'
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+
+
+def _source_stamp(data_path):
+    stat = os.stat(data_path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def _is_exported_from(path, data_path):
+    try:
+        with open(os.path.join(path, 'meta.json')) as f:
+            source = json.load(f).get('source')
+        return source == _source_stamp(data_path)
+    except (IOError, OSError, ValueError):
+        return False
+
+
+def stamp_columnar_dataset(path, data_path):
+    '''
+    Record data_path (its size and modification time) as the .pt file the columnar dataset at path corresponds to
+    '''
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    meta['source'] = _source_stamp(data_path)
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+
+def _offsets(lengths):
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets
+
+
+def export_columnar_dataset(one2many_examples, output_path, vocab_size, include_original=False, source_path=None):
+    '''
+    Write one2many examples (as returned by process_data_examples) in the columnar format
+    :param one2many_examples: list of dicts with keys src, src_oov, trg, trg_copy, oov_list (and src_str, trg_str)
+    :param output_path: the output directory
+    :param vocab_size: the vocab size used for numbering OOV words (oov_dict[w] = vocab_size + position in oov_list)
+    :param include_original: whether to store the original tokens
+    :param source_path: the .pt file the same examples were saved to, get_columnar_path() only prefers the columnar
+        dataset to it as long as it is unchanged
+    '''
+    if not os.path.exists(output_path):
+        os.makedirs(output_path)
+
+    string_ids = {}
+
+    def to_ids(words):
+        return [string_ids.setdefault(w, len(string_ids)) for w in words]
+
+    columns = {'src': [], 'src_oov': [], 'trg': [], 'trg_copy': [], 'oov': [], 'src_str': [], 'trg_str': []}
+    src_lens, trg_lens, trg_nums, oov_lens = [], [], [], []
+
+    for e in one2many_examples:
+        src_lens.append(len(e['src']))
+        columns['src'].extend(e['src'])
+        columns['src_oov'].extend(e['src_oov'])
+
+        trg_nums.append(len(e['trg']))
+        for t, tc in zip(e['trg'], e['trg_copy']):
+            trg_lens.append(len(t))
+            columns['trg'].extend(t)
+            columns['trg_copy'].extend(tc)
+
+        oov_lens.append(len(e['oov_list']))
+        columns['oov'].extend(to_ids(e['oov_list']))
+
+        if include_original:
+            columns['src_str'].extend(to_ids(e['src_str']))
+            for t in e['trg_str']:
+                columns['trg_str'].extend(to_ids(t))
+
+    for name, values in columns.items():
+        if name in ['src_str', 'trg_str'] and not include_original:
+            continue
+        np.save(os.path.join(output_path, name + '.npy'), np.asarray(values, dtype=np.int32))
+
+    np.save(os.path.join(output_path, 'src_offsets.npy'), _offsets(src_lens))
+    np.save(os.path.join(output_path, 'trg_offsets.npy'), _offsets(trg_lens))
+    np.save(os.path.join(output_path, 'trg_index.npy'), _offsets(trg_nums))
+    np.save(os.path.join(output_path, 'oov_offsets.npy'), _offsets(oov_lens))
+
+    # string table, in the order of string ids
+    encoded = [s.encode('utf-8') for s in sorted(string_ids, key=string_ids.get)]
+    with open(os.path.join(output_path, 'strings.bin'), 'wb') as f:
+        f.write(b''.join(encoded))
+    np.save(os.path.join(output_path, 'string_offsets.npy'), _offsets([len(s) for s in encoded]))
+
+    meta = {'format': FORMAT_VERSION,
+            'num_examples': len(one2many_examples),
+            'vocab_size': vocab_size,
+            'include_original': include_original}
+    if source_path is not None:
+        meta['source'] = _source_stamp(source_path)
+    with open(os.path.join(output_path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+
+class ColumnarExamples(object):
+    '''
+    Read-only sequence of the one2many examples of a columnar dataset, the arrays are memory-mapped
+    and each example is built from slices when accessed
+    '''
+    def __init__(self, path, include_original=False):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        assert self.meta['format'] == FORMAT_VERSION, 'Unsupported columnar format %s' % str(self.meta['format'])
+
+        self.vocab_size = self.meta['vocab_size']
+        self.include_original = include_original
+        if include_original and not self.meta['include_original']:
+            raise ValueError('%s does not contain the original texts' % path)
+
+        names = ['src', 'src_oov', 'src_offsets', 'trg', 'trg_copy', 'trg_offsets', 'trg_index',
+                 'oov', 'oov_offsets', 'string_offsets']
+        if include_original:
+            names += ['src_str', 'trg_str']
+        for name in names:
+            setattr(self, name, np.load(os.path.join(path, name + '.npy'), mmap_mode='r'))
+
+        self.strings = np.memmap(os.path.join(path, 'strings.bin'), dtype=np.uint8, mode='r') \
+            if self.string_offsets[-1] > 0 else np.zeros(0, dtype=np.uint8)
+
+    def __getstate__(self):
+        # re-open the mapping when unpickled (e.g. in loader workers) instead of copying the arrays
+        return {'path': self.path, 'include_original': self.include_original}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'], include_original=state['include_original'])
+
+    def __len__(self):
+        return self.meta['num_examples']
+
+    def _string(self, string_id):
+        return self.strings[self.string_offsets[string_id]:self.string_offsets[string_id + 1]].tobytes().decode('utf-8')
+
+    def _strings(self, string_ids):
+        return [self._string(i) for i in string_ids]
+
+    def num_trgs(self):
+        '''
+        Number of targets of each example, without building the examples
+        '''
+        return np.diff(self.trg_index)
+
+    def index(self):
+        '''
+        The index header of the dataset (see pykp.io.compute_dataset_index), read from the offset tables only
+        '''
+        num_trgs = self.num_trgs()
+        trg_lens = np.zeros(len(self), dtype=np.int64)
+        has_trgs = num_trgs > 0
+        if has_trgs.any():
+            trg_lens[has_trgs] = np.maximum.reduceat(np.diff(self.trg_offsets), self.trg_index[:-1][has_trgs])
+        return {'num_trgs': num_trgs,
+                'src_lens': np.diff(self.src_offsets),
+                'trg_lens': trg_lens}
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('example index out of range')
+
+        src_start, src_end = self.src_offsets[index], self.src_offsets[index + 1]
+        trg_bounds = self.trg_offsets[self.trg_index[index]:self.trg_index[index + 1] + 1]
+        oov_list = self._strings(self.oov[self.oov_offsets[index]:self.oov_offsets[index + 1]])
+
+        example = {}
+        example['src'] = self.src[src_start:src_end].tolist()
+        example['src_oov'] = self.src_oov[src_start:src_end].tolist()
+        example['trg'] = [self.trg[s:e].tolist() for s, e in zip(trg_bounds[:-1], trg_bounds[1:])]
+        example['trg_copy'] = [self.trg_copy[s:e].tolist() for s, e in zip(trg_bounds[:-1], trg_bounds[1:])]
+        example['oov_list'] = oov_list
+        example['oov_dict'] = {w: self.vocab_size + i for i, w in enumerate(oov_list)}
+
+        if self.include_original:
+            example['src_str'] = self._strings(self.src_str[src_start:src_end])
+            example['trg_str'] = [self._strings(self.trg_str[s:e]) for s, e in zip(trg_bounds[:-1], trg_bounds[1:])]
+
+        return example
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
@@ -3,19 +3,22 @@
 Large chunk borrowed from PyTorch DataLoader
 """
 
+import atexit
 import os
+import pickle
 
 __author__ = "Rui Meng"
 __email__ = "rui.meng@pitt.edu"
 
 import torch
 import torch.multiprocessing as multiprocessing
+from multiprocessing.reduction import ForkingPickler
 from torch.utils.data.sampler import SequentialSampler, RandomSampler, BatchSampler
 import collections
+import itertools
 import re
 import sys
 import traceback
-import threading
 
 if sys.version_info[0] == 2:
     string_classes = basestring
@@ -28,10 +31,14 @@ else:
     import queue
 
 import ctypes
+import numpy as np
 from ctypes.wintypes import DWORD, BOOL, HANDLE
 _use_shared_memory = False
 """Whether to use shared memory in default_collate"""
 
+MAX_SRC_LEN = 1000
+"""Sources are truncated to this length (BOS/EOS included) by KeyphraseDataset.collate_fn_one2many"""
+
 
 class ExceptionWrapper(object):
     "Wraps an exception plus traceback to communicate across threads"
@@ -41,8 +48,13 @@ class ExceptionWrapper(object):
         self.exc_msg = "".join(traceback.format_exception(*exc_info))
         
 class ManagerWatchdog(object):
-    def __init__(self):
-        self.manager_pid = os.getppid()
+    def __init__(self, manager_pid):
+        self.manager_pid = manager_pid
+        self.manager_dead = False
+
+        if os.name != 'nt':
+            return
+
         self.kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)
         self.kernel32.OpenProcess.argtypes = (DWORD, BOOL, DWORD)
         self.kernel32.OpenProcess.restype = HANDLE
@@ -56,54 +68,199 @@ class ManagerWatchdog(object):
         if not self.manager_handle:
             raise ctypes.WinError(ctypes.get_last_error())
 
-        self.manager_dead = False
-
     def is_alive(self):
         if not self.manager_dead:
-            self.manager_dead = self.kernel32.WaitForSingleObject(self.manager_handle, 0) == 0
+            if os.name == 'nt':
+                self.manager_dead = self.kernel32.WaitForSingleObject(self.manager_handle, 0) == 0
+            else:
+                # the worker is re-parented when the manager dies
+                self.manager_dead = os.getppid() != self.manager_pid
         return not self.manager_dead
-        
 
-def _worker_loop(dataset, index_queue, data_queue, collate_fn):
+
+MANAGER_STATUS_CHECK_INTERVAL = 5.0
+"""Interval (in seconds) of the liveness checks of the manager by the workers and of the workers by the manager"""
+
+# datasets and collate functions of the loaders in a worker, by loader id. Given to the worker when it starts,
+# and updated through its index queue
+_loader_registry = {}
+
+
+def _offload(dataset):
+    # lazy datasets are loaded for one pass only
+    if getattr(dataset, 'lazy_load', False):
+        dataset.offload_dataset()
+
+
+def _worker_loop(index_queue, data_queue, manager_pid, loaders):
     global _use_shared_memory
     _use_shared_memory = True
 
+    # the loaders registered before the pool started: inherited without copy with fork, pickled with spawn
+    _loader_registry.update(loaders)
+
     torch.set_num_threads(1)
-    watchdog = ManagerWatchdog()
+    watchdog = ManagerWatchdog(manager_pid)
     while watchdog.is_alive():
-        r = index_queue.get()
+        try:
+            r = index_queue.get(timeout=MANAGER_STATUS_CHECK_INTERVAL)
+        except queue.Empty:
+            continue
         if r is None:
-            data_queue.put(None)
             break
-        idx, batch_indices = r
+        if r[0] == 'register':
+            _, loader_id, payload = r
+            _loader_registry[loader_id] = pickle.loads(payload)
+            continue
+        if r[0] == 'unregister':
+            _loader_registry.pop(r[1], None)
+            continue
+        if r[0] == 'offload':
+            if r[1] in _loader_registry:
+                _offload(_loader_registry[r[1]][0])
+            continue
+
+        _, loader_id, iter_id, idx, batch_indices = r
         try:
+            dataset, collate_fn = _loader_registry[loader_id]
             samples = collate_fn([dataset[i] for i in batch_indices])
         except Exception:
-            data_queue.put((idx, ExceptionWrapper(sys.exc_info())))
+            data_queue.put((iter_id, idx, ExceptionWrapper(sys.exc_info())))
         else:
-            data_queue.put((idx, samples))
+            # tensors are moved to shared memory by the queue, only their handles are pickled
+            data_queue.put((iter_id, idx, samples))
             del samples
 
-def _pin_memory_loop(in_queue, out_queue, done_event):
-    while True:
-        try:
-            r = in_queue.get()
-        except Exception:
-            if done_event.is_set():
-                return
-            raise
-        if r is None:
-            break
-        if isinstance(r[1], ExceptionWrapper):
-            out_queue.put(r)
-            continue
-        idx, batch = r
-        try:
-            batch = pin_memory_batch(batch)
-        except Exception:
-            out_queue.put((idx, ExceptionWrapper(sys.exc_info())))
-        else:
-            out_queue.put((idx, batch))
+
+class WorkerPool(object):
+    """
+    Worker processes shared by the loaders and kept across epochs. Each worker has its own index queue, batches
+    are returned with the id of their iterator through a common data queue, tensors going through shared memory.
+    The datasets are registered in the workers once: passed to the worker processes when the pool starts after
+    the loader is created (without copy with the fork start method), sent through the index queues otherwise.
+    """
+
+    def __init__(self, num_workers):
+        self.num_workers = num_workers
+        # datasets and collate functions of the registered loaders, by loader id
+        self.loaders = {}
+        self.workers = []
+        self.index_queues = []
+        self.data_queue = None
+        self.started = False
+        self.shutdown = False
+
+        self.next_worker = 0
+        self.next_iter_id = 0
+        # results received for other active iterators than the one being read
+        self.pending = {}
+
+    def start(self):
+        if self.started:
+            return
+        self.started = True
+        self.data_queue = multiprocessing.Queue()
+        for _ in range(self.num_workers):
+            index_queue = multiprocessing.Queue()
+            w = multiprocessing.Process(target=_worker_loop,
+                                        args=(index_queue, self.data_queue, os.getpid(), dict(self.loaders)))
+            w.daemon = True  # ensure that the worker exits on process exit
+            w.start()
+            self.index_queues.append(index_queue)
+            self.workers.append(w)
+
+    def register(self, loader_id, dataset, collate_fn):
+        self.loaders[loader_id] = (dataset, collate_fn)
+        if self.started:
+            # pickled once for all the workers, and here so that errors are raised in the main process
+            payload = bytes(ForkingPickler.dumps((dataset, collate_fn)))
+            for index_queue in self.index_queues:
+                index_queue.put(('register', loader_id, payload))
+
+    def unregister(self, loader_id):
+        self.loaders.pop(loader_id, None)
+        if self.started and not self.shutdown:
+            for index_queue in self.index_queues:
+                index_queue.put(('unregister', loader_id))
+
+    def new_iterator(self):
+        self.start()
+        iter_id = self.next_iter_id
+        self.next_iter_id += 1
+        self.pending[iter_id] = []
+        return iter_id
+
+    def offload(self, loader_id):
+        for index_queue in self.index_queues:
+            index_queue.put(('offload', loader_id))
+
+    def close_iterator(self, iter_id):
+        # the results still in flight are dropped when received
+        self.pending.pop(iter_id, None)
+
+    def put(self, loader_id, iter_id, idx, batch_indices):
+        self.index_queues[self.next_worker].put(('batch', loader_id, iter_id, idx, batch_indices))
+        self.next_worker = (self.next_worker + 1) % self.num_workers
+
+    def get(self, iter_id):
+        if self.pending[iter_id]:
+            return self.pending[iter_id].pop(0)
+        while True:
+            try:
+                r_iter_id, idx, batch = self.data_queue.get(timeout=MANAGER_STATUS_CHECK_INTERVAL)
+            except queue.Empty:
+                self._check_workers()
+                continue
+            except Exception:
+                # a worker dying while writing to the data queue breaks it (e.g. ConnectionResetError),
+                # the pool can't be used anymore. Wait a little for the worker to exit so that it is reported
+                for w in self.workers:
+                    w.join(timeout=0.1)
+                self._check_workers()
+                self.close()
+                raise
+            if r_iter_id == iter_id:
+                return idx, batch
+            if r_iter_id in self.pending:
+                self.pending[r_iter_id].append((idx, batch))
+
+    def _check_workers(self):
+        failed = [w for w in self.workers if not w.is_alive()]
+        if failed:
+            self.close()
+            raise RuntimeError('DataLoader worker (pid(s) %s) exited unexpectedly'
+                               % ', '.join(str(w.pid) for w in failed))
+
+    def close(self):
+        if not self.started or self.shutdown:
+            return
+        self.shutdown = True
+        for index_queue in self.index_queues:
+            index_queue.put(None)
+        for w in self.workers:
+            w.join(timeout=MANAGER_STATUS_CHECK_INTERVAL)
+            if w.is_alive():
+                w.terminate()
+
+
+_worker_pools = {}
+
+
+def get_worker_pool(num_workers):
+    """The worker pool of a given size shared by all the loaders, started at the first iteration."""
+    pool = _worker_pools.get(num_workers)
+    if pool is None or pool.shutdown:
+        pool = _worker_pools[num_workers] = WorkerPool(num_workers)
+    return pool
+
+
+def shutdown_worker_pools():
+    for pool in _worker_pools.values():
+        pool.close()
+    _worker_pools.clear()
+
+
+atexit.register(shutdown_worker_pools)
 
 
 numpy_type_map = {
@@ -181,41 +338,27 @@ class DataLoaderIter(object):
         self.batch_sampler = loader.batch_sampler
         self.num_workers = loader.num_workers
         self.pin_memory = loader.pin_memory
-        self.done_event = threading.Event()
+        self.offload_dataset = loader.offload_dataset
 
         self.sample_iter = iter(self.batch_sampler)
 
         if self.num_workers > 0:
-            self.index_queue = multiprocessing.SimpleQueue()
-            self.data_queue = multiprocessing.SimpleQueue()
+            if loader.worker_pool.shutdown:
+                # the pool was closed (e.g. after a worker failure), the loader moves to a new one
+                loader.worker_pool = get_worker_pool(self.num_workers)
+                loader.worker_pool.register(loader.loader_id, loader.dataset, loader.collate_fn)
+            self.pool = loader.worker_pool
+            self.loader_id = loader.loader_id
+            self.iter_id = self.pool.new_iterator()
+            self.max_outstanding = loader.prefetch_factor * self.num_workers
             self.batches_outstanding = 0
             self.shutdown = False
             self.send_idx = 0
             self.rcvd_idx = 0
             self.reorder_dict = {}
-            
-            self.workers = [
-                multiprocessing.Process(
-                    target=_worker_loop,
-                    args=(self.dataset, self.index_queue, self.data_queue, self.collate_fn))
-                for _ in range(self.num_workers)]
-            
-                
-            for w in self.workers:
-                w.daemon = True  # ensure that the worker exits on process exit
-                w.start()
-
-            if self.pin_memory:
-                in_data = self.data_queue
-                self.data_queue = queue.Queue()
-                self.pin_thread = threading.Thread(
-                    target=_pin_memory_loop,
-                    args=(in_data, self.data_queue, self.done_event))
-                self.pin_thread.daemon = True
-                self.pin_thread.start()
 
             # prime the prefetch loop
-            for _ in range(2 * self.num_workers):
+            for _ in range(self.max_outstanding):
                 self._put_indices()
 
     def __len__(self):
@@ -223,7 +366,10 @@ class DataLoaderIter(object):
 
     def __next__(self):
         if self.num_workers == 0:  # same-process loading
-            indices = next(self.sample_iter)  # may raise StopIteration
+            indices = next(self.sample_iter, None)
+            if indices is None:
+                _offload(self.dataset)
+                raise StopIteration
             batch = self.collate_fn([self.dataset[i] for i in indices])
             if self.pin_memory:
                 batch = pin_memory_batch(batch)
@@ -236,11 +382,14 @@ class DataLoaderIter(object):
 
         if self.batches_outstanding == 0:
             self._shutdown_workers()
+            if self.offload_dataset:
+                self.pool.offload(self.loader_id)
+                _offload(self.dataset)
             raise StopIteration
 
         while True:
             assert (not self.shutdown and self.batches_outstanding > 0)
-            idx, batch = self.data_queue.get()
+            idx, batch = self.pool.get(self.iter_id)
             self.batches_outstanding -= 1
             if idx != self.rcvd_idx:
                 # store out-of-order samples
@@ -254,11 +403,11 @@ class DataLoaderIter(object):
         return self
 
     def _put_indices(self):
-        assert self.batches_outstanding < 2 * self.num_workers
+        assert self.batches_outstanding < self.max_outstanding
         indices = next(self.sample_iter, None)
         if indices is None:
             return
-        self.index_queue.put((self.send_idx, indices))
+        self.pool.put(self.loader_id, self.iter_id, self.send_idx, indices)
         self.batches_outstanding += 1
         self.send_idx += 1
 
@@ -266,7 +415,10 @@ class DataLoaderIter(object):
         self.rcvd_idx += 1
         self._put_indices()
         if isinstance(batch, ExceptionWrapper):
+            self._shutdown_workers()
             raise batch.exc_type(batch.exc_msg)
+        if self.pin_memory:
+            batch = pin_memory_batch(batch)
         return batch
 
     def __getstate__(self):
@@ -277,11 +429,10 @@ class DataLoaderIter(object):
         raise NotImplementedError("DataLoaderIterator cannot be pickled")
 
     def _shutdown_workers(self):
+        # the workers are kept for the next iterations, only this iterator is closed
         if not self.shutdown:
             self.shutdown = True
-            self.done_event.set()
-            for _ in self.workers:
-                self.index_queue.put(None)
+            self.pool.close_iterator(self.iter_id)
 
     def __del__(self):
         if self.num_workers > 0:
@@ -314,19 +465,44 @@ class KeyphraseDataLoader(object):
             if the dataset size is not divisible by the batch size. If ``False`` and
             the size of dataset is not divisible by the batch size, then the last batch
             will be smaller. (default: False)
+        prefetch_factor (int, optional): number of batches loaded in advance by each
+            worker (default: 2)
+
+    The worker processes are shared by the loaders with the same num_workers and kept
+    across epochs (see WorkerPool), they are stopped at exit or by shutdown_worker_pools().
     """
 
+    _loader_ids = itertools.count()
+
     def __init__(self, dataset, max_batch_example=5, max_batch_pair=1, shuffle=False, sampler=None, batch_sampler=None,
-                 num_workers=0, collate_fn=default_collate, pin_memory=False, drop_last=False):
+                 num_workers=0, collate_fn=default_collate, pin_memory=False, drop_last=False,
+                 max_batch_tokens=None, bucket_size=None, prefetch_factor=2):
         self.dataset            = dataset
-        # used for generating one2many batches
-        self.num_trgs           = [len(e['trg']) for e in dataset.get_examples()]
+        # used for generating one2many batches: number of targets, padded source length and padded target length,
+        # taken from the index header of the dataset so lazy datasets are not loaded
+        index                   = dataset.get_index()
+        self.num_trgs           = index['num_trgs'].tolist()
+        self.src_lens           = np.minimum(index['src_lens'] + 2, MAX_SRC_LEN).tolist()
+        self.trg_lens           = (index['trg_lens'] + 2).tolist()
         self.batch_size         = max_batch_pair
         self.max_example_number = max_batch_example
         self.num_workers        = num_workers
         self.collate_fn         = collate_fn
         self.pin_memory         = pin_memory
         self.drop_last          = drop_last
+        self.prefetch_factor    = prefetch_factor
+
+        self.loader_id          = next(KeyphraseDataLoader._loader_ids)
+        self.worker_pool        = None
+        # lazy datasets are loaded for one pass only. With workers, a dataset which is not memory-mapped would be
+        # loaded in full by every worker on each pass, so it is loaded once here and the workers get it when registered
+        lazy_load               = getattr(dataset, 'lazy_load', False)
+        self.offload_dataset    = lazy_load and (num_workers == 0 or getattr(dataset, 'columnar_path', None) is not None)
+        if lazy_load and not self.offload_dataset:
+            dataset.get_examples()
+        if num_workers > 0:
+            self.worker_pool = get_worker_pool(num_workers)
+            self.worker_pool.register(self.loader_id, dataset, collate_fn)
         
         if batch_sampler is not None:
             if max_batch_pair > 1 or shuffle or sampler is not None or drop_last:
@@ -338,12 +514,13 @@ class KeyphraseDataLoader(object):
 
         if batch_sampler is None:
             if sampler is None:
-                if shuffle:
-                    sampler = RandomSampler(dataset)
-                else:
-                    sampler = SequentialSampler(dataset)
-
-        batch_sampler = One2ManyBatchSampler(sampler, self.num_trgs, max_batch_example=max_batch_example, max_batch_pair=max_batch_pair, drop_last=drop_last)
+                # examples of similar lengths are batched together, in a new order at every epoch if shuffle
+                batch_sampler = BucketBatchSampler(self.num_trgs, self.src_lens, self.trg_lens,
+                                                   max_batch_example=max_batch_example, max_batch_pair=max_batch_pair,
+                                                   max_batch_tokens=max_batch_tokens, bucket_size=bucket_size,
+                                                   shuffle=shuffle, drop_last=drop_last)
+            else:
+                batch_sampler = One2ManyBatchSampler(sampler, self.num_trgs, max_batch_example=max_batch_example, max_batch_pair=max_batch_pair, drop_last=drop_last)
 
         self.sampler = sampler
         self.batch_sampler = batch_sampler
@@ -357,6 +534,10 @@ class KeyphraseDataLoader(object):
     def one2one_number(self):
         return sum(self.num_trgs)
 
+    def __del__(self):
+        if getattr(self, 'worker_pool', None) is not None:
+            self.worker_pool.unregister(self.loader_id)
+
 class One2ManyBatchSampler(object):
     """Wraps another sampler to yield a mini-batch of indices.
     Return batches of one2many pairs of which the sum of target sequences should not exceed the batch_size
@@ -386,27 +567,9 @@ class One2ManyBatchSampler(object):
         self.max_batch_example  = max_batch_example
         self.drop_last          = drop_last
 
-        batches = []
-        batch = []
-        
-        for idx in self.sampler:
-            # number of targets sequences in current batch
-            number_trgs = sum([self.num_trgs[id] for id in batch])
-            if len(batch) < self.max_batch_example and number_trgs + self.num_trgs[idx] < self.max_batch_pair:
-                batch.append(idx)
-            elif len(batch) == 0: # if the batch_size is very small, return a batch of only one data sample
-                batch.append(idx)
-                batches.append(batch)
-                # print('batch %d: #(src)=%d, #(trg)=%d \t\t %s' % (len(batches), len(batch), number_trgs, str(batch)))
-                batch = []
-            else:
-                batches.append(batch)
-                # print('batch %d: #(src)=%d, #(trg)=%d \t\t %s' % (len(batches), len(batch), number_trgs, str(batch)))
-                batch = []
-                batch.append(idx)
-
-        if len(batch) > 0 and not self.drop_last:
-            batches.append(batch)
+        batches = fill_batches(self.sampler, self.num_trgs, None, None,
+                               max_batch_example=self.max_batch_example, max_batch_pair=self.max_batch_pair,
+                               drop_last=self.drop_last)
 
         self.batches         = batches
         self.final_num_batch = len(batches)
@@ -418,3 +581,109 @@ class One2ManyBatchSampler(object):
     def __len__(self):
         return self.final_num_batch
 
+
+def fill_batches(indices, num_trgs, src_lens, trg_lens, max_batch_example, max_batch_pair, max_batch_tokens=None,
+                 drop_last=False):
+    """Greedily group indices (in the given order) into batches with less than max_batch_example examples,
+    less than max_batch_pair targets and, if max_batch_tokens is given, at most max_batch_tokens padded tokens
+    (number of one2one pairs times the longest source plus the longest target).
+    An example exceeding the limits alone makes a batch of its own.
+    """
+    batches = []
+    batch = []
+    # running sums of the current batch
+    number_trgs = 0
+    max_src_len = 0
+    max_trg_len = 0
+
+    for idx in indices:
+        fits = len(batch) < max_batch_example and number_trgs + num_trgs[idx] < max_batch_pair
+        if fits and max_batch_tokens is not None:
+            padded_tokens = (number_trgs + num_trgs[idx]) * (max(max_src_len, src_lens[idx]) + max(max_trg_len, trg_lens[idx]))
+            fits = padded_tokens <= max_batch_tokens
+
+        if fits:
+            batch.append(idx)
+            number_trgs += num_trgs[idx]
+        elif len(batch) == 0: # if the batch_size is very small, return a batch of only one data sample
+            batches.append([idx])
+            continue
+        else:
+            batches.append(batch)
+            batch = [idx]
+            number_trgs = num_trgs[idx]
+            max_src_len = max_trg_len = 0
+
+        if max_batch_tokens is not None:
+            max_src_len = max(max_src_len, src_lens[idx])
+            max_trg_len = max(max_trg_len, trg_lens[idx])
+
+    if len(batch) > 0 and not drop_last:
+        batches.append(batch)
+
+    return batches
+
+
+class BucketBatchSampler(object):
+    """Yield batches of one2many examples of similar lengths.
+    At every epoch, the examples are shuffled and split into buckets of bucket_size examples, each bucket is
+    sorted by source length and cut into batches (see fill_batches), then the order of batches is shuffled.
+    Without shuffle, examples are batched in their order.
+    Batches are limited by number of examples and targets as in One2ManyBatchSampler, and by number of padded
+    tokens if max_batch_tokens is given.
+
+    Args:
+        num_trgs (list of int): Number of target sequences for each example
+        src_lens (list of int): Padded length of the source of each example
+        trg_lens (list of int): Padded length of the longest target of each example
+        max_batch_example (int): Upper bound (excluded) of the number of examples in a batch
+        max_batch_pair (int): Upper bound (excluded) of the number of targets in a batch
+        max_batch_tokens (int): Maximum number of padded tokens in a batch, no limit if None
+        bucket_size (int): Number of examples per bucket, default to 50 batches of max_batch_example
+        shuffle (bool): Whether to reshuffle the buckets and batches at every epoch
+        drop_last (bool): If ``True``, the sampler will drop the last batch if it is not full (with shuffle,
+            the last batch of the last bucket, before the batches are shuffled)
+    """
+
+    def __init__(self, num_trgs, src_lens, trg_lens, max_batch_example, max_batch_pair,
+                 max_batch_tokens=None, bucket_size=None, shuffle=True, drop_last=False):
+        self.num_trgs           = num_trgs
+        self.src_lens           = np.asarray(src_lens)
+        self.trg_lens           = trg_lens
+        self.max_batch_example  = max_batch_example
+        self.max_batch_pair     = max_batch_pair
+        self.max_batch_tokens   = max_batch_tokens
+        self.bucket_size        = bucket_size if bucket_size is not None else 50 * max_batch_example
+        self.shuffle            = shuffle
+        self.drop_last          = drop_last
+
+        # the batches of the next epoch, generated in advance to know their number
+        self.batches = self._make_batches()
+
+    def _make_batches(self):
+        def fill(indices, drop_last=False):
+            return fill_batches(indices, self.num_trgs, self.src_lens, self.trg_lens,
+                                max_batch_example=self.max_batch_example, max_batch_pair=self.max_batch_pair,
+                                max_batch_tokens=self.max_batch_tokens, drop_last=drop_last)
+
+        if not self.shuffle:
+            return fill(range(len(self.num_trgs)), drop_last=self.drop_last)
+
+        order = np.random.permutation(len(self.num_trgs))
+        batches = []
+        for start in range(0, len(order), self.bucket_size):
+            bucket = order[start: start + self.bucket_size]
+            bucket = bucket[np.argsort(self.src_lens[bucket], kind='mergesort')]
+            # the last batch of the epoch is the last one of the last bucket
+            is_last = start + self.bucket_size >= len(order)
+            batches.extend(fill(bucket.tolist(), drop_last=self.drop_last and is_last))
+
+        return [batches[i] for i in np.random.permutation(len(batches))]
+
+    def __iter__(self):
+        batches = self.batches
+        self.batches = self._make_batches()
+        return iter(batches)
+
+    def __len__(self):
+        return len(self.batches)
@@ -3,6 +3,8 @@
 Python File Template 
 """
 import codecs
+import gzip
+import hashlib
 import inspect
 import itertools
 import json
@@ -16,6 +18,8 @@ import numpy as np
 from torch.autograd import Variable
 
 from evaluate import if_present_duplicate_phrases, if_present_phrase
+from pykp.columnar import ColumnarExamples, export_columnar_dataset, get_columnar_path, remove_columnar_dataset
+from pykp.vocab import Vocab
 
 __author__ = "Rui Meng"
 __email__ = "rui.meng@pitt.edu"
@@ -30,6 +34,12 @@ EOS_WORD = '</s>'
 DIGIT = '<digit>'
 SEP_WORD = '<sep>'
 
+# bump when copyseq_tokenize or tokenize_filter_data change, to invalidate the tokenization caches
+TOKENIZER_VERSION = 1
+# options of tokenize_filter_data, part of the tokenization cache key
+TOKENIZATION_OPTIONS = ['lower', 'src_seq_length_trunc', 'trg_seq_length_trunc',
+                        'max_src_seq_length', 'min_src_seq_length', 'max_trg_seq_length', 'min_trg_seq_length']
+
 
 def __getstate__(self):
     return dict(self.__dict__, stoi=dict(self.stoi))
@@ -44,6 +54,33 @@ torchtext.vocab.Vocab.__getstate__ = __getstate__
 torchtext.vocab.Vocab.__setstate__ = __setstate__
 
 
+class One2OneExamples(object):
+    '''
+    Read-only sequence of one2one examples, each one being a view of one target of a one2many example
+    :param one2many_examples: the one2many examples
+    :param one2one_index: array of shape (n, 2), the one2many example and the target index of each one2one example
+    '''
+    def __init__(self, one2many_examples, one2one_index):
+        self.one2many_examples = one2many_examples
+        self.one2one_index = one2one_index
+
+    def __len__(self):
+        return len(self.one2one_index)
+
+    def __getitem__(self, index):
+        example_id, target_id = self.one2one_index[index]
+        one2many_example = self.one2many_examples[int(example_id)]
+
+        one2one_example = {}
+        for k, v in one2many_example.items():
+            one2one_example[k] = v[target_id] if k in ['trg', 'trg_copy', 'trg_str'] else v
+        return one2one_example
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+
 class KeyphraseDataset(torch.utils.data.Dataset):
     def __init__(self, data_path, word2id, id2word,
                  type='one2many',
@@ -57,17 +94,43 @@ class KeyphraseDataset(torch.utils.data.Dataset):
         self.type = type
         self.include_original = include_original
 
+        # a columnar version of the dataset (see pykp.columnar) is memory-mapped instead of being unpickled
+        self.columnar_path = get_columnar_path(data_path) if type == 'one2many' else None
+
         self._examples = None
-        if self.lazy_load:
+        # per-example target counts, source and target lengths, see get_index()
+        self._index = None
+        if self.columnar_path:
+            print('Memory-mapping data from %s' % self.columnar_path)
+            self._load_examples()
+        elif self.lazy_load:
             print('Data will be loaded while needed from %s' % data_path)
         else:
             print('Loading data from %s' % data_path)
             self._load_examples()
 
     def _load_examples(self):
+        if self.columnar_path:
+            self._examples = ColumnarExamples(self.columnar_path, include_original=self.include_original)
+            return
+
         print(self.data_path)
-        one2many_examples = torch.load(self.data_path, 'rb')
-        
+        examples = torch.load(self.data_path, 'rb')
+
+        # one2one examples are stored as references to the targets of the one2many examples
+        if isinstance(examples, dict) and 'one2one_index' in examples:
+            one2many_path = os.path.join(os.path.dirname(self.data_path), examples['one2many'])
+            columnar_path = get_columnar_path(one2many_path)
+            if columnar_path:
+                one2many_examples = ColumnarExamples(columnar_path, include_original=self.include_original)
+            else:
+                one2many_examples = self._filter_examples(torch.load(one2many_path, 'rb'))
+            self._examples = One2OneExamples(one2many_examples, examples['one2one_index'])
+            return
+
+        self._examples = self._filter_examples(examples)
+
+    def _filter_examples(self, one2many_examples):
         # keys of matter. `src_oov_map` is for mapping pointed word to dict, `oov_dict` is for determining the dim of predicted logit: dim=vocab_size+max_oov_dict_in_batch
         keys = ['src', 'trg', 'trg_copy', 'src_oov', 'oov_dict', 'oov_list']
 
@@ -92,14 +155,64 @@ class KeyphraseDataset(torch.utils.data.Dataset):
 
             filtered_examples.append(filtered_example)
 
-        self._examples = filtered_examples
-        
+        return filtered_examples
 
     def get_examples(self):
         if self._examples == None:
             self._load_examples()
         return self._examples
 
+    def get_index(self):
+        '''
+        The index header of a one2many dataset (number of targets, source length and longest target length
+        of each example), read from the columnar offsets or the .index.npz file written at export, so that
+        batches can be planned without loading the examples. Computed from the examples for older datasets
+        '''
+        if self._index is None:
+            index_path = dataset_index_path(self.data_path)
+            if self.columnar_path:
+                examples = self._examples if self._examples is not None else ColumnarExamples(self.columnar_path)
+                self._index = examples.index()
+            elif self.type == 'one2many' and os.path.exists(index_path):
+                with np.load(index_path) as index:
+                    self._index = {k: index[k] for k in DATASET_INDEX_KEYS}
+            elif self.type == 'one2one' and self._examples is None:
+                self._index = self._one2one_index()
+            if self._index is None:
+                self._index = compute_dataset_index(self.get_examples(), type=self.type)
+        return self._index
+
+    def _one2one_index(self):
+        '''
+        The index header of a one2one dataset, derived from its one2one_index and the target lengths of its one2many
+        examples (columnar offsets or .index.npz). None if the one2many examples have no target lengths (older datasets)
+        '''
+        header = torch.load(self.data_path, 'rb')
+        if not (isinstance(header, dict) and 'one2one_index' in header):
+            return None
+
+        one2many_path = os.path.join(os.path.dirname(self.data_path), header['one2many'])
+        columnar_path = get_columnar_path(one2many_path)
+        if columnar_path:
+            one2many_examples = ColumnarExamples(columnar_path)
+            src_lens = np.diff(one2many_examples.src_offsets)
+            first_trgs = np.asarray(one2many_examples.trg_index[:-1])
+            all_trg_lens = np.diff(one2many_examples.trg_offsets)
+        else:
+            index_path = dataset_index_path(one2many_path)
+            if not os.path.exists(index_path):
+                return None
+            with np.load(index_path) as index:
+                if 'all_trg_lens' not in index:
+                    return None
+                src_lens, num_trgs, all_trg_lens = index['src_lens'], index['num_trgs'], index['all_trg_lens']
+            first_trgs = np.cumsum(num_trgs) - num_trgs
+
+        example_ids, target_ids = header['one2one_index'][:, 0], header['one2one_index'][:, 1]
+        return {'num_trgs': np.ones(len(example_ids), dtype=np.int64),
+                'src_lens': src_lens[example_ids].astype(np.int64),
+                'trg_lens': all_trg_lens[first_trgs[example_ids] + target_ids].astype(np.int64)}
+
     def offload_dataset(self):
         # print('Offloading dataset %s:' % self.data_path)
         self._examples = None
@@ -108,22 +221,36 @@ class KeyphraseDataset(torch.utils.data.Dataset):
         return self.get_examples()[index]
 
     def __len__(self):
+        if self._examples is None:
+            return len(self.get_index()['num_trgs'])
         return len(self.get_examples())
 
     def _pad(self, x_raw):
-        x_raw = np.asarray(x_raw)
+        '''
+        Pad a list of sequences into a single preallocated LongTensor, filled in one masked assignment
+        :return: the padded tensor (batch_size, max_length), the lengths and the mask (1 for tokens, 0 for padding)
+        '''
         x_lens = [len(x_) for x_ in x_raw]
         max_length = max(x_lens)  # (deprecated) + 1 to ensure at least one padding appears in the end
         # x_lens = [x_len + 1 for x_len in x_lens]
-        x = np.array([np.concatenate((x_, [self.pad_id] * (max_length - len(x_)))) for x_ in x_raw])
-        x = Variable(torch.stack([torch.from_numpy(x_) for x_ in x], 0)).type('torch.LongTensor')
-        x_mask = np.array([[1] * x_len + [0] * (max_length - x_len) for x_len in x_lens])
-        x_mask = Variable(torch.stack([torch.from_numpy(m_) for m_ in x_mask], 0))
+        x_mask = torch.arange(max_length).unsqueeze(0) < torch.LongTensor(x_lens).unsqueeze(1)
+        x = torch.full((len(x_raw), max_length), self.pad_id, dtype=torch.long)
+        x[x_mask] = torch.LongTensor(list(itertools.chain.from_iterable(x_raw)))
+        x = Variable(x)
+        x_mask = Variable(x_mask.long())
 
         assert x.size(1) == max_length
 
         return x, x_lens, x_mask
 
+    def _select_rows(self, x, x_lens, index):
+        '''
+        Select rows of a padded tensor (see _pad), the padding is cut to the longest selected row
+        '''
+        lens = [x_lens[i] for i in index]
+        x = x.index_select(0, Variable(torch.LongTensor(index)))
+        return x[:, :max(lens)], lens
+
     def collate_fn_one2one(self, batches):
         '''
         Puts each data field into a tensor with outer dimension batch size"
@@ -133,13 +260,13 @@ class KeyphraseDataset(torch.utils.data.Dataset):
         trg = [[self.word2id[BOS_WORD]] + b['trg'] + [self.word2id[EOS_WORD]] for b in batches]
 
         # target_for_loss: input to criterion, if it's copy model, oovs are replaced with temporary idx, e.g. 50000, 50001 etc.)
-        trg_target = [b['trg'] + [self.word2id[EOS_WORD]] for b in batches]
         trg_copy_target = [b['trg_copy'] + [self.word2id[EOS_WORD]] for b in batches]
         # extended src (unk words are replaced with temporary idx, e.g. 50000, 50001 etc.)
         src_ext = [[self.word2id[BOS_WORD]] + b['src_oov'] + [self.word2id[EOS_WORD]] for b in batches]
         src, src_lens, src_mask = self._pad(src)
         trg, _, _ = self._pad(trg)
-        trg_target, _, _ = self._pad(trg_target)
+        # trg_target is trg without BOS, padded to the same length
+        trg_target = trg[:, 1:].contiguous()
         trg_copy_target, _, _ = self._pad(trg_copy_target)
         src_ext, src_ext_lens, src_ext_mask = self._pad(src_ext)
 
@@ -155,8 +282,6 @@ class KeyphraseDataset(torch.utils.data.Dataset):
         # target_input: input to decoder, starts with BOS and oovs are replaced with <unk>
         trg = [[[self.word2id[BOS_WORD]] + t + [self.word2id[EOS_WORD]] for t in b['trg']] for b in batches]
 
-        # target_for_loss: input to criterion
-        trg_target = [[t + [self.word2id[EOS_WORD]] for t in b['trg']] for b in batches]
         # target for copy model, oovs are replaced with temporary idx, e.g. 50000, 50001 etc.)
         trg_copy_target = [[t + [self.word2id[EOS_WORD]] for t in b['trg_copy']] for b in batches]
         oov_lists = [b['oov_list'] for b in batches]
@@ -176,7 +301,6 @@ class KeyphraseDataset(torch.utils.data.Dataset):
         src_oov = [s if len(s) < 1000 else s[:1000] for s in src_oov]
 
         trg = [trg[i] for i in src_len_order]
-        trg_target = [trg_target[i] for i in src_len_order]
         trg_copy_target = [trg_copy_target[i] for i in src_len_order]
         oov_lists = [oov_lists[i] for i in src_len_order]
         if self.include_original:
@@ -191,13 +315,15 @@ class KeyphraseDataset(torch.utils.data.Dataset):
         trg_copy_target_o2m = trg_copy_target
         oov_lists_o2m = oov_lists
 
-        # unfold the one2many pairs and pad the one2one variables
-        src_o2o, src_o2o_len, _ = self._pad(list(itertools.chain(*[[src[idx]] * len(t) for idx, t in enumerate(trg)])))
-        src_oov_o2o, _, _ = self._pad(list(itertools.chain(*[[src_oov[idx]] * len(t) for idx, t in enumerate(trg)])))
+        # unfold the one2many pairs: the one2one sources are rows of the padded one2many sources, one per target
+        o2o_index = [idx for idx, t in enumerate(trg) for _ in t]
+        src_o2o, src_o2o_len = self._select_rows(src_o2m, src_o2m_len, o2o_index)
+        src_oov_o2o, _ = self._select_rows(src_oov_o2m, src_o2m_len, o2o_index)
         trg_o2o, _, _ = self._pad(list(itertools.chain(*[t for t in trg])))
-        trg_target_o2o, _, _ = self._pad(list(itertools.chain(*[t for t in trg_target])))
+        # trg_target is trg without BOS, padded to the same length
+        trg_target_o2o = trg_o2o[:, 1:].contiguous()
         trg_copy_target_o2o, _, _ = self._pad(list(itertools.chain(*[t for t in trg_copy_target])))
-        oov_lists_o2o = list(itertools.chain(*[[oov_lists[idx]] * len(t) for idx, t in enumerate(trg)]))
+        oov_lists_o2o = [oov_lists[idx] for idx in o2o_index]
 
         assert (len(src) == len(src_o2m) == len(src_oov_o2m) == len(trg_copy_target_o2m) == len(oov_lists_o2m))
         assert (sum([len(t) for t in trg]) == len(src_o2o) == len(src_oov_o2o) == len(trg_copy_target_o2o) == len(oov_lists_o2o))
@@ -273,16 +399,23 @@ def load_json_data(path, name='kp20k', src_fields=['title', 'abstract'], trg_fie
             # if(idx == 20000):
             #     break
             # print(line)
-            json_ = json.loads(line)
-
-            trg_strs = []
-            src_str = '.'.join([json_[f] for f in src_fields])
-            [trg_strs.extend(re.split(trg_delimiter, json_[f])) for f in trg_fields]
-            src_trgs_pairs.append((src_str, trg_strs))
+            src_trgs_pairs.append(parse_json_line(line, src_fields, trg_fields, trg_delimiter))
 
     return src_trgs_pairs
 
 
+def parse_json_line(line, src_fields=['title', 'abstract'], trg_fields=['keyword'], trg_delimiter=';'):
+    '''
+    Parse one line of a json data file into a pair of (src_str, [trg_str_1, trg_str_2 ... trg_str_m])
+    '''
+    json_ = json.loads(line)
+
+    trg_strs = []
+    src_str = '.'.join([json_[f] for f in src_fields])
+    [trg_strs.extend(re.split(trg_delimiter, json_[f])) for f in trg_fields]
+    return (src_str, trg_strs)
+
+
 def copyseq_tokenize(text):
     '''
     The tokenizer used in Meng et al. ACL 2017
@@ -409,23 +542,29 @@ def tokenize_filter_data(
 def process_data_examples(src_trgs_pairs, word2id, id2word, opt, mode='one2one', include_original=False):
     '''
     Standard process for copy model, parsing strings to tensors
-    :param mode: one2one or one2many
+    :param word2id: the word2id dict or a pykp.vocab.Vocab, each document is numericalized with Vocab.encode
+    :param mode: one2one, one2many or both
     :param include_original: keep the original texts of source and target
-    :return:
+    :return: the list of examples, for mode=both the one2many examples and the one2one index,
+        an array of shape (#one2one, 2) holding the one2many example and the target index of each one2one example
     '''
     return_example_list = []
+    one2one_index = []
     count_oov_in_targets = 0
     max_oov_num_in_src = 0
     max_oov_src = ''
+    num_pairs = 0
+    vocab = word2id if isinstance(word2id, Vocab) else Vocab.from_word2id(word2id, max_size=opt.vocab_size)
 
+    # the pairs may be streamed, they are only iterated once
     for idx, (source_str, target_strs) in enumerate(src_trgs_pairs):
+        num_pairs += 1
         # if w is not seen in training data vocab (word2id, size could be larger than opt.vocab_size), replace with <unk>
         # src_all = [word2id[w] if w in word2id else word2id[UNK_WORD] for w in source]
         # if w's id is larger than opt.vocab_size, replace with <unk>
-        src_unk = [word2id[w] if w in word2id and word2id[w] < opt.vocab_size else word2id[UNK_WORD] for w in source_str]
-
         # create a local vocab for the current source text. If there're V words in the vocab of this string, len(itos)=V+2 (including <unk> and <pad>), len(stoi)=V+1 (including <pad>)
-        src_copy, oov_dict, oov_list = extend_vocab_OOV(source_str, word2id, opt.vocab_size, opt.max_unk_words)
+        src_unk, src_copy, oov_dict, oov_list = vocab.encode(source_str, opt.vocab_size, opt.max_unk_words)
+        src_unk, src_copy = src_unk.tolist(), src_copy.tolist()
 
         one2one_example_list = []
         find_oov_in_targets = False
@@ -454,26 +593,18 @@ def process_data_examples(src_trgs_pairs, word2id, id2word, opt, mode='one2one',
             '''
             process targets and add into example
             '''
-            trg = [word2id[w] if (w in word2id and word2id[w] < opt.vocab_size) else word2id[UNK_WORD] for w in target_str]
-            one2one_example['trg'] = trg
-
             # oov words are replaced with indices in oov_dict
-            trg_copy = []
-            for w in target_str:
-                w_id = word2id[UNK_WORD]
-                if w in word2id and word2id[w] < opt.vocab_size:
-                    w_id = word2id[w]
-                elif w in oov_dict:
-                    w_id = oov_dict[w]
-                trg_copy.append(w_id)
+            trg, trg_copy = vocab.encode_target(target_str, opt.vocab_size, oov_dict)
+            trg, trg_copy = trg.tolist(), trg_copy.tolist()
+            one2one_example['trg'] = trg
             one2one_example['trg_copy'] = trg_copy
 
             if any([w >= opt.vocab_size for w in trg_copy]):
                 find_oov_in_targets= True
 
             if idx % 20000 == 0:
-                print('-------------------- %s: %d/%d ---------------------------' %
-                      (inspect.getframeinfo(inspect.currentframe()).function, idx, len(src_trgs_pairs)))
+                print('-------------------- %s: %d ---------------------------' %
+                      (inspect.getframeinfo(inspect.currentframe()).function, idx))
                 print('source    \n\t\t[len=%d]: %s' % (len(source_str), source_str))
                 print('targets    \n\t\t[len=%d]: %s' % (len(target_strs), target_strs))
                 print('target    \n\t\t[len=%d]: %s' % (len(target_str), target_str))
@@ -497,7 +628,7 @@ def process_data_examples(src_trgs_pairs, word2id, id2word, opt, mode='one2one',
             count_oov_in_targets += 1
 
         # if it is one2many mode, merge multiple one2one examples to one
-        if mode == 'one2many':
+        if mode in ['one2many', 'both']:
             one2many_example = {}
             if include_original:
                 one2many_example['src_str'] = source_str
@@ -558,6 +689,8 @@ def process_data_examples(src_trgs_pairs, word2id, id2word, opt, mode='one2one',
                 assert len(t) == len(tc)
 
             return_example_list.append(one2many_example)
+            if mode == 'both':
+                one2one_index.extend((len(return_example_list) - 1, i) for i in range(len(one2one_example_list)))
         else:
             return_example_list.extend(one2one_example_list)
 
@@ -565,8 +698,10 @@ def process_data_examples(src_trgs_pairs, word2id, id2word, opt, mode='one2one',
     print('Find max number of oov words in a text = %d' % (max_oov_num_in_src))
     print('max_oov sentence: %s' % str(max_oov_src))
 
-    print('#(input pairs)/#(returned %s examples) = %d / %d' % (mode, len(src_trgs_pairs), len(return_example_list)))
+    print('#(input pairs)/#(returned %s examples) = %d / %d' % (mode, num_pairs, len(return_example_list)))
 
+    if mode == 'both':
+        return return_example_list, np.asarray(one2one_index, dtype=np.int32).reshape(-1, 2)
     return return_example_list
 
 
@@ -576,7 +711,7 @@ def extend_vocab_OOV(source_words, word2id, vocab_size, max_oov_words):
     WARNING: if the number of oovs in the source text is more than max_unk_words, ignore and replace them as <unk>
     Args:
         source_words: a list of words (strings) of a document
-        word2id: global vocab word2id
+        word2id: global vocab word2id, or a pykp.vocab.Vocab (then the words are looked up at once with Vocab.encode)
         vocab_size: the maximum acceptable index of word in vocab (default 50000)
         max_oov_words: the maximum acceptable number of unique OOV words in a document,
                         any OOV words exceed this limit would be replace by unk
@@ -585,6 +720,10 @@ def extend_vocab_OOV(source_words, word2id, vocab_size, max_oov_words):
              If the vocabulary size is 50k and the doc has 3 OOVs, then these temporary OOV id will be 50000, 50001, 50002.
         oovs: A list of the OOV words in the article (strings), in the order corresponding to their temporary article OOV numbers.
     """
+    if isinstance(word2id, Vocab):
+        _, src_ext, oov_dict, oov_list = word2id.encode(source_words, vocab_size, max_oov_words)
+        return src_ext.tolist(), oov_dict, oov_list
+
     src_ext = []
     oov_dict = {}
     for w in source_words:
@@ -619,16 +758,25 @@ def copy_martix(source, target):
     return cc
 
 
+def count_vocab(tokenized_src_trgs_pairs):
+    """Count the tokens of sources and targets, the counter keeps the order of first occurrence."""
+    vocab = Counter()
+    for src_tokens, trgs_tokens in tokenized_src_trgs_pairs:
+        vocab.update(src_tokens)
+        for trg_tokens in trgs_tokens:
+            vocab.update(trg_tokens)
+    return vocab
+
+
 def build_vocab(tokenized_src_trgs_pairs, opt):
     """Construct a vocabulary from tokenized lines."""
-    vocab = {}
-    for src_tokens, trgs_tokens in tokenized_src_trgs_pairs:
-        tokens = src_tokens + list(itertools.chain(*trgs_tokens))
-        for token in tokens:
-            if token not in vocab:
-                vocab[token] = 1
-            else:
-                vocab[token] += 1
+    return build_vocab_from_counter(count_vocab(tokenized_src_trgs_pairs))
+
+
+def build_vocab_from_counter(vocab):
+    """Construct a vocabulary from token counts (see count_vocab), ties are kept in the order of the counter.
+    See pykp.vocab.Vocab.from_counter for the compact version."""
+    vocab = dict(vocab)
 
     # Discard start, end, pad and unk tokens if already present
     if '<s>' in vocab:
@@ -814,12 +962,67 @@ def initialize_fields(opt):
     return fields
 
 
-def load_src_trgs_pairs(source_json_path, dataset_name, src_fields, trg_fields, opt, valid_check=False):
-    tokenized_pairs_cache_path = source_json_path + '_tokenized.tmp'
+def tokenization_cache_path(source_json_path, src_fields, trg_fields, opt, valid_check=False,
+                            tokenize_fn=copyseq_tokenize, cache_dir=None):
+    '''
+    Path of the cached tokenized pairs of a json file, keyed by the size and modification time of the file,
+    the fields, the tokenization options and the tokenizer version, so a stale cache is never used
+    :param cache_dir: directory of the cache files, default to the directory of the json file
+    '''
+    stat = os.stat(source_json_path)
+    key = json.dumps([TOKENIZER_VERSION, tokenize_fn.__name__,
+                      os.path.abspath(source_json_path), stat.st_size, stat.st_mtime_ns,
+                      list(src_fields), list(trg_fields), valid_check,
+                      [getattr(opt, name, None) for name in TOKENIZATION_OPTIONS]])
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+    if cache_dir is None:
+        cache_dir = os.path.dirname(source_json_path)
+    return os.path.join(cache_dir, '%s.%s.tokenized.gz' % (os.path.basename(source_json_path), digest))
+
+
+# separators of the tokenization cache, tokens never contain control characters
+_TOKEN_SEPARATOR = '\x1f'
+_FIELD_SEPARATOR = '\x1e'
+
+
+def write_tokenized_pairs(tokenized_pairs, path):
+    '''
+    Write tokenized pairs as gzipped lines: number of targets, source and targets separated by \\x1e,
+    tokens separated by \\x1f. The file is written aside and renamed, so readers never see a partial cache
+    '''
+    tmp_path = path + '.%d.tmp' % os.getpid()
+    with gzip.open(tmp_path, 'wt', encoding='utf-8', newline='\n', compresslevel=3) as cache_file:
+        for src_tokens, trgs_tokens in tokenized_pairs:
+            fields = [str(len(trgs_tokens)), _TOKEN_SEPARATOR.join(src_tokens)]
+            fields.extend(_TOKEN_SEPARATOR.join(trg_tokens) for trg_tokens in trgs_tokens)
+            cache_file.write(_FIELD_SEPARATOR.join(fields) + '\n')
+    os.replace(tmp_path, path)
+
+
+def iter_tokenized_pairs(path):
+    '''
+    Stream the tokenized pairs written by write_tokenized_pairs
+    '''
+    def split_tokens(field):
+        return field.split(_TOKEN_SEPARATOR) if field else []
+
+    with gzip.open(path, 'rt', encoding='utf-8', newline='\n') as cache_file:
+        for line in cache_file:
+            fields = line.rstrip('\n').split(_FIELD_SEPARATOR)
+            num_trgs = int(fields[0])
+            yield (split_tokens(fields[1]), [split_tokens(f) for f in fields[2:2 + num_trgs]])
+
+
+def load_src_trgs_pairs(source_json_path, dataset_name, src_fields, trg_fields, opt, valid_check=False, cache_dir=None):
+    '''
+    Yield the tokenized pairs of a json file, streamed from the tokenization cache if it exists
+    '''
+    tokenized_pairs_cache_path = tokenization_cache_path(source_json_path, src_fields, trg_fields, opt,
+                                                         valid_check=valid_check, cache_dir=cache_dir)
     if os.path.exists(tokenized_pairs_cache_path):
         print('Loading tokenized_pairs from ' + tokenized_pairs_cache_path)
-        with open(tokenized_pairs_cache_path, 'rb') as cache_file:
-            tokenized_pairs = pickle.load(cache_file)
+        yield from iter_tokenized_pairs(tokenized_pairs_cache_path)
     else:
         print('Generating tokenized_pairs and dumping to ' + tokenized_pairs_cache_path)
         src_trgs_pairs = load_json_data(source_json_path,
@@ -834,21 +1037,16 @@ def load_src_trgs_pairs(source_json_path, dataset_name, src_fields, trg_fields,
                                                valid_check=valid_check)
         del src_trgs_pairs
 
-        with open(tokenized_pairs_cache_path, 'wb') as cache_file:
-            pickle.dump(tokenized_pairs, cache_file)
-
-    return tokenized_pairs
+        write_tokenized_pairs(tokenized_pairs, tokenized_pairs_cache_path)
+        yield from tokenized_pairs
 
 
 def generate_one2one_one2many_examples(tokenized_pairs, word2id, id2word, opt, include_original):
-    one2one_examples = process_data_examples(tokenized_pairs,
-                                                     word2id, id2word,
-                                                     opt, mode='one2one',
-                                                     include_original=include_original)
-    one2many_examples = process_data_examples(tokenized_pairs,
-                                                      word2id, id2word,
-                                                      opt, mode='one2many',
-                                                      include_original=include_original)
+    one2many_examples, one2one_index = process_data_examples(tokenized_pairs,
+                                                             word2id, id2word,
+                                                             opt, mode='both',
+                                                             include_original=include_original)
+    one2one_examples = list(One2OneExamples(one2many_examples, one2one_index))
 
     print('\t#pairs of one2one = %d' % len(one2one_examples))
     print('\t#pairs of one2many = %d' % len(one2many_examples))
@@ -856,6 +1054,51 @@ def generate_one2one_one2many_examples(tokenized_pairs, word2id, id2word, opt, i
     return one2one_examples, one2many_examples
 
 
+DATASET_INDEX_KEYS = ['num_trgs', 'src_lens', 'trg_lens']
+
+
+def dataset_index_path(data_path):
+    '''
+    Path of the index header of a dataset, 'xxx.index.npz' for 'xxx.pt'
+    '''
+    if data_path.endswith('.pt'):
+        data_path = data_path[:-len('.pt')]
+    return data_path + '.index.npz'
+
+
+def compute_dataset_index(examples, type='one2many'):
+    '''
+    Number of targets, source length and longest target length of each example
+    '''
+    if type == 'one2one':
+        num_trgs = [1] * len(examples)
+        trg_lens = [len(e['trg']) for e in examples]
+    else:
+        num_trgs = [len(e['trg']) for e in examples]
+        trg_lens = [max([len(t) for t in e['trg']] or [0]) for e in examples]
+    return {'num_trgs': np.asarray(num_trgs, dtype=np.int64),
+            'src_lens': np.asarray([len(e['src']) for e in examples], dtype=np.int64),
+            'trg_lens': np.asarray(trg_lens, dtype=np.int64)}
+
+
+def export_dataset_index(one2many_examples, data_path):
+    '''
+    Save the index header of a one2many dataset next to it, see KeyphraseDataset.get_index(). The length of every
+    target is saved as well (all_trg_lens), for the index header of the one2one examples referencing them
+    '''
+    index = compute_dataset_index(one2many_examples)
+    index['all_trg_lens'] = np.asarray([len(t) for e in one2many_examples for t in e['trg']], dtype=np.int64)
+    np.savez(dataset_index_path(data_path), **index)
+
+
+def export_one2one_index(one2one_index, one2many_file_name, output_path):
+    '''
+    Save one2one examples as references to the targets of the one2many examples saved in one2many_file_name
+    (in the same directory), see One2OneExamples
+    '''
+    torch.save({'one2many': one2many_file_name, 'one2one_index': one2one_index}, open(output_path, 'wb'))
+
+
 def process_and_export_dataset(tokenized_src_trg_pairs,
                                word2id, id2word,
                                opt, output_path,
@@ -863,7 +1106,7 @@ def process_and_export_dataset(tokenized_src_trg_pairs,
                                data_type=None,
                                include_original=False):
     """
-    :param tokenized_src_trg_pairs:
+    :param tokenized_src_trg_pairs: the tokenized pairs, iterated once (e.g. streamed by load_src_trgs_pairs)
     :param word2id:
     :param id2word:
     :param opt:
@@ -875,7 +1118,7 @@ def process_and_export_dataset(tokenized_src_trg_pairs,
     assert data_type is not None
     assert data_type in ['train', 'valid', 'test']
 
-    print("Processing %s data, #(src_trg_pair)=%d..." % (data_type, len(tokenized_src_trg_pairs)))
+    print("Processing %s data..." % data_type)
     '''
     Convert raw data to data examples (strings to tensors)
     '''
@@ -885,18 +1128,29 @@ def process_and_export_dataset(tokenized_src_trg_pairs,
     #     include_original = True
 
     print("Dumping %s %s to disk: %s" % (dataset_name, data_type, os.path.join(output_path, '%s.%s.*.pt' % (dataset_name, data_type))))
-    one2one_examples = process_data_examples(
-        tokenized_src_trg_pairs, word2id, id2word, opt, mode='one2one', include_original=include_original)
-    print('#pairs of %s %s one2one  = %d' % (dataset_name, data_type, len(one2one_examples)))
-    print("Dumping one2one %s %s to disk: %s" % (dataset_name, data_type, os.path.join(output_path, '%s.%s.one2one.pt' % (dataset_name, data_type))))
-    torch.save(one2one_examples, open(os.path.join(output_path, '%s.%s.one2one.pt' % (dataset_name, data_type)), 'wb'))
-    del one2one_examples
-
-    one2many_exmaples = process_data_examples(
-        tokenized_src_trg_pairs, word2id, id2word, opt, mode='one2many', include_original=include_original)
+    # one pass for both views, one2one examples are saved as references to the targets of the one2many examples
+    # the length statistics are counted while the pairs are processed, so they are only read once
+    src_len_counter, trg_len_counter = Counter(), Counter()
+    one2many_exmaples, one2one_index = process_data_examples(
+        count_lengths(tokenized_src_trg_pairs, src_len_counter, trg_len_counter),
+        word2id, id2word, opt, mode='both', include_original=include_original)
+    print('#(src_trg_pair) of %s %s = %d' % (dataset_name, data_type, sum(src_len_counter.values())))
+    print('#pairs of %s %s one2one  = %d' % (dataset_name, data_type, len(one2one_index)))
     print('#pairs of %s %s one2many = %d' % (dataset_name, data_type, len(one2many_exmaples)))
     print("Dumping one2many %s %s to disk: %s" % (dataset_name, data_type, os.path.join(output_path, '%s.%s.one2many.pt' % (dataset_name, data_type))))
     torch.save(one2many_exmaples, open(os.path.join(output_path, '%s.%s.one2many.pt' % (dataset_name, data_type)), 'wb'))
+    export_dataset_index(one2many_exmaples, os.path.join(output_path, '%s.%s.one2many.pt' % (dataset_name, data_type)))
+    print("Dumping one2one %s %s to disk: %s" % (dataset_name, data_type, os.path.join(output_path, '%s.%s.one2one.pt' % (dataset_name, data_type))))
+    export_one2one_index(one2one_index, '%s.%s.one2many.pt' % (dataset_name, data_type),
+                         os.path.join(output_path, '%s.%s.one2one.pt' % (dataset_name, data_type)))
+    if getattr(opt, 'columnar', True):
+        print("Dumping columnar one2many %s %s to disk: %s" % (dataset_name, data_type, os.path.join(output_path, '%s.%s.one2many.cols' % (dataset_name, data_type))))
+        export_columnar_dataset(one2many_exmaples, os.path.join(output_path, '%s.%s.one2many.cols' % (dataset_name, data_type)),
+                                vocab_size=opt.vocab_size, include_original=include_original,
+                                source_path=os.path.join(output_path, '%s.%s.one2many.pt' % (dataset_name, data_type)))
+    else:
+        # a columnar dataset left by a previous export would not match the new .pt file
+        remove_columnar_dataset(os.path.join(output_path, '%s.%s.one2many.pt' % (dataset_name, data_type)))
     del one2many_exmaples
 
     print("Dumping done!")
@@ -904,24 +1158,37 @@ def process_and_export_dataset(tokenized_src_trg_pairs,
     '''
     Print dataset statistics
     '''
-    print("***************** %s %s : Source Length Statistics ******************" % (dataset_name, data_type.upper()))
-    len_counter = {}
-    for src_tokens, trgs_tokens in tokenized_src_trg_pairs:
-        len_count = len_counter.get(len(src_tokens), 0) + 1
-        len_counter[len(src_tokens)] = len_count
-    sorted_len = sorted(len_counter.items(), key=lambda x: x[0], reverse=True)
+    print_length_statistics(dataset_name, data_type, src_len_counter, trg_len_counter)
 
-    for len_, count in sorted_len:
-        print('%d,%d' % (len_, count))
 
-    print("***************** %s %s : Target Length Statistics ******************" % (dataset_name, data_type.upper()))
-    len_counter = {}
+def count_lengths(tokenized_src_trg_pairs, src_len_counter, trg_len_counter):
+    '''
+    Yield the tokenized pairs, counting the lengths of the sources and of the targets in the given Counters
+    '''
     for src_tokens, trgs_tokens in tokenized_src_trg_pairs:
+        src_len_counter[len(src_tokens)] += 1
         for trgs_token in trgs_tokens:
-            len_count = len_counter.get(len(trgs_token), 0) + 1
-            len_counter[len(trgs_token)] = len_count
+            trg_len_counter[len(trgs_token)] += 1
+        yield src_tokens, trgs_tokens
 
-    sorted_len = sorted(len_counter.items(), key=lambda x: x[0], reverse=True)
 
-    for len_, count in sorted_len:
+def length_statistics(tokenized_src_trg_pairs):
+    '''
+    Count the lengths of the sources and of the targets
+    :return: two Counters, #source per source length and #target per target length
+    '''
+    src_len_counter = Counter()
+    trg_len_counter = Counter()
+    for _ in count_lengths(tokenized_src_trg_pairs, src_len_counter, trg_len_counter):
+        pass
+    return src_len_counter, trg_len_counter
+
+
+def print_length_statistics(dataset_name, data_type, src_len_counter, trg_len_counter):
+    print("***************** %s %s : Source Length Statistics ******************" % (dataset_name, data_type.upper()))
+    for len_, count in sorted(src_len_counter.items(), key=lambda x: x[0], reverse=True):
+        print('%d,%d' % (len_, count))
+
+    print("***************** %s %s : Target Length Statistics ******************" % (dataset_name, data_type.upper()))
+    for len_, count in sorted(trg_len_counter.items(), key=lambda x: x[0], reverse=True):
         print('%d,%d' % (len_, count))
@@ -141,9 +141,15 @@ class PointerGen(nn.Module):
         return torch.sigmoid(self.w_h(h) + self.w_s(s) + self.w_x(x) + self.bias).contiguous()
         
 class Attention(nn.Module):
-    def __init__(self, enc_dim, trg_dim, method='general'):
+    def __init__(self, enc_dim, trg_dim, method='general', max_concat_size=2 ** 24):
+        '''
+        :param max_concat_size: for concat attention, the maximum number of elements of the (batch, trg_len, src_len, trg_dim)
+            tensor of hidden energies computed at once, the target positions are processed by chunks if it is larger
+        '''
         super(Attention, self).__init__()
         self.method = method
+        self.trg_dim = trg_dim
+        self.max_concat_size = max_concat_size
 
         if self.method == 'general':
             self.attn = nn.Linear(enc_dim, trg_dim)
@@ -165,46 +171,64 @@ class Attention(nn.Module):
 
         self.tanh = nn.Tanh()
 
-    def score(self, hiddens, encoder_outputs, encoder_mask=None):
+    def precompute_keys(self, encoder_outputs):
+        '''
+        Project the encoder outputs to the attention keys, which don't depend on the decoder states, so that
+        they are computed once per source instead of at every call (e.g. at each decoding step)
+        :param encoder_outputs: (batch, src_len, src_hidden_dim)
+        :return: the keys (batch, src_len, trg_hidden_dim) for general and concat attention,
+            None for dot attention (the keys are the encoder outputs)
+        '''
+        if self.method == 'general':
+            return self.attn(encoder_outputs)
+        elif self.method == 'concat':
+            # the encoder part of attn(W[h; e] + b), i.e. W_e * e + b, W = [W_d, W_e] as hiddens come first in the concatenation
+            return func.linear(encoder_outputs, self.attn.mlp.weight[:, self.trg_dim:], self.attn.mlp.bias)
+        return None
+
+    def score(self, hiddens, encoder_outputs, encoder_mask=None, keys=None):
         '''
         :param hiddens: (batch, trg_len, trg_hidden_dim)
         :param encoder_outputs: (batch, src_len, src_hidden_dim)
+        :param keys: the keys of the encoder outputs given by precompute_keys(), computed here if not given
         :return: energy score (batch, trg_len, src_len)
         '''
         if self.method == 'dot':
             # hidden (batch, trg_len, trg_hidden_dim) * encoder_outputs (batch, src_len, src_hidden_dim).transpose(1, 2) -> (batch, trg_len, src_len)
             energies = torch.bmm(hiddens, encoder_outputs.transpose(1, 2))  # (batch, trg_len, src_len)
         elif self.method == 'general':
-            energies = self.attn(encoder_outputs)  # (batch, src_len, trg_hidden_dim)
+            energies = keys if keys is not None else self.attn(encoder_outputs)  # (batch, src_len, trg_hidden_dim)
             if encoder_mask is not None:
                 energies =  energies * encoder_mask.view(encoder_mask.size(0), encoder_mask.size(1), 1)
             # hidden (batch, trg_len, trg_hidden_dim) * encoder_outputs (batch, src_len, src_hidden_dim).transpose(1, 2) -> (batch, trg_len, src_len)
             energies = torch.bmm(hiddens, energies.transpose(1, 2))  # (batch, trg_len, src_len)
         elif self.method == 'concat':
+            # W[h; e] + b = W_d * h + (W_e * e + b), the encoder part being the keys, so the energies of all the
+            # target positions are broadcasted over (batch, trg_len, src_len, trg_hidden_dim) instead of concatenating
+            # each hidden with the encoder outputs
+            if keys is None:
+                keys = self.precompute_keys(encoder_outputs)  # (batch, src_len, trg_hidden_dim)
+            queries = func.linear(hiddens, self.attn.mlp.weight[:, :self.trg_dim])  # (batch, trg_len, trg_hidden_dim)
+
+            batch_size, src_len, trg_hidden_dim = keys.size()
+            chunk_size = max(1, self.max_concat_size // (batch_size * src_len * trg_hidden_dim))
             energies = []
-            batch_size = encoder_outputs.size(0)
-            src_len = encoder_outputs.size(1)
-            for i in range(hiddens.size(1)):
-                hidden_i = hiddens[:, i: i + 1, :].expand(-1, src_len, -1)  # (batch, src_len, trg_hidden_dim)
-                concated = torch.cat((hidden_i, encoder_outputs), 2)  # (batch_size, src_len, dec_hidden_dim + enc_hidden_dim)
-                if encoder_mask is not None:
-                    concated =  concated * encoder_mask.view(encoder_mask.size(0), encoder_mask.size(1), 1)  # (batch_size, src_len, dec_hidden_dim + enc_hidden_dim)
-                energy = self.tanh(self.attn(concated, encoder_mask))  # (batch_size, src_len, dec_hidden_dim)
-                if encoder_mask is not None:
-                    energy =  energy * encoder_mask.view(encoder_mask.size(0), encoder_mask.size(1), 1)  # (batch_size, src_len, dec_hidden_dim)
-                energy = self.v(energy, encoder_mask).squeeze(-1)  # (batch_size, src_len)
-                energies.append(energy)
-            energies = torch.stack(energies, dim=1)  # (batch_size, trg_len, src_len)
+            for start in range(0, hiddens.size(1), chunk_size):
+                energy = self.tanh(queries[:, start: start + chunk_size].unsqueeze(2) + keys.unsqueeze(1))  # (batch, chunk_size, src_len, trg_hidden_dim)
+                energies.append(self.v(energy).squeeze(-1))  # (batch, chunk_size, src_len)
+            energies = torch.cat(energies, dim=1)  # (batch_size, trg_len, src_len)
+            # a masked position has a null energy, as when the masks are applied to the concatenated inputs
             if encoder_mask is not None:
                 energies =  energies * encoder_mask.view(encoder_mask.size(0), 1, encoder_mask.size(1))
 
         return energies.contiguous()
 
-    def forward(self, hidden, encoder_outputs, encoder_mask=None):
+    def forward(self, hidden, encoder_outputs, encoder_mask=None, keys=None):
         '''
         Compute the attention and h_tilde, inputs/outputs must be batch first
         :param hidden: (batch_size, trg_len, trg_hidden_dim)
         :param encoder_outputs: (batch_size, src_len, trg_hidden_dim), if this is dot attention, you have to convert enc_dim to as same as trg_dim first
+        :param keys: the keys of the encoder outputs given by precompute_keys(encoder_outputs), to avoid projecting them again
         :return:
             h_tilde (batch_size, trg_len, trg_hidden_dim)
             attn_weights (batch_size, trg_len, src_len)
@@ -231,7 +255,7 @@ class Attention(nn.Module):
         trg_hidden_dim = hidden.size(2)
 
         # hidden (batch_size, trg_len, trg_hidden_dim) * encoder_outputs (batch, src_len, src_hidden_dim).transpose(1, 2) -> (batch, trg_len, src_len)
-        attn_energies = self.score(hidden, encoder_outputs)
+        attn_energies = self.score(hidden, encoder_outputs, keys=keys)
 
         # Normalize energies to weights in range 0 to 1, with consideration of masks
         if encoder_mask is None:
@@ -506,6 +530,25 @@ class Seq2SeqLSTMAttention(nn.Module):
 
         return src_h, (h_t, c_t)
 
+    def attention_keys(self, enc_context):
+        '''
+        Project the encoder outputs once per source for generate(), instead of at every decoding step
+        :param enc_context: (#sources, src_len, context_dim) the outputs of encode()
+        :return: tuple of
+            the context attended by the decoder (#sources, src_len, trg_hidden_dim or context_dim), converted to trg_hidden_dim for dot attention
+            the keys of the attention layer and of the copy attention layer (#sources, src_len, trg_hidden_dim), None if not used by the layer
+        '''
+        if self.attention_layer.method == 'dot':
+            num_srcs, src_len, context_dim = enc_context.size()
+            enc_context = nn.Tanh()(self.encoder2decoder_hidden(enc_context.contiguous().view(-1, context_dim))).view(num_srcs, src_len, self.trg_hidden_dim)
+
+        attn_keys = self.attention_layer.precompute_keys(enc_context)
+        copy_keys = None
+        if self.copy_attention and not self.reuse_copy_attn:
+            copy_keys = self.copy_attention_layer.precompute_keys(enc_context)
+
+        return enc_context, attn_keys, copy_keys
+
     def merge_decode_inputs(self, trg_emb, h_tilde, copy_h_tilde):
         '''
         Input-feeding: merge the information of current word and attentional hidden vectors
@@ -563,6 +606,10 @@ class Seq2SeqLSTMAttention(nn.Module):
             enc_context = nn.Tanh()(self.encoder2decoder_hidden(enc_context.contiguous().view(-1, context_dim))).view(batch_size, src_len, trg_hidden_dim)
             enc_context = enc_context * ctx_mask.view(ctx_mask.size() + (1,))
 
+        # project the attention keys once, they are shared by all the target steps
+        attn_keys = self.attention_layer.precompute_keys(enc_context)
+        copy_keys = self.copy_attention_layer.precompute_keys(enc_context) if self.copy_attention and not self.reuse_copy_attn else None
+
         # maximum length to unroll, ignore the last word (must be padding)
         max_length = trg_inputs.size(1) - 1
 
@@ -591,7 +638,7 @@ class Seq2SeqLSTMAttention(nn.Module):
             (2) Standard Attention
             '''
             # Get the h_tilde (batch_size, trg_len, trg_hidden_dim) and attention weights (batch_size, trg_len, src_len)
-            h_tildes, attn_weights, attn_logits = self.attention_layer(decoder_outputs.permute(1, 0, 2), enc_context, encoder_mask=ctx_mask)
+            h_tildes, attn_weights, attn_logits = self.attention_layer(decoder_outputs.permute(1, 0, 2), enc_context, encoder_mask=ctx_mask, keys=attn_keys)
             if self.pointer:
                 self.pgen = self.pointergen(h_tildes.permute(1, 0, 2), decoder_outputs, trg_emb).permute(1, 0 ,2)
             # compute the output decode_logit and read-out as probs: p_x = Softmax(W_s * h_tilde), (batch_size, trg_len, trg_hidden_size) -> (batch_size * trg_len, vocab_size)
@@ -606,7 +653,7 @@ class Seq2SeqLSTMAttention(nn.Module):
             if self.copy_attention:
                 # copy_weights and copy_logits is (batch_size, trg_len, src_len)
                 if not self.reuse_copy_attn:
-                    _, copy_weights, copy_logits = self.copy_attention_layer(decoder_outputs.permute(1, 0, 2), enc_context, encoder_mask=ctx_mask)
+                    _, copy_weights, copy_logits = self.copy_attention_layer(decoder_outputs.permute(1, 0, 2), enc_context, encoder_mask=ctx_mask, keys=copy_keys)
                 else:
                     copy_logits = attn_logits
 
@@ -648,7 +695,7 @@ class Seq2SeqLSTMAttention(nn.Module):
                 (2) Standard Attention
                 '''
                 # Get the h_tilde (hidden after attention) and attention weights. h_tilde (batch_size,1,trg_hidden), attn_weight & attn_logit(batch_size,1,src_len)
-                h_tilde, attn_weight, attn_logit = self.attention_layer(decoder_output.permute(1, 0, 2), enc_context, encoder_mask=ctx_mask)
+                h_tilde, attn_weight, attn_logit = self.attention_layer(decoder_output.permute(1, 0, 2), enc_context, encoder_mask=ctx_mask, keys=attn_keys)
 
                 # compute the output decode_logit and read-out as probs: p_x = Softmax(W_s * h_tilde)
                 # h_tilde=(batch_size, 1, trg_hidden_size) -> decoder2vocab(h_tilde.view)=(batch_size * 1, vocab_size) -> decoder_logit=(batch_size, 1, vocab_size)
@@ -659,7 +706,7 @@ class Seq2SeqLSTMAttention(nn.Module):
                 if self.copy_attention:
                     # copy_weights and copy_logits is (batch_size, trg_len, src_len)
                     if not self.reuse_copy_attn:
-                        copy_h_tilde, copy_weight, copy_logit = self.copy_attention_layer(decoder_output.permute(1, 0, 2), enc_context, encoder_mask=ctx_mask)
+                        copy_h_tilde, copy_weight, copy_logit = self.copy_attention_layer(decoder_output.permute(1, 0, 2), enc_context, encoder_mask=ctx_mask, keys=copy_keys)
                     else:
                         copy_h_tilde, copy_weight, copy_logit = h_tilde, attn_weight, attn_logit
 
@@ -807,14 +854,19 @@ class Seq2SeqLSTMAttention(nn.Module):
 
         return do_tf
 
-    def generate(self, trg_input, dec_hidden, enc_context, ctx_mask=None, src_map=None, oov_list=None, max_len=1, return_attention=False):
+    def generate(self, trg_input, dec_hidden, enc_context, ctx_mask=None, src_map=None, oov_list=None, max_len=1, return_attention=False, enc_keys=None):
         '''
         Given the initial input, state and the source contexts, return the top K restuls for each time step
         :param trg_input: just word indexes of target texts (usually zeros indicating BOS <s>)
         :param dec_hidden: hidden states for decoder RNN to start with
-        :param enc_context: context encoding vectors
-        :param src_map: required if it's copy model
-        :param oov_list: required if it's copy model
+        :param enc_context: context encoding vectors, one per source. If there're several hypotheses per source (beam search),
+            the hypotheses of each source are contiguous in trg_input, hypothesis i decoding the source i // (#hyps / #sources),
+            thus the encoder outputs, masks and oov maps are never copied for each hypothesis
+        :param ctx_mask: (#sources, src_len)
+        :param src_map: required if it's copy model, (#sources, src_len)
+        :param oov_list: required if it's copy model, one per source
+        :param enc_keys: the projections of enc_context given by attention_keys(enc_context), computed here if not given.
+            Pass them when calling generate() step by step (e.g. beam search) so that the context is projected only once
         :param k (deprecated): Top K to return
         :param feed_all_timesteps: it's one-step predicting or feed all inputs to run through all the time steps
         :param get_attention: return attention vectors?
@@ -823,10 +875,13 @@ class Seq2SeqLSTMAttention(nn.Module):
         # assert isinstance(input_list, list) or isinstance(input_list, tuple)
         # assert isinstance(input_list[0], list) or isinstance(input_list[0], tuple)
         batch_size = trg_input.size(0)
+        num_srcs = enc_context.size(0)
         src_len = enc_context.size(1)
         trg_len = trg_input.size(1)
-        context_dim = enc_context.size(2)
         trg_hidden_dim = self.trg_hidden_dim
+        # the hypotheses of a source are attended as the trg_len positions of a sequence, (#sources, #hyps per source, ...)
+        hyps_per_src = batch_size // num_srcs
+        assert hyps_per_src * num_srcs == batch_size, 'the hypotheses must be grouped by source'
 
         h_tilde = Variable(torch.zeros(batch_size, 1, trg_hidden_dim)).cuda() if torch.cuda.is_available() else Variable(torch.zeros(batch_size, 1, trg_hidden_dim))
         copy_h_tilde = Variable(torch.zeros(batch_size, 1, trg_hidden_dim)).cuda() if torch.cuda.is_available() else Variable(torch.zeros(batch_size, 1, trg_hidden_dim))
@@ -835,9 +890,11 @@ class Seq2SeqLSTMAttention(nn.Module):
         log_probs = []
 
         # enc_context has to be reshaped before dot attention (batch_size, src_len, context_dim) -> (batch_size, src_len, trg_hidden_dim)
-        if self.attention_layer.method == 'dot':
-            enc_context = nn.Tanh()(self.encoder2decoder_hidden(enc_context.contiguous().view(-1, context_dim))).view(batch_size, src_len, trg_hidden_dim)
-        
+        # and the attention keys are projected once for all the steps
+        if enc_keys is None:
+            enc_keys = self.attention_keys(enc_context)
+        enc_context, attn_keys, copy_keys = enc_keys
+
         #self.vocabref.clear()
         for i in range(max_len):
             # print('TRG_INPUT: %s' % str(trg_input.size()))
@@ -852,8 +909,11 @@ class Seq2SeqLSTMAttention(nn.Module):
                 dec_input, dec_hidden
             )
 
-            # Get the h_tilde (hidden after attention) and attention weights
-            h_tilde, attn_weight, attn_logit = self.attention_layer(decoder_output.permute(1, 0, 2), enc_context, encoder_mask=ctx_mask)
+            # Get the h_tilde (hidden after attention) and attention weights, (#sources, #hyps per source, ...)
+            grouped_output = decoder_output.permute(1, 0, 2).contiguous().view(num_srcs, hyps_per_src, trg_hidden_dim)
+            h_tilde, grouped_attn_weight, grouped_attn_logit = self.attention_layer(grouped_output, enc_context, encoder_mask=ctx_mask, keys=attn_keys)
+            h_tilde = h_tilde.view(batch_size, 1, trg_hidden_dim)
+            attn_weight = grouped_attn_weight.view(batch_size, 1, src_len)
             if self.pointer:
                 #print(h_tilde.size(),decoder_output.permute(1,0,2).size(), dec_input.size())
                 self.pgen = self.pointergen(h_tilde, decoder_output.permute(1, 0, 2), dec_input.permute(1,0,2))
@@ -867,15 +927,16 @@ class Seq2SeqLSTMAttention(nn.Module):
             if not self.copy_attention:
                 decoder_log_prob = torch.nn.functional.log_softmax(decoder_logit, dim=-1).view(batch_size, 1, self.vocab_size)
             else:
-                decoder_logit = decoder_logit.view(batch_size, 1, self.vocab_size)
-                # copy_weights and copy_logits is (batch_size, trg_len, src_len)
+                decoder_logit = decoder_logit.view(num_srcs, hyps_per_src, self.vocab_size)
+                # copy_weights and copy_logits is (#sources, #hyps per source, src_len)
                 if not self.reuse_copy_attn:
-                    copy_h_tilde, copy_weight, copy_logit = self.copy_attention_layer(decoder_output.permute(1, 0, 2), enc_context, encoder_mask=ctx_mask)
+                    copy_h_tilde, copy_weight, copy_logit = self.copy_attention_layer(grouped_output, enc_context, encoder_mask=ctx_mask, keys=copy_keys)
+                    copy_h_tilde = copy_h_tilde.view(batch_size, 1, trg_hidden_dim)
                 else:
-                    copy_h_tilde, copy_weight, copy_logit = h_tilde, attn_weight, attn_logit
-                copy_weights.append(copy_weight.permute(1, 0, 2))  # (1, batch_size, src_len)
-                # merge the generative and copying probs (batch_size, 1, vocab_size + max_unk_word)
-                decoder_log_prob = self.merge_copy_probs(decoder_logit, copy_logit, src_map, oov_list)
+                    copy_h_tilde, copy_weight, copy_logit = h_tilde, grouped_attn_weight, grouped_attn_logit
+                copy_weights.append(copy_weight.contiguous().view(1, batch_size, src_len))  # (1, batch_size, src_len)
+                # merge the generative and copying probs, the hypotheses of a source share its src_map and oov_list (batch_size, 1, vocab_size + max_unk_word)
+                decoder_log_prob = self.merge_copy_probs(decoder_logit, copy_logit, src_map, oov_list).view(batch_size, 1, -1)
 
             # Prepare for the next iteration, get the top word, top_idx and next_index are (batch_size, K)
             top_1_v, top_1_idx = decoder_log_prob.data.topk(1, dim=-1)  # (batch_size, 1)
@@ -963,6 +1024,9 @@ class Seq2SeqLSTMAttention(nn.Module):
         if self.attention_layer.method == 'dot':
             enc_context = nn.Tanh()(self.encoder2decoder_hidden(enc_context.contiguous().view(-1, context_dim))).view(batch_size, src_len, trg_hidden_dim)
 
+        # project the attention keys once, they are shared by all the target steps
+        attn_keys = self.attention_layer.precompute_keys(enc_context)
+
         # maximum length to unroll
         max_length = trg_inputs.size(1) - 1
 
@@ -981,7 +1045,7 @@ class Seq2SeqLSTMAttention(nn.Module):
                 trg_emb, init_hidden
             )
             # Get the h_tilde (hidden after attention) and attention weights, inputs/outputs must be batch first
-            h_tildes, attn_weights, _ = self.attention_layer(decoder_outputs.permute(1, 0, 2), enc_context, encoder_mask=ctx_mask)
+            h_tildes, attn_weights, _ = self.attention_layer(decoder_outputs.permute(1, 0, 2), enc_context, encoder_mask=ctx_mask, keys=attn_keys)
 
             # compute the output decode_logit and read-out as probs: p_x = Softmax(W_s * h_tilde)
             # (batch_size, trg_len, trg_hidden_size) -> (batch_size, trg_len, vocab_size)
@@ -1014,7 +1078,7 @@ class Seq2SeqLSTMAttention(nn.Module):
                 )
 
                 # Get the h_tilde (hidden after attention) and attention weights, both inputs and outputs are batch first
-                h_tilde, attn_weight, _ = self.attention_layer(decoder_output.permute(1, 0, 2), enc_context, encoder_mask=ctx_mask)
+                h_tilde, attn_weight, _ = self.attention_layer(decoder_output.permute(1, 0, 2), enc_context, encoder_mask=ctx_mask, keys=attn_keys)
 
                 # compute the output decode_logit and read-out as probs: p_x = Softmax(W_s * h_tilde)
                 # (batch_size, trg_hidden_size) -> (batch_size, 1, vocab_size)
@@ -8,23 +8,20 @@ import sys
 
 from pykp import io
 from pykp.io import load_json_data
+from evaluate import PhraseIndex
 
 
 def check_if_present(source_tokens, targets_tokens):
+    '''
+    :param source_tokens: tokens of source text, or its evaluate.PhraseIndex to share it between calls
+    '''
+    if not isinstance(source_tokens, PhraseIndex):
+        source_tokens = PhraseIndex(source_tokens, max_phrase_len=max([len(t) for t in targets_tokens] + [0]))
+
     target_present_flags = []
     for target_tokens in targets_tokens:
         # whether do filtering on groundtruth phrases.
-        present = False
-        for i in range(len(source_tokens) - len(target_tokens) + 1):
-            match = None
-            for j in range(len(target_tokens)):
-                if target_tokens[j] != source_tokens[i + j]:
-                    match = False
-                    break
-            if len(target_tokens) > 0 and j == len(target_tokens) - 1 and match == None:
-                present = True
-                break
-
+        present = len(target_tokens) > 0 and target_tokens in source_tokens
         target_present_flags.append(present)
     assert len(target_present_flags) == len(targets_tokens)
 
@@ -126,8 +123,9 @@ def evaluate_(source_str_list, targets_str_list, prediction_str_list,
                 targets_tokens_to_match = [io.copyseq_tokenize(target.strip().lower()) for target in targets]
                 predictions_tokens_to_match = [io.copyseq_tokenize(prediction.strip().lower()) for prediction in predictions]
 
-            target_present_flags = check_if_present(source_tokens_to_match, targets_tokens_to_match)
-            prediction_present_flags = check_if_present(source_tokens_to_match, predictions_tokens_to_match)
+            source_index = PhraseIndex(source_tokens_to_match)
+            target_present_flags = check_if_present(source_index, targets_tokens_to_match)
+            prediction_present_flags = check_if_present(source_index, predictions_tokens_to_match)
 
             if filter_criteria == 'present':
                 targets_valid_flags = target_present_flags
@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+"""
+Sharded multiprocess preprocessing of json data files.
+
+The input file is split into byte ranges aligned on lines, and each shard goes
+through the same steps as pykp.io.load_src_trgs_pairs/process_and_export_dataset
+in a worker process:
+    1. tokenize_json_file: parse, tokenize and filter the lines of each shard, dump
+       the tokenized pairs of the shard and return its vocab counts, which are
+       merged in shard order (so the vocab is the same as with pykp.io.build_vocab)
+    2. export_dataset: numericalize the tokenized pairs of each shard and write its
+       one2many examples and one2one index, then concatenate the shards in order
+Shards are processed in the order of the input file, so the outputs are the same
+as the single process ones.
+"""
+import gzip
+import os
+import pickle
+import shutil
+from collections import Counter
+from multiprocessing import Pool
+
+import numpy as np
+import torch
+
+import pykp.io
+from pykp.columnar import ColumnarExamples, export_columnar_dataset, get_columnar_path, remove_columnar_dataset, \
+    stamp_columnar_dataset
+
+__author__ = "Rui Meng"
+__email__ = "rui.meng@pitt.edu"
+
+# state shared by the worker processes (vocab, options), set once per worker
+_worker_state = {}
+
+
+def _init_worker(state):
+    _worker_state.clear()
+    _worker_state.update(state)
+
+
+def _map(function, jobs, num_workers, **state):
+    '''
+    Apply function to the jobs in order, in num_workers processes sharing the given state
+    '''
+    if num_workers <= 1 or len(jobs) <= 1:
+        _init_worker(state)
+        return [function(job) for job in jobs]
+
+    pool = Pool(min(num_workers, len(jobs)), initializer=_init_worker, initargs=(state,))
+    try:
+        return pool.map(function, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def byte_range_shards(path, num_shards):
+    '''
+    Split a file into at most num_shards byte ranges [start, end) aligned on line boundaries
+    '''
+    size = os.path.getsize(path)
+    boundaries = [0]
+    with open(path, 'rb') as f:
+        for i in range(1, num_shards):
+            # the boundary is the start of the first line beginning at or after i * size / num_shards
+            f.seek(max(i * size // num_shards - 1, 0))
+            f.readline()
+            boundary = min(f.tell(), size)
+            if boundary > boundaries[-1]:
+                boundaries.append(boundary)
+    if size > boundaries[-1]:
+        boundaries.append(size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def read_lines(path, start, end):
+    '''
+    Return the non-empty lines of a utf-8 file within the byte range [start, end)
+    '''
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    return [line for line in data.decode('utf-8').split('\n') if line.strip()]
+
+
+def _tokenize_shard(job):
+    shard_id, path, start, end, shard_path = job
+    opt = _worker_state['opt']
+
+    src_trgs_pairs = [pykp.io.parse_json_line(line,
+                                              src_fields=_worker_state['src_fields'],
+                                              trg_fields=_worker_state['trg_fields'],
+                                              trg_delimiter=';')
+                      for line in read_lines(path, start, end)]
+    tokenized_pairs = pykp.io.tokenize_filter_data(src_trgs_pairs,
+                                                   tokenize_fn=pykp.io.copyseq_tokenize,
+                                                   opt=opt,
+                                                   valid_check=_worker_state['valid_check'])
+
+    with open(shard_path, 'wb') as shard_file:
+        pickle.dump(tokenized_pairs, shard_file)
+
+    return len(tokenized_pairs), pykp.io.count_vocab(tokenized_pairs)
+
+
+def _iter_shards(shard_paths):
+    for shard_path in shard_paths:
+        with open(shard_path, 'rb') as shard_file:
+            for pair in pickle.load(shard_file):
+                yield pair
+
+
+def _shard_cached_pairs(cache_path, work_dir, num_shards):
+    '''
+    Split the cached tokenized pairs of a file into num_shards pickled shards
+    :return: the paths of the shards and the vocab counts
+    '''
+    # the pairs are streamed, only one shard is held in memory: they are counted first to size the shards
+    with gzip.open(cache_path, 'rt', encoding='utf-8', newline='\n') as cache_file:
+        num_pairs = sum(1 for _ in cache_file)
+    shard_size = max((num_pairs + num_shards - 1) // num_shards, 1)
+
+    shard_paths = []
+    vocab = Counter()
+
+    def dump(shard):
+        shard_path = os.path.join(work_dir, 'tokenized.%05d.pkl' % len(shard_paths))
+        with open(shard_path, 'wb') as shard_file:
+            pickle.dump(shard, shard_file)
+        shard_paths.append(shard_path)
+        # merged in shard order, the counter keeps the order of first occurrence
+        vocab.update(pykp.io.count_vocab(shard))
+
+    shard = []
+    for pair in pykp.io.iter_tokenized_pairs(cache_path):
+        shard.append(pair)
+        if len(shard) == shard_size:
+            dump(shard)
+            shard = []
+    if shard:
+        dump(shard)
+
+    return shard_paths, vocab
+
+
+def tokenize_json_file(source_json_path, src_fields, trg_fields, opt, work_dir,
+                       valid_check=False, num_workers=1, num_shards=None, cache_dir=None):
+    '''
+    Tokenize and filter a json data file in parallel, the tokenized pairs of each shard are dumped in work_dir.
+    The tokenized pairs are cached as in pykp.io.load_src_trgs_pairs and reused while the file and options don't change
+    :param num_shards: number of byte range shards, default to 4 per worker to balance the load
+    :param cache_dir: directory of the tokenization cache, default to the directory of the json file
+    :return: the paths of the tokenized shards (in order) and the vocab counts of the whole file
+    '''
+    if num_shards is None:
+        num_shards = 4 * num_workers
+    if not os.path.exists(work_dir):
+        os.makedirs(work_dir)
+
+    cache_path = pykp.io.tokenization_cache_path(source_json_path, src_fields, trg_fields, opt,
+                                                 valid_check=valid_check, cache_dir=cache_dir)
+    if os.path.exists(cache_path):
+        print('Loading tokenized_pairs from ' + cache_path)
+        return _shard_cached_pairs(cache_path, work_dir, num_shards)
+
+    jobs = [(shard_id, source_json_path, start, end, os.path.join(work_dir, 'tokenized.%05d.pkl' % shard_id))
+            for shard_id, (start, end) in enumerate(byte_range_shards(source_json_path, num_shards))]
+    print('Tokenizing %s in %d shards with %d workers' % (source_json_path, len(jobs), num_workers))
+
+    results = _map(_tokenize_shard, jobs, num_workers,
+                   opt=opt, src_fields=src_fields, trg_fields=trg_fields, valid_check=valid_check)
+
+    # merge the counts in shard order, to keep the order of first occurrence of words
+    vocab = Counter()
+    for _, shard_vocab in results:
+        vocab.update(shard_vocab)
+    print('#(tokenized pairs) of %s = %d' % (source_json_path, sum(n for n, _ in results)))
+
+    shard_paths = [job[-1] for job in jobs]
+    print('Dumping tokenized_pairs to ' + cache_path)
+    pykp.io.write_tokenized_pairs(_iter_shards(shard_paths), cache_path)
+
+    return shard_paths, vocab
+
+
+def _export_shard(job):
+    shard_path, output_prefix = job
+    opt = _worker_state['opt']
+    word2id, id2word = _worker_state['word2id'], _worker_state['id2word']
+    include_original = _worker_state['include_original']
+
+    with open(shard_path, 'rb') as shard_file:
+        tokenized_pairs = pickle.load(shard_file)
+
+    one2many_examples, one2one_index = pykp.io.process_data_examples(tokenized_pairs, word2id, id2word, opt,
+                                                                     mode='both', include_original=include_original)
+    torch.save(one2many_examples, open('%s.one2many.pt' % output_prefix, 'wb'))
+    torch.save(one2one_index, open('%s.one2one.pt' % output_prefix, 'wb'))
+
+    return pykp.io.length_statistics(tokenized_pairs)
+
+
+def _concatenate_shards(shard_prefixes):
+    '''
+    Concatenate the one2many examples of the shards, shifting the example ids of their one2one indexes
+    '''
+    one2many_examples = []
+    one2one_indexes = []
+    for prefix in shard_prefixes:
+        one2one_index = torch.load('%s.one2one.pt' % prefix, 'rb')
+        one2one_index[:, 0] += len(one2many_examples)
+        one2one_indexes.append(one2one_index)
+        one2many_examples.extend(torch.load('%s.one2many.pt' % prefix, 'rb'))
+    return one2many_examples, np.concatenate(one2one_indexes) if one2one_indexes else np.zeros((0, 2), dtype=np.int32)
+
+
+def export_dataset(shard_paths, word2id, id2word, opt, output_path, dataset_name,
+                   data_type=None, include_original=False, num_workers=1):
+    '''
+    Parallel version of pykp.io.process_and_export_dataset, taking the tokenized shards of tokenize_json_file
+    :param word2id: the word2id dict or a pykp.vocab.Vocab, which is much cheaper to send to the workers
+    '''
+    assert data_type in ['train', 'valid', 'test']
+
+    work_dir = os.path.join(output_path, '%s.%s.shards' % (dataset_name, data_type))
+    if not os.path.exists(work_dir):
+        os.makedirs(work_dir)
+
+    print("Processing %s data in %d shards with %d workers..." % (data_type, len(shard_paths), num_workers))
+    jobs = [(shard_path, os.path.join(work_dir, '%05d' % shard_id)) for shard_id, shard_path in enumerate(shard_paths)]
+    statistics = _map(_export_shard, jobs, num_workers,
+                      opt=opt, word2id=word2id, id2word=id2word, include_original=include_original)
+
+    one2many_examples, one2one_index = _concatenate_shards([prefix for _, prefix in jobs])
+    print('#pairs of %s %s one2one  = %d' % (dataset_name, data_type, len(one2one_index)))
+    print('#pairs of %s %s one2many = %d' % (dataset_name, data_type, len(one2many_examples)))
+
+    one2many_file_name = '%s.%s.one2many.pt' % (dataset_name, data_type)
+    print("Dumping one2many %s %s to disk: %s" % (dataset_name, data_type, os.path.join(output_path, one2many_file_name)))
+    torch.save(one2many_examples, open(os.path.join(output_path, one2many_file_name), 'wb'))
+    pykp.io.export_dataset_index(one2many_examples, os.path.join(output_path, one2many_file_name))
+    pykp.io.export_one2one_index(one2one_index, one2many_file_name,
+                                 os.path.join(output_path, '%s.%s.one2one.pt' % (dataset_name, data_type)))
+    if getattr(opt, 'columnar', True):
+        export_columnar_dataset(one2many_examples, os.path.join(output_path, '%s.%s.one2many.cols' % (dataset_name, data_type)),
+                                vocab_size=opt.vocab_size, include_original=include_original,
+                                source_path=os.path.join(output_path, one2many_file_name))
+    else:
+        remove_columnar_dataset(os.path.join(output_path, one2many_file_name))
+    del one2many_examples
+
+    shutil.rmtree(work_dir)
+    print("Dumping done!")
+
+    src_len_counter, trg_len_counter = Counter(), Counter()
+    for shard_src_len_counter, shard_trg_len_counter in statistics:
+        src_len_counter.update(shard_src_len_counter)
+        trg_len_counter.update(shard_trg_len_counter)
+    pykp.io.print_length_statistics(dataset_name, data_type, src_len_counter, trg_len_counter)
+
+
+def export_subset(output_path, subset_output_path, dataset_name, data_type, num_examples=None):
+    '''
+    Derive a subset of an exported dataset from its files instead of processing the data again:
+    the first num_examples one2many examples and their one2one examples (all of them if num_examples is None)
+    '''
+    def path_of(dir, mode):
+        return os.path.join(dir, '%s.%s.%s.pt' % (dataset_name, data_type, mode))
+
+    columnar_path = path_of(output_path, 'one2many')[:-len('.pt')] + '.cols'
+    subset_columnar_path = path_of(subset_output_path, 'one2many')[:-len('.pt')] + '.cols'
+    if os.path.exists(subset_columnar_path):
+        shutil.rmtree(subset_columnar_path)
+
+    if num_examples is None:
+        for mode in ['one2one', 'one2many']:
+            shutil.copyfile(path_of(output_path, mode), path_of(subset_output_path, mode))
+        shutil.copyfile(pykp.io.dataset_index_path(path_of(output_path, 'one2many')),
+                        pykp.io.dataset_index_path(path_of(subset_output_path, 'one2many')))
+        if get_columnar_path(path_of(output_path, 'one2many')):
+            shutil.copytree(columnar_path, subset_columnar_path)
+            stamp_columnar_dataset(subset_columnar_path, path_of(subset_output_path, 'one2many'))
+        return
+
+    one2many_examples = torch.load(path_of(output_path, 'one2many'), 'rb')[:num_examples]
+    torch.save(one2many_examples, open(path_of(subset_output_path, 'one2many'), 'wb'))
+    pykp.io.export_dataset_index(one2many_examples, path_of(subset_output_path, 'one2many'))
+    if get_columnar_path(path_of(output_path, 'one2many')):
+        meta = ColumnarExamples(columnar_path).meta
+        export_columnar_dataset(one2many_examples, subset_columnar_path,
+                                vocab_size=meta['vocab_size'], include_original=meta['include_original'],
+                                source_path=path_of(subset_output_path, 'one2many'))
+    del one2many_examples
+
+    # one2one examples only reference the one2many examples
+    one2one = torch.load(path_of(output_path, 'one2one'), 'rb')
+    one2one_index = one2one['one2one_index']
+    pykp.io.export_one2one_index(one2one_index[one2one_index[:, 0] < num_examples], one2one['one2many'],
+                                 path_of(subset_output_path, 'one2one'))
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""
+Compact vocabulary backed by a sorted string table.
+
+The words are kept as one blob of the sorted utf-8 words with their offsets
+and the id of each word, instead of word2id/id2word dicts, so a vocab is cheap
+to pickle to the worker processes and can be memory-mapped when loaded. The
+hash index used to look up the tokens of a document is built from the table on
+first use, in the process using it.
+A vocab is saved as a directory (next to 'xxx.vocab.pt', the dicts are still
+saved for the code that uses them):
+    meta.json       format version and number of words
+    strings.bin     the sorted utf-8 words, concatenated
+    offsets.npy     int64, strings[offsets[i]:offsets[i+1]] is the i-th sorted word
+    ids.npy         int32 id of each sorted word
+    positions.npy   int32, the word of id i is the positions[i]-th sorted word
+"""
+import itertools
+import json
+import os
+
+import numpy as np
+
+__author__ = "Rui Meng"
+__email__ = "rui.meng@pitt.edu"
+
+FORMAT_VERSION = 2
+
+SPECIAL_WORDS = ['<pad>', '<s>', '</s>', '<unk>', '<sep>']
+
+
+def get_vocab_table_path(vocab_path):
+    '''
+    Return the vocab table directory corresponding to a vocab path, i.e. the path itself if it is a
+    directory, or 'xxx.vocab' for 'xxx.vocab.pt' if it exists. Return None if there is no vocab table.
+    '''
+    if os.path.isdir(vocab_path):
+        return vocab_path
+    if vocab_path.endswith('.pt'):
+        path = vocab_path[:-len('.pt')]
+        if os.path.isdir(path):
+            return path
+    return None
+
+
+def _offsets(lengths):
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets
+
+
+class Vocab(object):
+    '''
+    Mapping between words and ids, stored as a table of sorted utf-8 words. It supports the dict operations of
+    word2id (vocab[w], w in vocab, vocab.get(w), len(vocab)) and vectorized lookups with encode()
+    '''
+    def __init__(self, strings, offsets, ids, positions=None, path=None):
+        '''
+        :param strings: uint8 array of the sorted utf-8 words, concatenated
+        :param offsets: int64 array of the boundaries of the words in strings (number of words + 1)
+        :param ids: the id of each sorted word
+        :param positions: the position in the sorted words of each id, computed if not given
+        '''
+        self.strings = strings
+        self.offsets = offsets
+        self.ids = ids
+        if positions is None:
+            positions = np.zeros(len(ids), dtype=np.int32)
+            positions[ids] = np.arange(len(ids), dtype=np.int32)
+        self.positions = positions
+        self.path = path
+        self._index = None
+        self.unk_id = self.get('<unk>')
+
+    @classmethod
+    def from_words(cls, id2word):
+        '''
+        Build the vocab of a list of words, the word of id i being id2word[i]
+        '''
+        words = [w.encode('utf-8') for w in id2word]
+        order = sorted(range(len(words)), key=words.__getitem__)
+        words = [words[i] for i in order]
+        if any(w1 == w2 for w1, w2 in zip(words[:-1], words[1:])):
+            raise ValueError('duplicate words in the vocab')
+        return cls(np.frombuffer(b''.join(words), dtype=np.uint8).copy(), _offsets([len(w) for w in words]),
+                   np.array(order, dtype=np.int32))
+
+    @classmethod
+    def from_word2id(cls, word2id, max_size=None):
+        '''
+        Build the vocab of a word2id dict, keeping the ids lower than max_size only (the others being OOV anyway)
+        '''
+        id2word = [None] * (len(word2id) if max_size is None else min(len(word2id), max_size))
+        for w, i in word2id.items():
+            if i < len(id2word):
+                id2word[i] = w
+        assert all(w is not None for w in id2word), 'the ids of word2id are not contiguous'
+        return cls.from_words(id2word)
+
+    @classmethod
+    def from_counter(cls, counter, max_size=None):
+        '''
+        Build the vocab of token counts (e.g. merged from the counts of shards), with the same ids as
+        pykp.io.build_vocab_from_counter: the special words, then the words by decreasing count,
+        ties being kept in the order of the counter
+        '''
+        words = [w for w, _ in sorted(counter.items(), key=lambda x: x[1], reverse=True) if w not in SPECIAL_WORDS]
+        id2word = SPECIAL_WORDS + words
+        if max_size is not None:
+            id2word = id2word[:max_size]
+        return cls.from_words(id2word)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        '''
+        Load a vocab saved with save(), the arrays are memory-mapped unless mmap=False
+        '''
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        assert meta['format'] == FORMAT_VERSION, 'Unsupported vocab format %s' % str(meta['format'])
+
+        mmap_mode = 'r' if mmap else None
+        offsets, ids, positions = [np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode)
+                                   for name in ['offsets', 'ids', 'positions']]
+        strings_path = os.path.join(path, 'strings.bin')
+        if not mmap:
+            strings = np.fromfile(strings_path, dtype=np.uint8)
+        elif offsets[-1] > 0:
+            strings = np.memmap(strings_path, dtype=np.uint8, mode='r')
+        else:
+            # an empty file can't be memory-mapped
+            strings = np.zeros(0, dtype=np.uint8)
+        return cls(strings, offsets, ids, positions, path=path)
+
+    def save(self, path):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        with open(os.path.join(path, 'strings.bin'), 'wb') as f:
+            f.write(np.asarray(self.strings).tobytes())
+        for name in ['offsets', 'ids', 'positions']:
+            np.save(os.path.join(path, name + '.npy'), np.asarray(getattr(self, name)))
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({'format': FORMAT_VERSION, 'num_words': len(self)}, f)
+
+    def __getstate__(self):
+        # re-open the mapping when unpickled (e.g. in worker processes) instead of copying the arrays
+        if self.path is not None:
+            return {'path': self.path}
+        return {name: np.asarray(getattr(self, name)) for name in ['strings', 'offsets', 'ids', 'positions']}
+
+    def __setstate__(self, state):
+        if 'path' in state:
+            loaded = Vocab.load(state['path'])
+            state = {name: getattr(loaded, name) for name in ['strings', 'offsets', 'ids', 'positions', 'path']}
+        self.__init__(state['strings'], state['offsets'], state['ids'], state['positions'], path=state.get('path'))
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def index(self):
+        '''
+        The hash index of the words, built from the table when first used
+        '''
+        if self._index is None:
+            self._index = dict(zip(self._sorted_words(), np.asarray(self.ids).tolist()))
+        return self._index
+
+    def _sorted_words(self):
+        strings = np.asarray(self.strings).tobytes()
+        offsets = np.asarray(self.offsets).tolist()
+        return [strings[s:e].decode('utf-8') for s, e in zip(offsets[:-1], offsets[1:])]
+
+    def lookup(self, tokens):
+        '''
+        :param tokens: a list of words
+        :return: int64 array of the ids of the tokens, -1 for the words not in the vocab
+        '''
+        return np.fromiter(map(self.index.get, tokens, itertools.repeat(-1)), dtype=np.int64, count=len(tokens))
+
+    def __getitem__(self, word):
+        return self.index[word]
+
+    def __contains__(self, word):
+        return word in self.index
+
+    def get(self, word, default=None):
+        return self.index.get(word, default)
+
+    def word(self, word_id):
+        position = self.positions[word_id]
+        return self.strings[self.offsets[position]:self.offsets[position + 1]].tobytes().decode('utf-8')
+
+    def id2word(self):
+        words = self._sorted_words()
+        return {i: words[p] for i, p in enumerate(np.asarray(self.positions).tolist())}
+
+    def word2id(self):
+        return {w: i for i, w in self.id2word().items()}
+
+    def encode(self, tokens, vocab_size, max_oov_words=None):
+        '''
+        Map the words of a document to their ids, as in pykp.io.extend_vocab_OOV. Words out of the vocab or
+        with an id not lower than vocab_size are <unk>, and are numbered from vocab_size in the extended ids
+        (in the order of their first occurrence) until the document has max_oov_words OOV words,
+        after which the OOV words are <unk> in the extended ids as well
+        :return: the int32 ids, the int32 extended ids, the oov_dict and the oov_list of the document
+        '''
+        word_ids = self.lookup(tokens)
+        is_oov = (word_ids < 0) | (word_ids >= vocab_size)
+        ids = np.where(is_oov, self.unk_id, word_ids).astype(np.int32)
+        ext_ids = ids.copy()
+
+        # only the OOV words (usually a few) are numbered one by one, in the order of their first occurrence
+        oov_dict = {}
+        for p in np.flatnonzero(is_oov).tolist():
+            if max_oov_words is not None and len(oov_dict) >= max_oov_words:
+                # once the document has max_oov_words OOV words, all the following OOV words are <unk>
+                break
+            ext_ids[p] = oov_dict.setdefault(tokens[p], vocab_size + len(oov_dict))
+
+        oov_list = [w for w, _ in sorted(oov_dict.items(), key=lambda x: x[1])]
+        return ids, ext_ids, oov_dict, oov_list
+
+    def encode_target(self, tokens, vocab_size, oov_dict):
+        '''
+        Map the words of a target to their ids, and to their extended ids given the oov_dict of its source
+        :return: the int32 ids and the int32 extended ids
+        '''
+        word_ids = self.lookup(tokens)
+        is_oov = (word_ids < 0) | (word_ids >= vocab_size)
+        ids = np.where(is_oov, self.unk_id, word_ids).astype(np.int32)
+        ext_ids = ids.copy()
+        for p in np.flatnonzero(is_oov):
+            ext_ids[p] = oov_dict.get(tokens[p], self.unk_id)
+        return ids, ext_ids
@@ -21,6 +21,7 @@ from utils import Progbar, plot_learning_curve_and_write_csv
 from config import init_logging, init_opt
 import pykp
 from pykp.io import KeyphraseDataset
+from pykp.vocab import SPECIAL_WORDS, Vocab, get_vocab_table_path
 from pykp.model import Seq2SeqLSTMAttention, Seq2SeqLSTMAttentionCascading
 
 import time
@@ -417,7 +418,8 @@ def train_model(model, optimizer_ml, optimizer_rl, criterion, train_data_loader,
     generator = SequenceGenerator(model,
                                   eos_id=opt.word2id[pykp.io.EOS_WORD],
                                   beam_size=opt.beam_size,
-                                  max_sequence_length=opt.max_sent_length
+                                  max_sequence_length=opt.max_sent_length,
+                                  n_best=opt.n_best
                                   )
     logger = logging.getLogger('train.py')
     logger.info('======================  Checking GPU Availability  =========================')
@@ -625,10 +627,25 @@ def train_model(model, optimizer_ml, optimizer_rl, criterion, train_data_loader,
                 logging.info('*' * 50)
 
 
+def load_vocab(opt):
+    '''
+    Load the vocab dumped by preprocess.py. word2id is the memory-mapped vocab table ('xxx.vocab' for 'xxx.vocab.pt',
+    see pykp.vocab) if there is one, which is much cheaper to send to the loader workers than the dicts
+    :return: word2id, id2word and the number of words of the data (besides the special words)
+    '''
+    vocab_table_path = get_vocab_table_path(opt.vocab_path)
+    if vocab_table_path:
+        word2id = Vocab.load(vocab_table_path)
+        return word2id, word2id.id2word(), len(word2id) - len(SPECIAL_WORDS)
+
+    word2id, id2word, vocab = torch.load(opt.vocab_path, 'rb')
+    return word2id, id2word, len(vocab)
+
+
 def load_data_vocab_for_training(opt, load_train=True):
 
     logging.info("Loading vocab from disk: %s" % (opt.vocab_path))
-    word2id, id2word, vocab = torch.load(opt.vocab_path, 'rb')
+    word2id, id2word, vocab_size = load_vocab(opt)
     pin_memory = torch.cuda.is_available()
 
     # one2one data loader
@@ -648,6 +665,9 @@ def load_data_vocab_for_training(opt, load_train=True):
                                                     num_workers=opt.batch_workers,
                                                     max_batch_example=1024,
                                                     max_batch_pair=opt.batch_size,
+                                                    max_batch_tokens=opt.max_batch_tokens,
+                                                    bucket_size=opt.bucket_size,
+                                                    prefetch_factor=opt.prefetch_factor,
                                                     pin_memory=pin_memory,
                                                     shuffle=True)
 
@@ -692,6 +712,7 @@ def load_data_vocab_for_training(opt, load_train=True):
                                                 num_workers=opt.batch_workers,
                                                 max_batch_example=opt.beam_search_batch_example,
                                                 max_batch_pair=opt.beam_search_batch_size,
+                                                prefetch_factor=opt.prefetch_factor,
                                                 pin_memory=pin_memory,
                                                 shuffle=False)
     test_one2many_loader = KeyphraseDataLoader(dataset=test_one2many_dataset,
@@ -699,24 +720,24 @@ def load_data_vocab_for_training(opt, load_train=True):
                                                num_workers=opt.batch_workers,
                                                max_batch_example=opt.beam_search_batch_example,
                                                max_batch_pair=opt.beam_search_batch_size,
+                                               prefetch_factor=opt.prefetch_factor,
                                                pin_memory=pin_memory,
                                                shuffle=False)
 
     opt.word2id = word2id
     opt.id2word = id2word
-    opt.vocab = vocab
 
     logging.info('#(valid data size: #(one2many pair)=%d, #(one2one pair)=%d, #(batch)=%d' % (len(valid_one2many_loader.dataset), valid_one2many_loader.one2one_number(), len(valid_one2many_loader)))
     logging.info('#(test data size:  #(one2many pair)=%d, #(one2one pair)=%d, #(batch)=%d' % (len(test_one2many_loader.dataset), test_one2many_loader.one2one_number(), len(test_one2many_loader)))
 
-    logging.info('#(vocab from data)=%d' % len(vocab))
+    logging.info('#(vocab from data)=%d' % vocab_size)
     logging.info('#(vocab in setting)=%d' % opt.vocab_size)
-    if opt.vocab_size > len(vocab):
-        logging.info('size of vocab is smaller than setting, reset it to %d' % len(vocab))
-        opt.vocab_size = len(vocab)
+    if opt.vocab_size > vocab_size:
+        logging.info('size of vocab is smaller than setting, reset it to %d' % vocab_size)
+        opt.vocab_size = vocab_size
     logging.info('#(vocab used)=%d' % opt.vocab_size)
 
-    return train_one2many_loader, valid_one2many_loader, test_one2many_loader, word2id, id2word, vocab
+    return train_one2many_loader, valid_one2many_loader, test_one2many_loader, word2id, id2word, vocab_size
 
 
 def load_vocab_and_datasets_for_testing(dataset_names, type, opt):
@@ -732,8 +753,8 @@ def load_vocab_and_datasets_for_testing(dataset_names, type, opt):
     assert type == 'test' or type == 'valid'
 
     logger.info("Loading vocab from disk: %s" % (opt.vocab_path))
-    word2id, id2word, vocab = torch.load(opt.vocab_path, 'rb')
-    logger.info('#(vocab)=%d' % len(vocab))
+    word2id, id2word, vocab_size = load_vocab(opt)
+    logger.info('#(vocab)=%d' % vocab_size)
 
     pin_memory = torch.cuda.is_available()
     one2many_loaders = []
@@ -760,6 +781,7 @@ def load_vocab_and_datasets_for_testing(dataset_names, type, opt):
                                               num_workers=opt.batch_workers,
                                               max_batch_example=opt.beam_search_batch_example,
                                               max_batch_pair=opt.beam_search_batch_size,
+                                              prefetch_factor=opt.prefetch_factor,
                                               pin_memory=pin_memory,
                                               shuffle=False)
 
@@ -771,7 +793,7 @@ def load_vocab_and_datasets_for_testing(dataset_names, type, opt):
                      len(one2many_loader)))
         logger.info('*' * 50)
 
-    return one2many_loaders, word2id, id2word, vocab
+    return one2many_loaders, word2id, id2word, vocab_size
 
 
 def init_optimizer_criterion(model, opt):